@@ -1,26 +1,45 @@
 #!/usr/bin/env python3
+import codecs
 import csv
+import filecmp
+import json
 import logging
+import math
+import mmap
+import os
 import re
+import shutil
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from base64 import b64encode
+from bisect import bisect_left
+from collections import Counter
 from collections import namedtuple
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timezone
 from decimal import Decimal
+from decimal import InvalidOperation
+from functools import partial
+from html import escape
+from html import unescape
+from html.parser import HTMLParser
 from io import StringIO
+from itertools import chain
+from itertools import islice
 from urllib.error import URLError
-from urllib.request import urlopen
+from urllib.parse import urlencode
+from urllib.parse import urljoin
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
 
-from bs4 import BeautifulSoup
-from geojson import dumps
-from geojson import Feature
-from geojson import FeatureCollection
-from geojson import Point
-from simplekml import featgeom
-from simplekml import Kml
-
-try:
-    from systemd import journal
-    systemd = True
-except ImportError:
-    systemd = False
+# The heavier modules (asyncio, http.client, sqlite3, geojson and systemd) are imported
+# by the functions that need them, so that 'import archmap' and runs that don't use them start faster.
 
 
 # ---------------------------------------------------------------------------------------- #
@@ -35,6 +54,25 @@ default_config = '/etc/archmap.conf'
 default_url = 'https://wiki.archlinux.org/index.php/ArchMap/List'
 default_file = ''
 
+# If a MediaWiki API endpoint is supplied to 'default_api', the wikitext of the 'default_title' page
+# is fetched from it instead of the rendered page at 'default_url'. The last revision that was used
+# is saved to 'default_revision' so that runs where the page hasn't changed can be skipped.
+default_api = ''
+default_title = 'ArchMap/List'
+default_revision = ''
+
+# If a file path is supplied to 'default_raw', the users are read from it as a raw-text list
+# (the same format as the list on the wiki, without any HTML) instead of using the wiki
+default_raw = ''
+
+# If a file path is supplied to 'default_load', the users are read back from a CSV, GeoJSON or KML output
+# that archmap made earlier instead of using the wiki, e.g. to make other outputs from it
+default_load = ''
+
+# Additional URLs and/or file paths (separated by whitespace or newlines) to fetch
+# alongside the main list. The users from every source are merged and de-duplicated.
+default_sources = ''
+
 # Set the output locations for the raw-text, GeoJSON, KML and CSV files.
 # Setting any of the following to 'no' or leaving them blank will disable the output,
 # use '-' to print the generated text to stdout.
@@ -43,6 +81,37 @@ default_geojson = '/tmp/archmap.geojson'
 default_kml = '/tmp/archmap.kml'
 default_csv = '/tmp/archmap.csv'
 
+# Set the output locations for the compact binary formats, these are disabled by default.
+# See the documentation of 'make_points()' and 'make_msgpack()' for the formats.
+default_points = ''
+default_msgpack = ''
+
+# Set the location of the SQLite database that the users are exported to, this is disabled by default.
+default_sqlite = ''
+
+# If a file path is supplied to 'default_ids', each user is given an ID that is made from their details
+# and stays the same between runs, instead of their position in the list. The IDs are saved to the file
+# and used for the features in the GeoJSON and KML outputs
+default_ids = ''
+
+# If a GeoJSON file of country boundaries (e.g. Natural Earth's "Admin 0 - Countries") is supplied to
+# 'default_boundaries', each user is given the code of the country they are in and the number of users
+# in each country is saved to 'default_countries' as JSON. 'default_country_code' is the property of each
+# boundary feature that holds its code
+default_boundaries = ''
+default_countries = ''
+default_country_code = 'ISO_A2'
+
+# Set the output locations for the number of users in each cell of a 'default_cell_size' degree grid,
+# 'default_density' is GeoJSON (a square polygon for each cell that has users in it)
+# and 'default_density_grid' is an ESRI ASCII grid of every cell. These are disabled by default
+default_density = ''
+default_density_grid = ''
+default_cell_size = '1'
+
+# The most cells in the density grid, a 0.1 degree grid of the world has 6,480,000 of them
+density_grid_max_cells = 10000000
+
 # Define the verbosity level:
 # '-1' will disable all messages other than critical messages (same as '--quiet')
 # '0' will disable all messages other than error messages
@@ -53,37 +122,452 @@ default_verbosity = 1
 # Setting the following to 'True' will align the columns in the raw-text list
 default_pretty = False
 
+# Define the number of decimal places to round the coordinates of every output to, 4 (about 10 metres)
+# is plenty for a map. Leave it blank to keep the coordinates as they were written on the wiki
+default_precision = ''
+
+# Setting the following to 'True' will make the GeoJSON and KML as small as possible
+# by leaving out the indentation and empty comments
+default_compact = False
+
+# Setting the following to 'geohash' will sort the users by where they are (nearby users end up next to each other)
+# and 'name' will sort them alphabetically, leave it blank to keep them in the same order as the wiki list.
+# Sorting keeps the outputs in the same order when users are added to or moved around in the list
+default_sort = ''
+
+# Define the CSV output:
+# 'columns' is a comma separated list of the columns to include (latitude, longitude, name and comment),
+# 'precision' is the number of decimal places to round the coordinates to (leave it blank to keep them as they are),
+# 'encoding' is the text encoding and 'buffering' is the size of the write buffer in bytes ('-1' uses the default)
+default_csv_columns = 'latitude, longitude, name, comment'
+default_csv_precision = ''
+default_csv_encoding = 'utf-8'
+default_csv_buffering = -1
+
+# Define what happens to users with impossible coordinates and duplicated users
+# (the same name at the same coordinates, or within 'default_nearby' degrees of them):
+# 'drop' will remove them from the outputs, 'flag' will only report them and 'no' will skip the checks.
+# 'default_nearby' has to be more than 0
+default_validate = 'flag'
+default_nearby = '0.01'
+
+# The lines that couldn't be parsed are saved to 'default_parse_report' as JSON, leave it blank to only log them.
+# If more than 'default_max_bad_lines' (a fraction between 0 and 1) of the lines can't be parsed,
+# the list is probably broken so none of the outputs are written, leave it blank to always write them
+default_parse_report = ''
+default_max_bad_lines = ''
+
+# If a file path is supplied to 'default_state', the number of users and a hash of them are saved to it
+# each time the outputs are written. If the next run has lost more than 'default_max_shrink'
+# (a fraction between 0 and 1) of the users, the wiki page is probably broken so the outputs are left as they are
+default_state = ''
+default_max_shrink = '0.5'
+
+# If a directory is supplied to 'default_generations', each run writes its output files to a new directory in it
+# and then points the 'current' symlink in it at that directory, so the outputs should be read from 'current'.
+# The newest 'default_keep_generations' are kept and any older than 'default_generation_max_age' hours are
+# removed, leave it blank to keep them regardless of their age
+default_generations = ''
+default_keep_generations = '3'
+default_generation_max_age = ''
+
+# If a file path is supplied to 'default_archive', a snapshot of the users is added to it on each run.
+# Most snapshots are stored as compressed changes to the one before, with a complete copy
+# every 'default_keyframe_interval' snapshots
+default_archive = ''
+default_keyframe_interval = '28'
+
+# The number of seconds to wait for each source before giving up on it
+# and the number of times to retry a source that failed
+default_timeout = 30
+default_retries = 2
+
+# Limits on what is accepted from the sources, so a vandalized page can't use up all of the memory or time.
+# 'download' is the most bytes to download from each source (the list is cut off at the last whole line),
+# 'line_length' is the longest line that is parsed (longer lines are skipped as bad lines),
+# 'users' is the most users to parse from each source and 'parse_time' is the most seconds to spend parsing each one.
+# Leave any of them blank to not limit it
+default_limit_download = '67108864'
+default_limit_line_length = '4096'
+default_limit_users = '1000000'
+default_limit_parse_time = '60'
+
 # -------------------------------------------------------------------------------------- #
 
 logging.basicConfig(format='==> %(message)s')
 log = logging.getLogger('archmap')
 log.setLevel(logging.WARNING)
 
-if systemd is not False:
-    log.addHandler(journal.JournalHandler(SYSLOG_IDENTIFIER='archmap'))
-    log.handlers[0].setFormatter(logging.Formatter('%(message)s.'))
-
 # Define the namedtuple used to store each users details
 Entry = namedtuple(typename='Entry', field_names=['latitude', 'longitude', 'name', 'comment'])
 
+# Define the namedtuple used to report the users that were found by 'validate_users()'
+ValidationReport = namedtuple(typename='ValidationReport', field_names=['invalid', 'duplicates', 'nearby'])
+
+
+class ParseReport:
+    """The lines that :func:`parse_users` couldn't parse, counted by the reason they couldn't be parsed.
+
+    The reasons are ``'missing quotes'`` (the name isn't between two quote marks), ``'missing coordinates'``
+    and ``'bad coordinates'`` (the coordinates aren't two numbers separated by a comma), or ``'too long'``
+    if the line is longer than the limit. Only the first ``max_samples`` lines for each reason are kept.
+    If a list was cut off because it reached a limit, the reason is in :attr:`truncated`.
+
+    Args:
+        max_samples (int): The most lines to keep for each reason
+    """
+
+    def __init__(self, max_samples=5):
+        self.max_samples = max_samples
+        self.lines = 0
+        self.reasons = Counter()
+        self.samples = {}
+        self.truncated = []
+
+    @property
+    def bad_lines(self):
+        """int: The number of lines that couldn't be parsed."""
+        return sum(self.reasons.values())
+
+    @property
+    def ratio(self):
+        """float: The fraction of the lines that couldn't be parsed."""
+        return self.bad_lines / self.lines if self.lines else 0.0
+
+    def add(self, line_number, line, reason):
+        """Count ``line`` as a bad line, because of ``reason``."""
+        self.reasons[reason] += 1
+        samples = self.samples.setdefault(reason, [])
+        if len(samples) < self.max_samples:
+            samples.append((line_number, line))
+
+    def summary(self):
+        """Describe the bad lines, with the lines that were kept for each reason.
+
+        Returns:
+            str: The summary, or an empty string if there weren't any bad lines
+        """
+        summary = []
+        if self.reasons:
+            summary.append('Skipped {} bad lines of {} ({})'.format(self.bad_lines, self.lines, ', '.join(
+                '{} {}'.format(count, reason) for reason, count in self.reasons.most_common())))
+            for reason, samples in self.samples.items():
+                summary += ['    {} ({}): {}'.format(reason, line_number, line) for line_number, line in samples]
+        summary += ['The list was cut off: ' + reason for reason in self.truncated]
+        return '\n'.join(summary)
+
+    def write(self, report_file):
+        """Save the report to ``report_file`` as JSON."""
+        log.info('Writing the parse report to ' + report_file)
+        with open(report_file, 'w') as output:
+            json.dump({'lines': self.lines,
+                       'bad_lines': self.bad_lines,
+                       'reasons': dict(self.reasons),
+                       'samples': {reason: [{'line': line_number, 'text': line} for line_number, line in samples]
+                                   for reason, samples in self.samples.items()},
+                       'truncated': self.truncated},
+                      output, ensure_ascii=False, indent=4, sort_keys=True)
+            output.write('\n')
+
+
+class DownloadLimitError(URLError):
+    """Raised by :meth:`ConnectionPool.stream` once a response has gone over its ``max_bytes``,
+    everything up to the limit has already been yielded."""
+
+
+class ConnectionPool:
+    """A pool of HTTP(S) connections that are kept alive and reused between requests.
+
+    Reusing a connection avoids a new TCP and TLS handshake every time the same host is asked for a page,
+    which adds up when archmap is run as a daemon or fetches several lists from the same server.
+    The pool is thread-safe, each request gets a connection to itself for as long as its response is being read.
+
+    Proxies are taken from the environment (``http_proxy``, ``https_proxy`` and ``no_proxy``) the same way as
+    :mod:`urllib.request` does. HTTP requests are sent to the proxy, HTTPS requests are tunnelled through it.
+
+    Args:
+        max_idle (int): The most idle connections to keep open for each host
+        chunk_size (int): Number of bytes to read from the socket at a time
+    """
 
-def get_users(url='https://wiki.archlinux.org/index.php/ArchMap/List', local=''):
+    def __init__(self, max_idle=4, chunk_size=65536):
+        self.max_idle = max_idle
+        self.chunk_size = chunk_size
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def stream(self, url, timeout=None, max_redirects=5, max_bytes=None):
+        """Request ``url`` and yield the decoded text of the response as it arrives.
+
+        Redirects are followed and ``gzip`` or ``deflate`` encoded responses are decompressed on the fly.
+
+        Args:
+            url (str): The URL to get
+            timeout (float): Number of seconds to wait for the server before giving up, ``None`` waits forever
+            max_redirects (int): The most redirects to follow before giving up
+            max_bytes (int): The most bytes of the (decompressed) response body to read, ``None`` reads all of it.
+                Compressed responses are never decompressed past this, however well they compress
+
+        Yields:
+            str: Pieces of the decoded response body
+
+        Raises:
+            DownloadLimitError: If the response body is longer than ``max_bytes``
+            urllib.error.URLError: If the server responds with an error status or breaks the connection
+            OSError: If the server can't be reached
+        """
+        from http.client import HTTPException
+
+        try:
+            yield from self._stream(url, timeout, max_redirects, max_bytes)
+        except HTTPException as error:
+            raise URLError(error)
+
+    def _stream(self, url, timeout, max_redirects, max_bytes):
+        """Do the work for :meth:`stream`, which turns the errors from :mod:`http.client` into ``URLError``."""
+        for _ in range(max_redirects + 1):
+            key, connection, response = self._request(url, timeout)
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                self._release(key, connection, response)
+                url = urljoin(url, response.getheader('Location'))
+                log.debug('Redirected to {}'.format(url))
+                continue
+
+            if response.status >= 400:
+                connection.close()
+                raise URLError('HTTP Error {}: {}'.format(response.status, response.reason))
+
+            break
+        else:
+            connection.close()
+            raise URLError('Too many redirects')
+
+        encoding = response.getheader('Content-Encoding', 'identity').lower()
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = None
+
+        charset = response.msg.get_content_charset() or 'utf-8'
+        decoder = codecs.getincrementaldecoder(charset)()
+
+        remaining = max_bytes
+        try:
+            chunk = response.read(self.chunk_size)
+            while chunk:
+                if decompressor is not None:
+                    # Decompressing one byte past the limit is enough to tell that it has been reached.
+                    chunk = decompressor.decompress(chunk, remaining + 1 if remaining is not None else 0)
+                if remaining is not None:
+                    if len(chunk) > remaining:
+                        yield decoder.decode(chunk[:remaining])
+                        raise DownloadLimitError('The response is larger than {} bytes'.format(max_bytes))
+                    remaining -= len(chunk)
+                yield decoder.decode(chunk)
+                chunk = response.read(self.chunk_size)
+
+            if decompressor is not None:
+                yield decoder.decode(decompressor.flush(), final=True)
+            else:
+                yield decoder.decode(b'', final=True)
+        except BaseException:
+            # The rest of the response is still in the socket, so this connection can't be reused.
+            connection.close()
+            raise
+
+        self._release(key, connection, response)
+
+    def close(self):
+        """Close all of the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, url, timeout):
+        """Send a GET request for ``url`` on a pooled connection and return ``(key, connection, response)``."""
+        from http.client import HTTPConnection
+        from http.client import HTTPException
+        from http.client import HTTPSConnection
+
+        parts = urlsplit(url)
+        proxy = self._proxy(parts)
+        key = (parts.scheme, parts.hostname, parts.port, proxy)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {'Accept-Encoding': 'gzip, deflate', 'User-Agent': 'archmap'}
+
+        proxy_headers = {}
+        if proxy is not None:
+            proxy_parts = urlsplit(proxy)
+            if proxy_parts.username is not None:
+                credentials = '{}:{}'.format(unquote(proxy_parts.username), unquote(proxy_parts.password or ''))
+                proxy_headers['Proxy-Authorization'] = 'Basic ' + b64encode(credentials.encode()).decode('ascii')
+            if parts.scheme == 'http':
+                # A plain HTTP proxy is asked for the whole URL, which also gives it the Host header.
+                path = urlunsplit((parts.scheme, parts.netloc, path, '', ''))
+                headers.update(proxy_headers)
+
+        connection = self._acquire(key, timeout)
+        if connection is not None:
+            try:
+                connection.request('GET', path, headers=headers)
+                return key, connection, connection.getresponse()
+            except (OSError, HTTPException):
+                # The server has probably closed the idle connection, so try again on a new one.
+                connection.close()
+
+        if parts.scheme not in ('http', 'https'):
+            raise URLError('Unknown URL type: {}'.format(url))
+        elif proxy is not None and parts.scheme == 'https':
+            connection = HTTPSConnection(proxy_parts.hostname, proxy_parts.port, timeout=timeout)
+            connection.set_tunnel(parts.hostname, parts.port, headers=proxy_headers)
+        elif proxy is not None:
+            connection = HTTPConnection(proxy_parts.hostname, proxy_parts.port, timeout=timeout)
+        elif parts.scheme == 'https':
+            connection = HTTPSConnection(parts.hostname, parts.port, timeout=timeout)
+        else:
+            connection = HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+
+        try:
+            connection.request('GET', path, headers=headers)
+            return key, connection, connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+    @staticmethod
+    def _proxy(parts):
+        """Return the URL of the proxy to use for the split URL ``parts``, or None to connect directly."""
+        from urllib.request import getproxies
+        from urllib.request import proxy_bypass
+
+        proxy = getproxies().get(parts.scheme)
+        if not proxy or proxy_bypass(parts.netloc):
+            return None
+        if '//' not in proxy:
+            # Proxies are often given without a scheme, e.g. 'proxy.example.com:3128'
+            proxy = 'http://' + proxy
+        return proxy
+
+    def _acquire(self, key, timeout):
+        """Take an idle connection for ``key`` out of the pool, or return None if there isn't one."""
+        with self._lock:
+            connections = self._idle.get(key)
+            if not connections:
+                return None
+            connection = connections.pop()
+
+        connection.timeout = timeout
+        if connection.sock is not None:
+            try:
+                connection.sock.settimeout(timeout)
+            except OSError:
+                connection.close()
+                return None
+        return connection
+
+    def _release(self, key, connection, response):
+        """Put a connection with a fully read ``response`` back in the pool so it can be reused."""
+        if response.will_close:
+            connection.close()
+            return
+
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+
+        connection.close()
+
+
+# The pool that is used by default, keeping connections alive between calls of 'get_users()'
+http_pool = ConnectionPool()
+
+
+class PreExtractor(HTMLParser):
+    """An HTML parser that keeps the text of the last ``<pre>`` block it has seen.
+
+    The HTML can be passed to :meth:`feed` in as many pieces as needed,
+    so a page can be parsed while it is still being downloaded.
+    Once :meth:`close` has been called, the text is in ``text`` (or None if there were no ``<pre>`` tags).
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = None
+        self._depth = 0
+        self._pieces = []
+
+    @property
+    def in_pre(self):
+        """bool: True if the HTML fed so far ends inside a ``<pre>`` block."""
+        return self._depth > 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'pre':
+            if self._depth == 0:
+                self._pieces = []
+            self._depth += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'pre' and self._depth > 0:
+            self._depth -= 1
+            if self._depth == 0:
+                self.text = ''.join(self._pieces)
+
+    def handle_data(self, data):
+        if self._depth > 0:
+            self._pieces.append(data)
+
+    def close(self):
+        super().close()
+
+        # Treat a <pre> that is still open at the end of the page as if it had been closed.
+        if self._depth > 0:
+            self._depth = 0
+            self.text = ''.join(self._pieces)
+
+
+def get_users(url='https://wiki.archlinux.org/index.php/ArchMap/List', local='', timeout=None, pool=None,
+              max_bytes=None):
     """This funtion parses the list of users from the ArchWiki and returns it as a string.
 
+    The page is parsed while it is being downloaded, so only the list itself is ever held in memory.
+    If the page is larger than ``max_bytes``, only that much of it is read. When that cuts the list off,
+    the last line (which may only be part of a line) is left out.
+
     Args:
         url (str): Link to a URL that points to a ArchWiki ArchMap list (default)
         local (str): Path to a local copy of the ArchWiki ArchMap source
+        timeout (float): Number of seconds to wait for the URL before giving up, ``None`` waits forever
+        pool (:obj:`ConnectionPool`): The connection pool to use, defaults to the shared ``http_pool``
+        max_bytes (int): The most bytes of the page to read (characters for a local copy), ``None`` reads all of it
 
     Returns:
         str or None: The extracted raw-text list of users or None if not avaliable
     """
+    # Grab the user data between the last set of <pre> tags.
+    extractor = PreExtractor()
+    truncated = False
+
     if local == '':
-        # Open and decode the page from the URL containing the list of users.
+        # Stream and decode the page from the URL containing the list of users.
         log.info('Getting users from the ArchWiki: {}'.format(url))
         try:
-            wiki = urlopen(url)
-            wiki_source = wiki.read().decode()
-        except URLError:
+            for piece in (pool or http_pool).stream(url, timeout=timeout, max_bytes=max_bytes):
+                extractor.feed(piece)
+        except DownloadLimitError:
+            truncated = True
+        except OSError:
             log.critical("Can't connect to the ArchWiki")
             return None
 
@@ -91,67 +575,1055 @@ def get_users(url='https://wiki.archlinux.org/index.php/ArchMap/List', local='')
         # Open and decode the local page containing the list of users.
         with open(local, 'r') as wiki:
             log.info('Getting users from a local file: {}'.format(local))
-            wiki_source = wiki.read()
+            remaining = max_bytes
+            for piece in iter(partial(wiki.read, 65536), ''):
+                if remaining is not None:
+                    if len(piece) > remaining:
+                        extractor.feed(piece[:remaining])
+                        truncated = True
+                        break
+                    remaining -= len(piece)
+                extractor.feed(piece)
+
+    # The list was still being read when the limit was reached.
+    cut_off = truncated and extractor.in_pre
+    extractor.close()
+
+    if extractor.text is None:
+        log.critical("Can't find the list of users")
+        return None
+
+    text = extractor.text.strip()
+    if truncated:
+        log.warning('Only the first {} bytes of {} were read'.format(max_bytes, local or url))
+    if cut_off:
+        text = text.rpartition('\n')[0].rstrip()
+    return text
+
+
+def get_users_api(api='https://wiki.archlinux.org/api.php', title='ArchMap/List', revision=None,
+                  timeout=None, pool=None, max_bytes=None):
+    """This function gets the list of users from the wikitext of the ``title`` page using the MediaWiki API.
+
+    The wikitext is a fraction of the size of the rendered page and doesn't need any HTML parsing.
+    The latest revision ID of the page is checked first, if it is the same as ``revision``
+    the page hasn't changed since it was last used, so the wikitext isn't downloaded at all.
+
+    Args:
+        api (str): Link to the ``api.php`` of the wiki
+        title (str): The title of the page containing the list
+        revision (int): The revision ID of the page that was used last time, if there was one
+        timeout (float): Number of seconds to wait for the API before giving up, ``None`` waits forever
+        pool (:obj:`ConnectionPool`): The connection pool to use, defaults to the shared ``http_pool``
+        max_bytes (int): The most bytes of each response to read, the JSON can't be used if it is cut off
+            so the list isn't avaliable if the response is larger than this
+
+    Returns:
+        tuple: ``(revision, users)``, the latest revision ID and the extracted raw-text list of users.
+        ``users`` is None if the revision hasn't changed and both are None if the list isn't avaliable
+    """
+    query = {'action': 'query', 'prop': 'revisions', 'titles': title, 'rvprop': 'ids',
+             'format': 'json', 'formatversion': '2'}
+
+    log.info('Getting users from the ArchWiki API: {} ({})'.format(api, title))
+    try:
+        latest = _get_revision(api, query, timeout, pool, max_bytes)
+        if latest['revid'] == revision:
+            log.info('Revision {} has not changed'.format(revision))
+            return revision, None
+
+        query['rvprop'] = 'ids|content'
+        query['rvslots'] = 'main'
+        latest = _get_revision(api, query, timeout, pool, max_bytes)
+    except DownloadLimitError:
+        log.critical('The response from the ArchWiki API is larger than {} bytes'.format(max_bytes))
+        return None, None
+    except OSError:
+        log.critical("Can't connect to the ArchWiki")
+        return None, None
+    except (ValueError, KeyError, IndexError, TypeError):
+        log.critical("Can't find {} in the response from the ArchWiki API".format(title))
+        return None, None
 
     # Grab the user data between the last set of <pre> tags.
-    soup = BeautifulSoup(wiki_source, 'html.parser')
-    wiki_text = soup.find_all('pre')[-1].text.strip()
+    pre_blocks = re.findall(r'<pre[^>]*>(.*?)</pre>', latest['slots']['main']['content'], re.DOTALL | re.IGNORECASE)
+    if not pre_blocks:
+        log.critical("Can't find the list of users")
+        return None, None
 
-    return wiki_text
+    log.debug('Got revision {}'.format(latest['revid']))
+    return latest['revid'], unescape(pre_blocks[-1]).strip()
 
 
-def parse_users(users):
+def _get_revision(api, query, timeout, pool, max_bytes):
+    """Request the latest revision of a page from the MediaWiki ``api`` and return its JSON."""
+    response = ''.join((pool or http_pool).stream(api + '?' + urlencode(query), timeout=timeout, max_bytes=max_bytes))
+    return json.loads(response)['query']['pages'][0]['revisions'][0]
+
+
+def get_users_multi(sources, timeout=30, retries=2, max_bytes=None):
+    """This function fetches the raw-text lists from several sources at the same time.
+
+    Each source can either be a URL or a path to a local copy of an ArchWiki ArchMap page,
+    they are all fetched concurrently (using :mod:`asyncio` and a thread pool), so a slow
+    mirror only delays the run by its own ``timeout`` rather than adding to the others.
+    The attempts at each source are made one after the other, the next one starts once the last one has failed.
+
+    Args:
+        sources (:obj:`list` of :obj:`str`): URLs and/or file paths to get the lists from
+        timeout (float): Number of seconds to wait for the server on each attempt at a source
+        retries (int): Number of times to retry a source after the first attempt fails
+        max_bytes (int): The most bytes to read from each source, see :func:`get_users`
+
+    Returns:
+        :obj:`list` of :obj:`str` or None: The raw-text lists in the same order as ``sources``,
+        a source that couldn't be fetched is None
+    """
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_get_users_all(loop, sources, timeout, retries, max_bytes))
+    finally:
+        loop.close()
+
+
+async def _get_users_all(loop, sources, timeout, retries, max_bytes):
+    """Start fetching every source in ``sources`` and wait until they have all finished."""
+    import asyncio
+
+    results = await asyncio.gather(*[_get_users_async(loop, source, timeout, retries, max_bytes) for source in sources])
+    return list(results)
+
+
+async def _get_users_async(loop, source, timeout, retries, max_bytes):
+    """Fetch a single ``source`` for :func:`get_users_multi`, retrying it if it fails or times out."""
+    if source.startswith(('http://', 'https://')):
+        fetch = partial(get_users, url=source, timeout=timeout, max_bytes=max_bytes)
+    else:
+        fetch = partial(get_users, local=source, max_bytes=max_bytes)
+
+    for attempt in range(1, retries + 2):
+        # The attempt is left to time out on its socket, a thread can't be stopped from outside
+        # so giving up on it here would only start the next attempt while it's still running.
+        try:
+            users = await loop.run_in_executor(None, fetch)
+        except OSError:
+            users = None
+
+        if users is not None:
+            return users
+        log.warning('Attempt {} of {} failed for {}'.format(attempt, retries + 1, source))
+
+    log.error("Can't get users from {}".format(source))
+    return None
+
+
+def merge_users(*user_lists):
+    """This function merges several lists of parsed users into one, preserving their order.
+
+    Entries that are exactly the same (e.g. because a mirror contains a copy of the ArchWiki list)
+    are only kept the first time they are seen.
+
+    Args:
+        *user_lists (:obj:`list` of :obj:`collections.namedtuple`): Lists generated by :func:`parse_users`
+
+    Returns:
+        :obj:`list` of :obj:`collections.namedtuple`: The merged list of users
+    """
+    merged = []
+    seen = set()
+
+    for users in user_lists:
+        for user in users:
+            if user not in seen:
+                seen.add(user)
+                merged.append(user)
+
+    log.debug('Merged {} lists into {} users'.format(len(user_lists), len(merged)))
+    return merged
+
+
+def parse_users(users, report=None, max_line=None, max_users=None, time_limit=None):
     """This function parses the raw-text list (``users``) that has been extracted from the wiki page
     and splits it into a list of namedtuples containing the latitude, longitude, name and comment.
 
+    The lines that can't be parsed are skipped and added to ``report``. If a report isn't given,
+    a summary of them is logged once all of the lines have been parsed. Empty lines are ignored.
+    The names and comments are cleaned up with :func:`clean_text`, so none of the outputs have to.
+
+    Lines longer than ``max_line`` are skipped as ``'too long'``. If ``max_users`` users have been parsed
+    or parsing has taken longer than ``time_limit``, the rest of the list is left out and the report says so.
+
+    Args:
+        users (str or iterable): raw-text list from the ArchWiki, or its lines (e.g. from :func:`read_users`)
+        report (:obj:`ParseReport`): The report to add the bad lines to, it can be shared by more than one list
+        max_line (int): The most characters in a line, ``None`` parses lines of any length
+        max_users (int): The most users to parse, ``None`` parses all of them
+        time_limit (float): The most seconds to spend parsing, ``None`` takes as long as it needs
+
+    Returns:
+        :obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`)\
+        : A list of namedtuples, each namedtuple has 4 elements: ``(latitude, longitude, name, comment)``
+    """
+    if isinstance(users, str):
+        users = users.splitlines()
+    parsed = []
+    log_report = report is None
+    if log_report:
+        report = ParseReport()
+
+    if time_limit is not None:
+        from time import monotonic
+        deadline = monotonic() + time_limit
+
+    log.info('Parsing ArchWiki list')
+    for line_number, line in enumerate(users, start=1):
+        if max_users is not None and len(parsed) >= max_users:
+            report.truncated.append('stopped at line {} after {} users'.format(line_number, max_users))
+            break
+        if time_limit is not None and line_number % 1000 == 0 and monotonic() > deadline:
+            report.truncated.append('stopped at line {} after {} seconds'.format(line_number, time_limit))
+            break
+
+        if not line.strip():
+            continue
+        report.lines += 1
+
+        if max_line is not None and len(line) > max_line:
+            report.add(line_number, line[:100] + '...', 'too long')
+            continue
+
+        # Retun None unless the line is valid
+        fields = parse_line(line)
+
+        if fields:
+            latitude, longitude, name, comment = fields
+            if re_not_plain.search(line) is not None:
+                name, comment = clean_text(name), clean_text(comment)
+            try:
+                parsed.append(Entry(latitude=Decimal(latitude), longitude=Decimal(longitude), name=name, comment=comment))
+                continue
+            except InvalidOperation:
+                # e.g. '1..5', which the regular expressions allow.
+                pass
+
+        report.add(line_number, line, _bad_line_reason(line))
+
+    if report.truncated and not log_report:
+        log.warning('The list was cut off: ' + report.truncated[-1])
+    if log_report and (report.reasons or report.truncated):
+        log.error(report.summary())
+
+    return parsed
+
+
+def _bad_line_reason(line):
+    """Work out why ``line`` couldn't be parsed, this is only done for the bad lines."""
+    coords, quote, rest = line.partition('"')
+    if not quote or '"' not in rest:
+        return 'missing quotes'
+    if not coords.strip():
+        return 'missing coordinates'
+    return 'bad coordinates'
+
+
+def read_users(local, encoding='utf-8', max_line=None):
+    """This function reads the lines of a raw-text list of users from the file at ``local``.
+
+    The file is memory-mapped and each line is decoded as it is reached, so even a huge list is never
+    copied into memory as a whole. The lines can be passed straight to :func:`parse_users`.
+
+    A line that is certainly longer than ``max_line`` characters is only read up to just past the limit,
+    so :func:`parse_users` (given the same ``max_line``) skips it as ``'too long'`` without the whole line
+    ever being copied into memory.
+
+    Args:
+        local (str): Path to a raw-text list, in the same format as the list on the ArchWiki
+        encoding (str): The encoding of the file
+        max_line (int): The most characters in a line, ``None`` reads lines of any length
+
+    Yields:
+        str: Each line of the list, without the line ending
+    """
+    log.info('Getting users from a raw-text file: {}'.format(local))
+    with open(local, 'rb') as raw:
+        try:
+            raw_map = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return
+
+        # No character takes more than 4 bytes, so a line with more bytes than this is too long in any encoding
+        max_bytes = None if max_line is None else (max_line + 1) * 4
+
+        with raw_map:
+            start = 0
+            end = raw_map.size()
+            while start < end:
+                line_end = raw_map.find(b'\n', start)
+                if line_end == -1:
+                    line_end = end
+
+                if max_bytes is not None and line_end - start > max_bytes:
+                    # Even if the prefix is cut in the middle of a character it still has over 'max_line' of them
+                    yield raw_map[start:start + max_bytes].decode(encoding, errors='replace')
+                    start = line_end + 1
+                    continue
+
+                line = raw_map[start:line_end]
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                yield line.decode(encoding)
+                start = line_end + 1
+
+
+def read_output(local):
+    """This function reads the users back from an output made by archmap, so the other outputs can be made again
+    without the wiki. The format is worked out from the file extension
+    (``.csv``, ``.geojson`` or ``.json``, and ``.kml``).
+
+    Args:
+        local (str): Path to the output file
+
+    Returns:
+        :obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`)\
+        : A list of namedtuples, each namedtuple has 4 elements: ``(latitude, longitude, name, comment)``
+
+    Raises:
+        ValueError: If the format isn't known or the file isn't a valid output
+    """
+    extension = local.rpartition('.')[2].lower()
+    if extension == 'csv':
+        return read_csv(local)
+    if extension in ('geojson', 'json'):
+        return read_geojson(local)
+    if extension == 'kml':
+        return read_kml(local)
+    raise ValueError("Can't tell what format {} is".format(local))
+
+
+def read_csv(local, encoding='utf-8'):
+    """This function reads the users from a CSV output made by :func:`make_csv`, the rows are read one at a time.
+
+    The columns are found from the header, so any order works as long as there are latitude and longitude columns.
+    A missing name or comment column is read as empty names or comments.
+
+    Args:
+        local (str): Path to the CSV file
+        encoding (str): The text encoding of the file
+
+    Returns:
+        :obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`)\
+        : A list of namedtuples, each namedtuple has 4 elements: ``(latitude, longitude, name, comment)``
+
+    Raises:
+        ValueError: If there isn't a latitude and longitude column or a coordinate isn't a number
+    """
+    log.info('Getting users from a CSV file: {}'.format(local))
+    with open(local, 'r', encoding=encoding, newline='') as csv_file:
+        rows = csv.reader(csv_file)
+        header = [column.strip().lower() for column in next(rows, [])]
+        if 'latitude' not in header or 'longitude' not in header:
+            raise ValueError('{} has no latitude and longitude columns'.format(local))
+
+        columns = [header.index(field) if field in header else None for field in Entry._fields]
+        users = []
+        for row in rows:
+            if not row:
+                continue
+            fields = [row[column] if column is not None and column < len(row) else '' for column in columns]
+            users.append(Entry(_read_coord(fields[0]), _read_coord(fields[1]), fields[2], fields[3]))
+
+    return users
+
+
+def read_geojson(local):
+    """This function reads the users from a GeoJSON output made by :func:`make_geojson`.
+
+    The coordinates are read straight into :obj:`decimal.Decimal`, so they are exactly the same as in the file,
+    except that the '.0' the GeoJSON output adds to whole numbers is taken off again.
+
+    Args:
+        local (str): Path to the GeoJSON file
+
+    Returns:
+        :obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`)\
+        : A list of namedtuples, each namedtuple has 4 elements: ``(latitude, longitude, name, comment)``
+
+    Raises:
+        ValueError: If the file isn't a GeoJSON FeatureCollection of points
+    """
+    log.info('Getting users from a GeoJSON file: {}'.format(local))
+    with open(local, 'r') as geojson_file:
+        collection = json.load(geojson_file, parse_float=_read_json_coord, parse_int=Decimal)
+
+    users = []
+    try:
+        for feature in collection['features']:
+            longitude, latitude = feature['geometry']['coordinates'][:2]
+            properties = feature.get('properties') or {}
+            users.append(Entry(latitude, longitude, properties.get('Name', ''), properties.get('Comment', '')))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('{} is not a GeoJSON FeatureCollection of points'.format(local))
+
+    return users
+
+
+def read_kml(local):
+    """This function reads the users from a KML output made by :func:`make_kml`.
+
+    The file is read a piece at a time. Placemarks laid out the way :func:`make_kml` writes them are picked
+    out with ``re_placemark``, which is several times faster than an XML parser. If a file has any other
+    placemarks in it (e.g. it has been edited), the whole file is parsed incrementally with
+    :func:`xml.etree.ElementTree.iterparse` instead.
+
+    Args:
+        local (str): Path to the KML file
+
+    Returns:
+        :obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`)\
+        : A list of namedtuples, each namedtuple has 4 elements: ``(latitude, longitude, name, comment)``
+
+    Raises:
+        ValueError: If the file isn't valid XML or a placemark doesn't have any coordinates
+    """
+    log.info('Getting users from a KML file: {}'.format(local))
+    users = []
+    pending = ''
+
+    with open(local, 'r', encoding='utf-8') as kml_file:
+        for piece in iter(partial(kml_file.read, 1024 * 1024), ''):
+            # Only whole placemarks are matched, the rest is kept until the next piece has been read.
+            pending += piece
+            end = pending.rfind('</Placemark>')
+            if end == -1:
+                continue
+            end += len('</Placemark>')
+            block, pending = pending[:end], pending[end:]
+
+            placemarks = re_placemark.findall(block)
+            if len(placemarks) != block.count('<Placemark'):
+                return _read_kml_tree(local)
+            for name, comment, longitude, latitude in placemarks:
+                users.append(Entry(_read_coord(latitude), _read_coord(longitude),
+                                   unescape(name) if '&' in name else name,
+                                   unescape(comment) if '&' in comment else comment))
+
+    # A file that has been cut off is left for the XML parser to complain about.
+    if '<Placemark' in pending or '</kml>' not in pending:
+        return _read_kml_tree(local)
+    return users
+
+
+def _read_kml_tree(local):
+    """Read the users from any KML file for :func:`read_kml`, one placemark at a time."""
+    from xml.etree.ElementTree import iterparse
+    from xml.etree.ElementTree import ParseError
+
+    kml = '{http://www.opengis.net/kml/2.2}'
+    users = []
+
+    log.debug('Parsing {} as XML'.format(local))
+    try:
+        for _, element in iterparse(local):
+            if element.tag != kml + 'Placemark':
+                continue
+
+            coordinates = element.findtext(kml + 'Point/' + kml + 'coordinates')
+            if coordinates is None:
+                raise ValueError('A placemark in {} has no coordinates'.format(local))
+            longitude, latitude = coordinates.strip().split(',')[:2]
+            users.append(Entry(_read_coord(latitude), _read_coord(longitude),
+                               element.findtext(kml + 'name') or '', element.findtext(kml + 'description') or ''))
+            element.clear()
+    except ParseError as error:
+        raise ValueError('{} is not valid KML: {}'.format(local, error))
+
+    return users
+
+
+def _read_json_coord(coord):
+    """Turn a number from a GeoJSON output into a :obj:`decimal.Decimal`, e.g. '10.0' (from '10') into '10'."""
+    return Decimal(coord[:-2] if coord.endswith('.0') else coord)
+
+
+def _read_coord(coord):
+    """Turn a coordinate from an output into a :obj:`decimal.Decimal`, raising ValueError if it isn't a number."""
+    try:
+        return Decimal(coord.strip())
+    except InvalidOperation:
+        raise ValueError('{!r} is not a coordinate'.format(coord))
+
+
+# Expression that matches one-half of a coordinate pair, e.g. '-33.9289049'.
+# The same as '-?\d+\.*\d*', but a long run of digits can only be split one way so it doesn't backtrack
+re_coord = r'(-?\d+(?:\.+\d*)?)'
+
+# Compiled expression that matches a whole line, the name is inside the quote marks and the comment is anything
+# after them (optionally after a '#'). Results in 4 groups: Latitude, longitude, name and comment.
+# The longitude is matched in a lookahead and then taken whole ('\2'), so the regular expression engine can't try
+# giving its digits and dots to '[^a-zA-Z]*' one at a time. It is always the longest match, just like before.
+re_line = re.compile(re_coord + r'\s*,\s*(?=' + re_coord + r')\2[^a-zA-Z]*"(.*)"\s*#*\s*(.*)')
+
+# Compiled expression that matches the control characters (C0, DEL and C1) that are removed from names and comments
+re_control = re.compile('[\x00-\x1f\x7f-\x9f]')
+
+# Compiled expression that matches anything other than printable ASCII, text without it doesn't need cleaning.
+# It works on every Python 3 version, unlike 'str.isascii()' which is new in 3.7
+re_not_plain = re.compile('[^\x20-\x7e]')
+
+# Compiled expression that matches a placemark the way 'make_kml()' writes it.
+# Results in 4 groups: Name, description, longitude and latitude (the name and description are still escaped)
+re_placemark = re.compile(r'<Placemark\b[^>]*>\s*<name>([^<]*)</name>\s*'
+                          r'(?:<description>([^<]*)</description>|<description/>)?\s*'
+                          r'<Point\b[^>]*>\s*<coordinates>\s*([^,<]*),([^,<]*)')
+
+# Compiled expression that only matches the coordinates before the name on a well-formed line.
+# Results in 2 groups: Latitude and longitude
+re_coords = re.compile(re_coord + r'\s*,\s*' + re_coord + r'\s*')
+
+
+def parse_line(line):
+    """This function splits a single line of the raw-text list into its latitude, longitude, name and comment.
+
+    Well-formed lines (exactly two quote marks with only whitespace between the coordinates and the name)
+    are split around the quote marks, so only the short coordinate part is matched with a regular expression.
+    Anything else falls back to ``re_line``, whose ``.*`` groups can backtrack on long lines.
+    Both ways give exactly the same result for any line.
+
+    Args:
+        line (str): A line from the raw-text list, without the line ending
+
+    Returns:
+        tuple or None: ``(latitude, longitude, name, comment)`` as stripped strings, or None if the line is invalid
+    """
+    coords, quote, rest = line.partition('"')
+    if quote:
+        name, quote, comment = rest.rpartition('"')
+
+        if not quote:
+            # 're_line' needs two quote marks, so it can't match.
+            return None
+        if '"' not in name:
+            coords_result = re_coords.fullmatch(coords)
+            if coords_result:
+                return (coords_result.group(1), coords_result.group(2),
+                        name.strip(), comment.lstrip().lstrip('#').strip())
+    else:
+        return None
+
+    line_result = re_line.fullmatch(line)
+    if line_result is None:
+        return None
+
+    latitude, longitude, name, comment = line_result.groups()
+    return latitude, longitude, name.strip(), comment.strip()
+
+
+def clean_text(text):
+    """This function normalizes a name or comment to Unicode NFC and removes any control characters from it,
+    so the same text always looks (and is escaped) the same way in every output.
+
+    Plain ASCII without any control characters, which almost every name and comment is, is returned as it is.
+
+    Args:
+        text (str): A name or comment
+
+    Returns:
+        str: The cleaned text, any whitespace left at either end by the removed characters is stripped
+    """
+    if re_not_plain.search(text) is None:
+        return text
+    text = unicodedata.normalize('NFC', text)
+    if re_control.search(text) is None:
+        return text
+    return re_control.sub('', text).strip()
+
+
+def escape_xml(text):
+    """This function escapes a name or comment for the text of an XML element (e.g. in KML).
+
+    Text without any '&', '<' or '>' is returned as it is, without making a copy of it.
+
+    Args:
+        text (str): A name or comment
+
+    Returns:
+        str: ``text`` with '&', '<' and '>' escaped
+    """
+    if '&' not in text and '<' not in text and '>' not in text:
+        return text
+    return escape(text, quote=False)
+
+
+def validate_users(parsed_users, drop=True, nearby=Decimal('0.01')):
+    """This function checks the users that were parsed by :func:`parse_users` for
+    impossible coordinates and duplicates, it does this in a single pass over the list.
+
+    A user is a duplicate if an earlier user has the same name and exactly the same coordinates,
+    or the same name within ``nearby`` degrees of latitude and longitude of them. Users are found by
+    looking them up in hashed indexes (keyed on the name and coordinates, or the name and the grid
+    cell of size ``nearby`` that they are in), so this takes the same time for each user.
+
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        drop (bool): If set to True, the users that fail the checks are removed, otherwise they are only reported
+        nearby (:obj:`decimal.Decimal`): The most degrees apart two users with the same name can be
+            to count as duplicates, 0 will only find exact duplicates
+
+    Returns:
+        tuple: ``(users, report)``, the checked list of users and a ``ValidationReport``
+        containing lists of the ``invalid``, ``duplicates`` and ``nearby`` users
+    """
+    report = ValidationReport(invalid=[], duplicates=[], nearby=[])
+    users = []
+    exact_index = set()
+    nearby_index = {}
+
+    log.debug('Validating users')
+    for user in parsed_users:
+        if not (-90 <= user.latitude <= 90 and -180 <= user.longitude <= 180):
+            log.debug('Invalid coordinates: {}'.format(user))
+            report.invalid.append(user)
+            if drop:
+                continue
+
+        exact_key = (user.name, user.latitude, user.longitude)
+        if exact_key in exact_index:
+            report.duplicates.append(user)
+            if drop:
+                continue
+
+        elif nearby:
+            # Any user within 'nearby' degrees has to be in the same cell or one of the 8 cells around it.
+            row = math.floor(user.latitude / nearby)
+            column = math.floor(user.longitude / nearby)
+            neighbours = [other for row_offset in (-1, 0, 1) for column_offset in (-1, 0, 1)
+                          for other in nearby_index.get((user.name, row + row_offset, column + column_offset), ())]
+
+            if any(abs(other.latitude - user.latitude) <= nearby and abs(other.longitude - user.longitude) <= nearby
+                   for other in neighbours):
+                report.nearby.append(user)
+                if drop:
+                    continue
+            nearby_index.setdefault((user.name, row, column), []).append(user)
+
+        exact_index.add(exact_key)
+        users.append(user)
+
+    log.info('Validated {} users: {} invalid, {} duplicates, {} nearby duplicates{}'
+             .format(len(users), len(report.invalid), len(report.duplicates), len(report.nearby),
+                     ' (dropped)' if drop else ''))
+    return users, report
+
+
+def round_users(parsed_users, precision):
+    """This function rounds the coordinates of the users to ``precision`` decimal places.
+
+    Coordinates that already have fewer decimal places are left alone
+    and trailing zeros are removed after rounding, e.g. ``51.50001`` becomes ``51.5`` with a precision of 4.
+
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        precision (int): The most decimal places to keep
+
+    Returns:
+        :obj:`list` of :obj:`collections.namedtuple`: The users with rounded coordinates
+
+    Raises:
+        ValueError: If ``precision`` is negative
+    """
+    if precision < 0:
+        raise ValueError("The precision can't be negative, not {}".format(precision))
+
+    step = Decimal(1).scaleb(-precision)
+
+    def round_coord(coord):
+        if coord.as_tuple().exponent >= -precision:
+            return coord
+        coord = coord.quantize(step)
+        if '.' in str(coord):
+            coord = Decimal(str(coord).rstrip('0').rstrip('.'))
+        return coord
+
+    log.debug('Rounding coordinates to {} decimal places'.format(precision))
+    return [user._replace(latitude=round_coord(user.latitude), longitude=round_coord(user.longitude))
+            for user in parsed_users]
+
+
+# The characters used by geohashes, each one encodes 5 bits.
+geohash_alphabet = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(latitude, longitude, length=12):
+    """This function encodes a pair of coordinates as a geohash.
+
+    Geohashes that share a prefix are close to each other, so sorting by them keeps nearby users together.
+
+    Args:
+        latitude (:obj:`decimal.Decimal`): The latitude, between -90 and 90
+        longitude (:obj:`decimal.Decimal`): The longitude, between -180 and 180
+        length (int): The number of characters in the geohash (up to 12), 12 is precise to a few centimetres
+
+    Returns:
+        str: The geohash
+    """
+    # The bits of a geohash alternate between the longitude and the latitude, starting with the longitude,
+    # so the longitude gets the extra bit when there is an odd number of them.
+    bit_count = length * 5
+    longitude_bits = (bit_count + 1) // 2
+    latitude_bits = bit_count // 2
+    longitude_cell = min(int((float(longitude) + 180) / 360 * (1 << longitude_bits)), (1 << longitude_bits) - 1)
+    latitude_cell = min(int((float(latitude) + 90) / 180 * (1 << latitude_bits)), (1 << latitude_bits) - 1)
+
+    if bit_count % 2:
+        bits = _spread_bits(longitude_cell) | _spread_bits(latitude_cell) << 1
+    else:
+        bits = _spread_bits(longitude_cell) << 1 | _spread_bits(latitude_cell)
+
+    return ''.join(geohash_alphabet[(bits >> shift) & 31] for shift in range(bit_count - 5, -1, -5))
+
+
+def _spread_bits(number):
+    # Move each of the (up to 32) bits of 'number' to twice its position, leaving a gap between each of them.
+    number = (number | number << 16) & 0x0000FFFF0000FFFF
+    number = (number | number << 8) & 0x00FF00FF00FF00FF
+    number = (number | number << 4) & 0x0F0F0F0F0F0F0F0F
+    number = (number | number << 2) & 0x3333333333333333
+    return (number | number << 1) & 0x5555555555555555
+
+
+def sort_users(parsed_users, key='geohash', run_size=100000):
+    """This function sorts the users by where they are (``key='geohash'``) or by their name (``key='name'``).
+
+    Ties are broken by the rest of each user's details, so the same users always come out
+    in the same order no matter what order they were in before. This is an external merge sort,
+    when there are more than ``run_size`` users they are sorted in runs of ``run_size`` that are
+    saved to temporary files and merged, so only one run has to fit in memory at a time.
+
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list (or any other iterable) of namedtuples, each namedtuple should have 4 elements:
+            ``(latitude, longitude, name, comment)``
+        key (str): What to sort the users by, either ``'geohash'`` or ``'name'``
+        run_size (int): The most users to sort in memory at once
+
+    Returns:
+        :obj:`generator` of :obj:`collections.namedtuple`: The sorted users
+
+    Raises:
+        ValueError: If ``key`` isn't ``'geohash'`` or ``'name'``
+    """
+    if key == 'geohash':
+        def sort_key(user):
+            return (geohash(user.latitude, user.longitude), user.latitude, user.longitude, user.name, user.comment)
+    elif key == 'name':
+        def sort_key(user):
+            return (user.name.casefold(), user.name, user.latitude, user.longitude, user.comment)
+    else:
+        raise ValueError("Can't sort the users by '{}', use 'geohash' or 'name'".format(key))
+
+    log.debug('Sorting users by {}'.format(key))
+    return _sort_runs(((sort_key(user), user) for user in parsed_users), run_size)
+
+
+def _sort_runs(keyed_users, run_size):
+    import heapq
+    import pickle
+    import tempfile
+
+    run = sorted(islice(keyed_users, run_size))
+    next_user = list(islice(keyed_users, 1))
+
+    # Everything fitted in a single run, so there is nothing to merge.
+    if not next_user:
+        for _, user in run:
+            yield user
+        return
+
+    runs = []
+    try:
+        while run:
+            run_file = tempfile.TemporaryFile()
+            runs.append(run_file)
+            # The users are saved in small batches, it's much faster than saving them one at a time.
+            for start in range(0, len(run), 1000):
+                pickle.dump(run[start:start + 1000], run_file, protocol=pickle.HIGHEST_PROTOCOL)
+            run_file.seek(0)
+            log.debug('Saved a run of {} users to a temporary file'.format(len(run)))
+
+            run = sorted(next_user + list(islice(keyed_users, run_size - len(next_user))))
+            next_user = []
+
+        for _, user in heapq.merge(*(_read_run(run_file) for run_file in runs)):
+            yield user
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+
+def _read_run(run_file):
+    import pickle
+
+    while True:
+        try:
+            yield from pickle.load(run_file)
+        except EOFError:
+            return
+
+
+def make_ids(parsed_users, id_file=''):
+    """This function gives each user an ID that stays the same between runs,
+    as long as their line in the list doesn't change.
+
+    Each ID is made from a hash of the user's line in the raw-text list (which includes their name).
+    If more than one user has the same hash (e.g. a duplicated line), a number is added to the end of it.
+    The IDs are saved to ``id_file`` along with the lines they were made from, so that the next run gives
+    the same IDs to the same users and an ID that was in use isn't given to a different user.
+
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        id_file (str): Location of the ID index file. If left empty, the IDs are only based on this run
+
+    Returns:
+        :obj:`list` of :obj:`str`: The ID of each user, in the same order as ``parsed_users``
+    """
+    from hashlib import blake2b
+
+    old_index = {}
+    if id_file:
+        try:
+            with open(id_file, 'r') as index_file:
+                old_index = json.load(index_file)
+        except (OSError, ValueError):
+            log.debug('There is no ID index in {}'.format(id_file))
+
+    # The IDs that each line had last time, they're handed back out in the same order.
+    old_ids = {}
+    for user_id, line in sorted(old_index.items()):
+        old_ids.setdefault(line, []).append(user_id)
+
+    ids = []
+    index = {}
+    log.debug('Making IDs')
+    for user in parsed_users:
+        line = '{},{} "{}" # {}'.format(user.latitude, user.longitude, user.name, user.comment).rstrip()
+        if old_ids.get(line):
+            user_id = old_ids[line].pop(0)
+        else:
+            hash_id = blake2b(line.encode('utf-8'), digest_size=6).hexdigest()
+            user_id = hash_id
+            suffix = 1
+            while user_id in index or user_id in old_index:
+                user_id = '{}-{}'.format(hash_id, suffix)
+                suffix += 1
+
+        index[user_id] = line
+        ids.append(user_id)
+
+    if id_file:
+        added = len(index.keys() - old_index.keys())
+        removed = len(old_index.keys() - index.keys())
+        log.info('Writing {} IDs to {} ({} added, {} removed)'.format(len(ids), id_file, added, removed))
+        with open(id_file, 'w') as index_file:
+            json.dump(index, index_file, ensure_ascii=False, indent=0, sort_keys=True)
+            index_file.write('\n')
+
+    return ids
+
+
+class CountryLookup:
+    """Finds the country that a pair of coordinates is in, using the boundaries in a GeoJSON file.
+
+    The boundaries are put into a grid of ``cell_size`` degree cells when the file is loaded. Cells that are
+    completely inside a boundary give the country straight away, otherwise only the few boundaries
+    that go through the cell that the point is in have to be checked.
+    The coordinates are rounded to ``cache_precision`` decimal places before they are looked up
+    and the results are cached, so users in the same place are only looked up once.
+
+    No boundaries are included with archmap, any GeoJSON file of ``Polygon`` or ``MultiPolygon``
+    features with a country code in their properties can be used.
+
+    Args:
+        boundary_file (str): Location of the GeoJSON file of country boundaries
+        code_property (str): The property of each feature that holds the country code
+        cell_size (float): The size of the grid cells in degrees
+        cache_precision (int): The number of decimal places to round the coordinates to for the cache
+
+    Raises:
+        OSError: If the file can't be read
+        ValueError: If the file isn't a GeoJSON file
+    """
+
+    def __init__(self, boundary_file, code_property='ISO_A2', cell_size=1.0, cache_precision=2):
+        self.cell_size = cell_size
+        self.cache_precision = cache_precision
+        self.cache = {}
+        self._grid = {}
+        self._interior = {}
+
+        log.debug('Loading country boundaries from {}'.format(boundary_file))
+        with open(boundary_file, 'r', encoding='utf-8') as boundaries:
+            features = json.load(boundaries)['features']
+
+        for feature in features:
+            geometry = feature.get('geometry') or {}
+            code = (feature.get('properties') or {}).get(code_property)
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+
+            for polygon in polygons:
+                self._add_polygon(code, [[(float(lon), float(lat)) for lon, lat, *_ in ring] for ring in polygon])
+
+        log.info('Loaded {} country boundaries into {} grid cells'
+                 .format(len(features), len(self._grid) + len(self._interior)))
+
+    def _add_polygon(self, code, rings):
+        size = self.cell_size
+        longitudes = [lon for lon, _ in rings[0]]
+        latitudes = [lat for _, lat in rings[0]]
+        bounds = (min(longitudes), min(latitudes), max(longitudes), max(latitudes))
+
+        # Find the cells that the edges of the polygon go through, and where the edges cross
+        # the line through the middle of each row of cells.
+        edge_cells = set()
+        crossings = {}
+        for ring in rings:
+            x1, y1 = ring[-1]
+            for x2, y2 in ring:
+                for row in range(math.floor(min(y1, y2) / size), math.floor(max(y1, y2) / size) + 1):
+                    for column in range(math.floor(min(x1, x2) / size), math.floor(max(x1, x2) / size) + 1):
+                        edge_cells.add((row, column))
+                for row in range(math.ceil(min(y1, y2) / size - 0.5), math.ceil(max(y1, y2) / size - 0.5)):
+                    middle = (row + 0.5) * size
+                    crossings.setdefault(row, []).append(x1 + (middle - y1) * (x2 - x1) / (y2 - y1))
+                x1, y1 = x2, y2
+
+        for cell in edge_cells:
+            self._grid.setdefault(cell, []).append((code, bounds, rings))
+
+        # A cell that none of the edges go through is either completely inside the polygon or completely
+        # outside it, so it's inside if its middle is between a pair of crossings on its row.
+        for row, row_crossings in crossings.items():
+            row_crossings.sort()
+            for start, end in zip(row_crossings[::2], row_crossings[1::2]):
+                for column in range(math.ceil(start / size - 0.5), math.ceil(end / size - 0.5)):
+                    if (row, column) not in edge_cells:
+                        self._interior[row, column] = code
+
+    def country(self, latitude, longitude):
+        """Look up the code of the country that ``(latitude, longitude)`` is in.
+
+        Args:
+            latitude (:obj:`decimal.Decimal`): The latitude
+            longitude (:obj:`decimal.Decimal`): The longitude
+
+        Returns:
+            str: The country code, or None if the point isn't in any of the boundaries
+        """
+        latitude = round(float(latitude), self.cache_precision)
+        longitude = round(float(longitude), self.cache_precision)
+        try:
+            return self.cache[latitude, longitude]
+        except KeyError:
+            pass
+
+        cell = (math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size))
+        code = self._interior.get(cell)
+        for candidate, bounds, rings in self._grid.get(cell, ()) if code is None else ():
+            if bounds[0] <= longitude <= bounds[2] and bounds[1] <= latitude <= bounds[3] and \
+               _in_rings(longitude, latitude, rings):
+                code = candidate
+                break
+
+        self.cache[latitude, longitude] = code
+        return code
+
+
+def _in_rings(x, y, rings):
+    # Count how many edges a ray going east from the point crosses, the holes are rings too,
+    # so the point is inside the polygon (and not in a hole) if the count is odd.
+    inside = False
+    for ring in rings:
+        x1, y1 = ring[-1]
+        for x2, y2 in ring:
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+            x1, y1 = x2, y2
+    return inside
+
+
+def locate_users(parsed_users, lookup):
+    """This function finds the country that each user is in.
+
     Args:
-        users (str): raw-text list from the ArchWiki
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        lookup (:obj:`CountryLookup`): The country boundaries to look the users up in
 
     Returns:
-        :obj:`list` of :obj:`collections.namedtuple` \
-        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`)\
-        : A list of namedtuples, each namedtuple has 4 elements: ``(latitude, longitude, name, comment)``
+        :obj:`list` of :obj:`str`: The country code of each user (None if they aren't in a country),
+        in the same order as ``parsed_users``
     """
-    users = users.splitlines()
-    parsed = []
+    log.debug('Looking up the country of each user')
+    countries = [lookup.country(user.latitude, user.longitude) for user in parsed_users]
+    log.info('Found the countries of {} of {} users'.format(len(countries) - countries.count(None), len(countries)))
+    return countries
 
-    # Expression that matches one-half of a coordinate pair. Results in 3 groups: Full, before decimal and after decimal
-    re_coord = r'((\-?\d+)\.*(\d+)?)'
 
-    # Expression that matches the name inside the quote marks and puts that into a group
-    re_name = r'"(.*)"'
+def count_cells(parsed_users, cell_size=Decimal('1')):
+    """This function counts the users in each cell of a grid of ``cell_size`` degree squares.
 
-    # Expression that puts the comment in a group
-    re_comment = r'(.*)'
+    The cells are numbered from the equator and the prime meridian, so the cell ``(row, column)``
+    goes from ``row * cell_size`` to ``(row + 1) * cell_size`` degrees of latitude and the same for the columns
+    and longitude. Users on the north pole or the antimeridian are counted in the cells below or left of them,
+    and users with impossible coordinates (outside of ±90 and ±180 degrees) aren't counted at all.
 
-    # Compiled expression that combines all of the groups with the stuff inbetween. Results in 8 groups:
-    #     1. Full latitude
-    #     2. Latitude before decimal
-    #     3. Latitude after decimal
-    #     4. Full longitude
-    #     5. Longitude before decimal
-    #     6. Longitude after decimal
-    #     7. Name
-    #     8. Comment
-    re_whole = re.compile(str(re_coord + r'\s*,\s*' + re_coord + r'[^a-zA-Z]*' + re_name + r'\s*#*\s*' + re_comment))
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        cell_size (:obj:`decimal.Decimal`): The size of the cells in degrees
 
-    log.info('Parsing ArchWiki list')
-    for line_number, line in enumerate(users, start=1):
-        # Retun None unless the line fully matches the RE
-        re_whole_result = re_whole.fullmatch(line)
+    Returns:
+        :obj:`collections.Counter`: The number of users in each ``(row, column)`` cell that has any users in it
 
-        if re_whole_result:
-            latitude = Decimal(re_whole_result.group(1))
-            longitude = Decimal(re_whole_result.group(4))
-            name = re_whole_result.group(7).strip()
-            comment = re_whole_result.group(8).strip()
+    Raises:
+        ValueError: If ``cell_size`` isn't more than 0
+    """
+    if not cell_size > 0:
+        raise ValueError('The cell size has to be more than 0, not {}'.format(cell_size))
 
-            parsed.append(Entry(latitude=latitude, longitude=longitude, name=name, comment=comment))
+    top_row = math.ceil(90 / cell_size) - 1
+    right_column = math.ceil(180 / cell_size) - 1
 
-        else:
-            log.error('Bad line ({}): {}'.format(line_number, line))
+    log.debug('Counting users in {} degree cells'.format(cell_size))
+    cells = Counter((min(math.floor(user.latitude / cell_size), top_row),
+                     min(math.floor(user.longitude / cell_size), right_column)) for user in parsed_users
+                    if -90 <= user.latitude <= 90 and -180 <= user.longitude <= 180)
 
-    return parsed
+    skipped = len(parsed_users) - sum(cells.values())
+    if skipped:
+        log.warning("{} users with impossible coordinates weren't counted in the density cells".format(skipped))
+    return cells
 
 
 def make_text(parsed_users, output_file='', pretty=False):
@@ -215,7 +1687,7 @@ def make_text(parsed_users, output_file='', pretty=False):
     return text_str
 
 
-def make_geojson(parsed_users, output_file=''):
+def make_geojson(parsed_users, output_file='', compact=False, ids=None):
     """This function reads the user data supplied by ``parsed_users``, it then generates
     GeoJSON output and writes it to ``output_file``.
 
@@ -224,21 +1696,37 @@ def make_geojson(parsed_users, output_file=''):
         (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
         : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
         output_file (str): Location to save the GeoJSON output. If left empty, nothing will be output
+        compact (bool): If set to True, the indentation and whitespace and any empty comments are left out
+        ids (:obj:`list` of :obj:`str`): The ID of each feature, e.g. from :func:`make_ids`.
+            If left empty, the features are numbered in the order of ``parsed_users``
 
     Returns:
         str: The text written to the output file
     """
+    from geojson import dumps
+    from geojson import Feature
+    from geojson import FeatureCollection
+    from geojson import Point
+
     geojson = []
 
     log.debug('Making GeoJSON')
-    for id, user in enumerate(parsed_users):
+    for id, user in zip(ids, parsed_users) if ids is not None else enumerate(parsed_users):
         # Generate a GeoJSON point feature for the user and add it to 'geojson'.
-        point = Point((float(user.longitude), float(user.latitude)))
-        feature = Feature(geometry=point, properties={'Name': user.name, 'Comment': user.comment}, id=id)
+        # The precision stops the coordinates from being rounded any more than they already are.
+        precision = max(0, -user.longitude.as_tuple().exponent, -user.latitude.as_tuple().exponent)
+        point = Point((float(user.longitude), float(user.latitude)), precision=precision)
+        properties = {'Name': user.name, 'Comment': user.comment}
+        if compact and not user.comment:
+            del properties['Comment']
+        feature = Feature(geometry=point, properties=properties, id=id)
         geojson.append(feature)
 
     # Make 'geojson_str' for output.
-    geojson_str = (dumps(FeatureCollection(geojson), sort_keys=True, indent=4)) + '\n'
+    if compact:
+        geojson_str = dumps(FeatureCollection(geojson), sort_keys=True, ensure_ascii=True, separators=(',', ':')) + '\n'
+    else:
+        geojson_str = (dumps(FeatureCollection(geojson), sort_keys=True, ensure_ascii=True, indent=4)) + '\n'
 
     if output_file == '-':
         print(geojson_str)
@@ -251,31 +1739,58 @@ def make_geojson(parsed_users, output_file=''):
     return geojson_str
 
 
-def make_kml(parsed_users, output_file=''):
+def make_kml(parsed_users, output_file='', compact=False, ids=None):
     """This function reads the user data supplied by ``parsed_users``, it then generates
     KML output and writes it to ``output_file``.
 
+    The IDs of the elements are numbered separately for each call, so this can be run from more than one thread at once.
+
     Args:
         parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
         (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
         : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
         output_file (str): Location to save the KML output. If left empty, nothing will be output
+        compact (bool): If set to True, the indentation and any empty descriptions are left out
+        ids (:obj:`list` of :obj:`str`): The ID of each placemark, e.g. from :func:`make_ids`.
+            If left empty, the placemarks are numbered in the order of ``parsed_users``
 
     Returns:
         str: The text written to the output file
     """
-    kml = Kml()
-
-    log.debug('Making KML')
-    for user in parsed_users:
-        # Generate a KML point for the user.
-        kml.newpoint(coords=[(user.longitude, user.latitude)], name=user.name, description=user.comment)
+    if compact:
+        indent = newline = ''
+    else:
+        indent = '    '
+        newline = '\n'
 
-    # Reset the ID counters
-    featgeom.Feature._id = 0
-    featgeom.Geometry._id = 0
+    # These are the same IDs that simplekml used to give to the elements, kept so that the output doesn't change.
+    kml = ['<?xml version="1.0" encoding="UTF-8"?>', newline,
+           '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">', newline,
+           indent, '<Document id="feat_1">', newline]
 
-    kml_str = kml.kml()
+    log.debug('Making KML')
+    for number, user in enumerate(parsed_users):
+        # Generate a KML placemark for the user.
+        if ids is None:
+            feature_id = 'feat_{}'.format(number + 2)
+            geometry_id = 'geom_{}'.format(number)
+        else:
+            feature_id = 'feat_{}'.format(ids[number])
+            geometry_id = 'geom_{}'.format(ids[number])
+
+        kml += [indent * 2, '<Placemark id="', feature_id, '">', newline,
+                indent * 3, '<name>', escape_xml(user.name), '</name>', newline]
+        if user.comment:
+            kml += [indent * 3, '<description>', escape_xml(user.comment), '</description>', newline]
+        elif not compact:
+            kml += [indent * 3, '<description/>', newline]
+        kml += [indent * 3, '<Point id="', geometry_id, '">', newline,
+                indent * 4, '<coordinates>{},{},0.0</coordinates>'.format(user.longitude, user.latitude), newline,
+                indent * 3, '</Point>', newline,
+                indent * 2, '</Placemark>', newline]
+
+    kml += [indent, '</Document>', newline, '</kml>\n']
+    kml_str = ''.join(kml)
 
     if output_file == '-':
         print(kml_str)
@@ -288,26 +1803,52 @@ def make_kml(parsed_users, output_file=''):
     return kml_str
 
 
-def make_csv(parsed_users, output_file=''):
+def make_csv(parsed_users, output_file='', columns=Entry._fields, precision=None, encoding='utf-8', buffering=-1,
+             batch_size=1000, stream=False):
     """This function reads the user data supplied by ``parsed_users``, it then generates
     CSV output and writes it to ``output_file``.
 
+    With ``stream``, the rows are written straight into ``output_file`` in batches of ``batch_size``
+    with ``writerows``, so the whole CSV is never held in memory (and isn't returned either).
+
     Args:
         parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
         (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
         : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
         output_file (str): Location to save the CSV output. If left empty, nothing will be output
+        columns (:obj:`tuple` of :obj:`str`): The fields of each user to output, in order
+            (any of ``'latitude'``, ``'longitude'``, ``'name'`` and ``'comment'``)
+        precision (int): If set, the coordinates are output as fixed-point numbers with this many decimal places
+        encoding (str): The text encoding of the output file
+        buffering (int): The size of the output file's write buffer in bytes, -1 uses the default size
+        batch_size (int): The number of rows to pass to ``writerows`` at a time
+        stream (bool): Stream the rows into ``output_file`` instead of making the text first
 
     Returns:
-        str: The text written to the output file
+        str: The text written to the output file, or None if it was streamed to ``output_file``
     """
     log.debug('Making CSV')
-    csv_string = StringIO()
-    csv_string_writer = csv.writer(csv_string, quoting=csv.QUOTE_MINIMAL, dialect='unix')
-    csv_string_writer.writerow(('Latitude', 'Longitude', 'Name', 'Comment'))
-    for user in parsed_users:
-        csv_string_writer.writerow((user.latitude, user.longitude, user.name, user.comment))
+    columns = [Entry._fields.index(column) for column in columns]
+    header = [('Latitude', 'Longitude', 'Name', 'Comment')[column] for column in columns]
+
+    if precision is None and columns == [0, 1, 2, 3]:
+        # The users are already tuples in the right order, so they can be written as they are.
+        rows = iter(parsed_users)
+    elif precision is None:
+        rows = (tuple(user[column] for column in columns) for user in parsed_users)
+    else:
+        coordinate_format = '.{}f'.format(precision)
+        rows = (tuple(format(user[column], coordinate_format) if column < 2 else user[column] for column in columns)
+                for user in parsed_users)
+
+    if stream and output_file not in ('', '-'):
+        log.info('Writing CSV to ' + output_file)
+        with open(output_file, 'w', buffering=buffering, encoding=encoding, newline='') as output:
+            _write_csv(output, header, rows, batch_size)
+        return None
 
+    csv_string = StringIO()
+    _write_csv(csv_string, header, rows, batch_size)
     csv_str = csv_string.getvalue()
     csv_string.close()
 
@@ -316,12 +1857,1140 @@ def make_csv(parsed_users, output_file=''):
 
     elif output_file != '':
         log.info('Writing CSV to ' + output_file)
-        with open(output_file, 'w') as output:
+        with open(output_file, 'w', buffering=buffering, encoding=encoding, newline='') as output:
             output.write(csv_str)
 
     return csv_str
 
 
+def make_country_counts(countries, output_file=''):
+    """This function counts the users in each country found by :func:`locate_users`, it then generates
+    a JSON object of the counts and writes it to ``output_file``.
+
+    The countries are sorted by their code, users that aren't in any country are counted under ``""``.
+
+    Args:
+        countries (:obj:`list` of :obj:`str`): The country code of each user
+        output_file (str): Location to save the JSON output. If left empty, nothing will be output
+
+    Returns:
+        str: The text written to the output file
+    """
+    log.debug('Counting users in each country')
+    counts = Counter(country or '' for country in countries)
+    counts_str = json.dumps(dict(sorted(counts.items())), indent=4) + '\n'
+
+    if output_file == '-':
+        print(counts_str)
+
+    elif output_file != '':
+        log.info('Writing country counts to ' + output_file)
+        with open(output_file, 'w') as output:
+            output.write(counts_str)
+
+    return counts_str
+
+
+def make_density(cells, output_file='', cell_size=Decimal('1')):
+    """This function reads the number of users in each cell counted by :func:`count_cells`, it then generates
+    compact GeoJSON output with a square polygon for each cell and writes it to ``output_file``.
+
+    The number of users in each cell is in its ``Users`` property.
+
+    Args:
+        cells (:obj:`collections.Counter`): The number of users in each ``(row, column)`` cell
+        output_file (str): Location to save the GeoJSON output. If left empty, nothing will be output
+        cell_size (:obj:`decimal.Decimal`): The size of the cells in degrees, the same as was given to :func:`count_cells`
+
+    Returns:
+        str: The text written to the output file
+    """
+    features = []
+
+    log.debug('Making density GeoJSON')
+    for (row, column), users in sorted(cells.items()):
+        south = float(row * cell_size)
+        north = float((row + 1) * cell_size)
+        west = float(column * cell_size)
+        east = float((column + 1) * cell_size)
+        features.append({'type': 'Feature',
+                         'geometry': {'type': 'Polygon',
+                                      'coordinates': [[[west, south], [east, south], [east, north],
+                                                       [west, north], [west, south]]]},
+                         'properties': {'Users': users}})
+
+    density_str = json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':')) + '\n'
+
+    if output_file == '-':
+        print(density_str)
+
+    elif output_file != '':
+        log.info('Writing density GeoJSON to ' + output_file)
+        with open(output_file, 'w') as output:
+            output.write(density_str)
+
+    return density_str
+
+
+def make_density_grid(cells, output_file='', cell_size=Decimal('1'), max_cells=density_grid_max_cells):
+    """This function reads the number of users in each cell counted by :func:`count_cells`, it then generates
+    an `ESRI ASCII grid <https://en.wikipedia.org/wiki/Esri_grid>`_ of the whole world and writes it to ``output_file``.
+
+    The grid starts from the north-west corner, with one line for each row of cells.
+
+    Args:
+        cells (:obj:`collections.Counter`): The number of users in each ``(row, column)`` cell
+        output_file (str): Location to save the grid. If left empty, nothing will be output
+        cell_size (:obj:`decimal.Decimal`): The size of the cells in degrees, the same as was given to :func:`count_cells`
+        max_cells (int): The most cells that the grid can have, None doesn't limit it
+
+    Returns:
+        str: The text written to the output file
+
+    Raises:
+        ValueError: If ``cell_size`` isn't more than 0 or the grid would have more than ``max_cells`` cells
+    """
+    if not cell_size > 0:
+        raise ValueError('The cell size has to be more than 0, not {}'.format(cell_size))
+
+    rows = math.ceil(90 / cell_size)
+    columns = math.ceil(180 / cell_size)
+    if max_cells is not None and rows * columns * 4 > max_cells:
+        raise ValueError('A grid of {} degree cells has {} cells, more than the most of {}'
+                         .format(cell_size, rows * columns * 4, max_cells))
+
+    log.debug('Making density grid')
+    grid = ['ncols {}\n'.format(columns * 2),
+            'nrows {}\n'.format(rows * 2),
+            'xllcorner {}\n'.format(-columns * cell_size),
+            'yllcorner {}\n'.format(-rows * cell_size),
+            'cellsize {}\n'.format(cell_size),
+            'NODATA_value -1\n']
+    for row in range(rows - 1, -rows - 1, -1):
+        grid.append(' '.join(str(cells.get((row, column), 0)) for column in range(-columns, columns)) + '\n')
+    grid_str = ''.join(grid)
+
+    if output_file == '-':
+        print(grid_str)
+
+    elif output_file != '':
+        log.info('Writing density grid to ' + output_file)
+        with open(output_file, 'w') as output:
+            output.write(grid_str)
+
+    return grid_str
+
+
+def _write_csv(output, header, rows, batch_size):
+    """Write the ``header`` and then the ``rows`` to ``output`` as CSV, ``batch_size`` rows at a time."""
+    csv_writer = csv.writer(output, quoting=csv.QUOTE_MINIMAL, dialect='unix')
+    csv_writer.writerow(header)
+
+    batch = list(islice(rows, batch_size))
+    while batch:
+        csv_writer.writerows(batch)
+        batch = list(islice(rows, batch_size))
+
+
+def log_to_journal():
+    """Send the log messages to the systemd journal as well, if systemd is available.
+
+    Returns:
+        bool: True if the messages are being sent to the journal
+    """
+    try:
+        from systemd import journal
+    except ImportError:
+        return False
+
+    if not any(isinstance(handler, journal.JournalHandler) for handler in log.handlers):
+        log.addHandler(journal.JournalHandler(SYSLOG_IDENTIFIER='archmap'))
+        log.handlers[-1].setFormatter(logging.Formatter('%(message)s.'))
+    return True
+
+
+def read_revision(revision_file, settings=None):
+    """Read the revision ID that was saved by :func:`write_revision`, returns None if there isn't one
+    or if ``settings`` is given and the revision was saved with different settings."""
+    try:
+        with open(revision_file, 'r') as revision:
+            lines = revision.read().splitlines()
+        if settings is not None and lines[1:2] != [settings]:
+            return None
+        return int(lines[0].strip())
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def write_revision(revision_file, revision, settings=None):
+    """Save the ``revision`` ID of the wiki page that the outputs were generated from,
+    and the ``settings`` (a single line of text) that they were generated with."""
+    log.debug('Writing revision {} to {}'.format(revision, revision_file))
+    with open(revision_file, 'w') as output:
+        output.write('{}\n'.format(revision))
+        if settings is not None:
+            output.write('{}\n'.format(settings))
+
+
+def make_sqlite(parsed_users, output_file=''):
+    """This function reads the user data supplied by ``parsed_users``, it then updates
+    the ``users`` table in the SQLite database at ``output_file`` to match it.
+
+    The table has ``id``, ``latitude``, ``longitude``, ``name`` and ``comment`` columns, with indexes on
+    ``latitude`` and ``longitude``. If SQLite has the R*Tree module, the ``users_rtree`` table is kept up to date
+    as well, so that users in an area can be found with e.g. ``SELECT users.* FROM users JOIN users_rtree
+    USING (id) WHERE min_latitude >= 50 AND max_latitude <= 52 AND min_longitude >= -1 AND max_longitude <= 1``.
+
+    Instead of rebuilding the table on every run, the existing rows are compared with ``parsed_users``,
+    the rows that are no longer needed are deleted and only the new users are inserted. This is all done
+    in one transaction, so anything reading the database sees either the old or the new list of users.
+
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        output_file (str): Location of the SQLite database. If left empty, an in-memory database is used
+
+    Returns:
+        tuple: ``(added, removed)``, the number of rows that were inserted and deleted
+    """
+    import sqlite3
+
+    if output_file == '-':
+        log.error("The SQLite database can't be printed to stdout")
+        return None
+
+    connection = sqlite3.connect(output_file or ':memory:', isolation_level=None)
+    try:
+        connection.execute('BEGIN')
+        connection.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, latitude REAL NOT NULL, '
+                           'longitude REAL NOT NULL, name TEXT NOT NULL, comment TEXT NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS users_latitude ON users (latitude)')
+        connection.execute('CREATE INDEX IF NOT EXISTS users_longitude ON users (longitude)')
+        try:
+            connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS users_rtree '
+                               'USING rtree(id, min_latitude, max_latitude, min_longitude, max_longitude)')
+            rtree = True
+        except sqlite3.OperationalError:
+            log.debug('SQLite does not have the R*Tree module')
+            rtree = False
+
+        # Find the existing row (if there is one) for each user, any rows that are left over have been removed.
+        existing = {}
+        for row in connection.execute('SELECT id, latitude, longitude, name, comment FROM users ORDER BY id'):
+            existing.setdefault(row[1:], []).append(row[0])
+        next_id = connection.execute('SELECT coalesce(max(id), 0) + 1 FROM users').fetchone()[0]
+
+        added = []
+        for user in parsed_users:
+            row = (float(user.latitude), float(user.longitude), user.name, user.comment)
+            if existing.get(row):
+                existing[row].pop(0)
+            else:
+                added.append((next_id,) + row)
+                next_id += 1
+        removed = [(row_id,) for row_ids in existing.values() for row_id in row_ids]
+
+        log.info('Writing SQLite to {} ({} added, {} removed)'.format(output_file or ':memory:', len(added), len(removed)))
+        connection.executemany('DELETE FROM users WHERE id = ?', removed)
+        connection.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?)', added)
+        if rtree:
+            connection.executemany('DELETE FROM users_rtree WHERE id = ?', removed)
+            connection.executemany('INSERT INTO users_rtree VALUES (?, ?, ?, ?, ?)',
+                                   [(row[0], row[1], row[1], row[2], row[2]) for row in added])
+        connection.execute('COMMIT')
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+
+    return len(added), len(removed)
+
+
+# The header at the start of the binary point feed made by 'make_points()'
+points_header = struct.Struct('<4sHHIHHII')
+
+# A single user in the binary point feed: latitude, longitude, name offset and comment offset
+points_record = struct.Struct('<iiII')
+
+
+def make_points(parsed_users, output_file='', index=True):
+    """This function reads the user data supplied by ``parsed_users``, it then generates
+    a compact binary point feed and writes it to ``output_file``.
+
+    The feed is made of fixed-size little-endian records so that it can be memory-mapped or read with
+    range requests without parsing the whole file. It is laid out like this (offsets are in bytes):
+
+    ========================  ========================================================================
+    Header (24 bytes)         ``b'AMPF'``, version (uint16, 1), flags (uint16, 1 if there is an index),
+                              number of records (uint32), index rows and columns (uint16 each, 0 if
+                              there is no index), string table offset and size (uint32 each)
+    Index (optional)          ``rows * columns + 1`` uint32 record numbers, the records in cell ``n``
+                              are ``index[n]`` up to (not including) ``index[n + 1]``
+    Records (16 bytes each)   latitude and longitude (int32, degrees * 10^7),
+                              name and comment offsets into the string table (uint32 each)
+    String table              UTF-8 strings, each one after its length in bytes (uint32),
+                              identical strings are only stored once
+    ========================  ========================================================================
+
+    The index divides the world into 10 degree cells, row 0 starts at -90 latitude and column 0 at -180 longitude.
+    With the index, the records are ordered by cell (keeping the original order within each cell).
+    Users with coordinates that don't fit in the range of latitude and longitude are left out.
+
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        output_file (str): Location to save the binary output. If left empty, nothing will be output
+        index (bool): If set to True, a spatial index of the records will be included
+
+    Returns:
+        bytes: The data written to the output file
+    """
+    rows, columns = (18, 36) if index else (0, 0)
+    strings = bytearray()
+    string_offsets = {}
+    cells = []
+    records = []
+
+    log.debug('Making binary points')
+    for user in parsed_users:
+        if not (-90 <= user.latitude <= 90 and -180 <= user.longitude <= 180):
+            log.warning('Leaving out user with invalid coordinates from the binary points: {}'.format(user))
+            continue
+
+        for text in (user.name, user.comment):
+            if text not in string_offsets:
+                encoded = text.encode()
+                string_offsets[text] = len(strings)
+                strings += struct.pack('<I', len(encoded)) + encoded
+
+        records.append(points_record.pack(int((user.latitude * 10000000).to_integral_value()),
+                                          int((user.longitude * 10000000).to_integral_value()),
+                                          string_offsets[user.name], string_offsets[user.comment]))
+        if index:
+            cells.append(min(int((user.latitude + 90) // 10), rows - 1) * columns +
+                         min(int((user.longitude + 180) // 10), columns - 1))
+
+    index_table = b''
+    if index:
+        # Order the records by cell and count how many there are in each one.
+        order = sorted(range(len(records)), key=cells.__getitem__)
+        records = [records[record] for record in order]
+
+        starts = [0] * (rows * columns + 1)
+        for cell in cells:
+            starts[cell + 1] += 1
+        for cell in range(rows * columns):
+            starts[cell + 1] += starts[cell]
+        index_table = struct.pack('<{}I'.format(len(starts)), *starts)
+
+    strings_offset = points_header.size + len(index_table) + len(records) * points_record.size
+    header = points_header.pack(b'AMPF', 1, int(index), len(records), rows, columns, strings_offset, len(strings))
+    points_bytes = b''.join([header, index_table] + records + [bytes(strings)])
+
+    if output_file == '-':
+        sys.stdout.buffer.write(points_bytes)
+        sys.stdout.flush()
+
+    elif output_file != '':
+        log.info('Writing binary points to ' + output_file)
+        with open(output_file, 'wb') as output:
+            output.write(points_bytes)
+
+    return points_bytes
+
+
+def make_msgpack(parsed_users, output_file=''):
+    """This function reads the user data supplied by ``parsed_users``, it then generates
+    `MessagePack <https://msgpack.org/>`_ output and writes it to ``output_file``.
+
+    The output is a single array containing a ``[latitude, longitude, name, comment]`` array for each user,
+    with the coordinates as 64-bit floats. It can be read by any MessagePack library.
+
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        output_file (str): Location to save the MessagePack output. If left empty, nothing will be output
+
+    Returns:
+        bytes: The data written to the output file
+    """
+    log.debug('Making MessagePack')
+    msgpack = bytearray()
+    parsed_users = list(parsed_users)
+
+    _pack_msgpack_length(msgpack, len(parsed_users), 0x90, 15, 0xdc, 0xdd)
+    for user in parsed_users:
+        # Each user is a fixed array of 4 elements.
+        msgpack.append(0x94)
+        msgpack += struct.pack('>Bd', 0xcb, float(user.latitude))
+        msgpack += struct.pack('>Bd', 0xcb, float(user.longitude))
+        for text in (user.name, user.comment):
+            encoded = text.encode()
+            _pack_msgpack_length(msgpack, len(encoded), 0xa0, 31, 0xda, 0xdb, 0xd9)
+            msgpack += encoded
+
+    msgpack_bytes = bytes(msgpack)
+
+    if output_file == '-':
+        sys.stdout.buffer.write(msgpack_bytes)
+        sys.stdout.flush()
+
+    elif output_file != '':
+        log.info('Writing MessagePack to ' + output_file)
+        with open(output_file, 'wb') as output:
+            output.write(msgpack_bytes)
+
+    return msgpack_bytes
+
+
+def _pack_msgpack_length(msgpack, length, fix_type, fix_max, type_16, type_32, type_8=None):
+    """Append the MessagePack header for an array or string of ``length`` to ``msgpack``."""
+    if length <= fix_max:
+        msgpack.append(fix_type | length)
+    elif type_8 is not None and length <= 0xff:
+        msgpack += struct.pack('>BB', type_8, length)
+    elif length <= 0xffff:
+        msgpack += struct.pack('>BH', type_16, length)
+    else:
+        msgpack += struct.pack('>BI', type_32, length)
+
+
+class UserIndex:
+    """Indexes of the users by where they are and by their name, to quickly find the users in an area
+    or whose names start with something.
+
+    The users are put into a grid of ``cell_size`` degree cells and their names are kept in a sorted list,
+    so a search only has to look at the users in the cells that the area overlaps or in the part of the list
+    where the names start with the prefix.
+
+    Args:
+        parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+        (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+        : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+        cell_size (int): The size of the grid cells in degrees
+    """
+
+    def __init__(self, parsed_users, cell_size=10):
+        self.users = list(parsed_users)
+        self.cell_size = cell_size
+        self._grid = {}
+        for position, user in enumerate(self.users):
+            cell = (math.floor(user.latitude / cell_size), math.floor(user.longitude / cell_size))
+            self._grid.setdefault(cell, []).append(position)
+
+        names = sorted((user.name.casefold(), position) for position, user in enumerate(self.users))
+        self._names = [name for name, _ in names]
+        self._name_positions = [position for _, position in names]
+
+    def select(self, bbox=None, prefix=None, limit=None):
+        """Find the users that are in ``bbox`` and whose names start with ``prefix``.
+
+        Args:
+            bbox (tuple): The area to find the users in, ``(west, south, east, north)`` in degrees.
+                If ``west`` is bigger than ``east`` the area goes over the antimeridian
+            prefix (str): The start of the names to find, it isn't case-sensitive
+            limit (int): The most users to return
+
+        Returns:
+            :obj:`list` of :obj:`collections.namedtuple`: The users that were found, in the same order as the index
+        """
+        if bbox is not None:
+            west, south, east, north = (Decimal(str(coord)) for coord in bbox)
+
+        if prefix is not None:
+            prefix = prefix.casefold()
+            start = bisect_left(self._names, prefix)
+            end = start
+            while end < len(self._names) and self._names[end].startswith(prefix):
+                end += 1
+            positions = self._name_positions[start:end]
+        elif bbox is not None:
+            if west <= east:
+                columns = range(math.floor(west / self.cell_size), math.floor(east / self.cell_size) + 1)
+            else:
+                # The two ranges share a column if the area goes almost all the way around the world.
+                columns = set(chain(range(math.floor(west / self.cell_size), math.floor(180 / self.cell_size) + 1),
+                                    range(math.floor(-180 / self.cell_size), math.floor(east / self.cell_size) + 1)))
+            rows = range(math.floor(south / self.cell_size), math.floor(north / self.cell_size) + 1)
+            positions = [position for row in rows for column in columns for position in self._grid.get((row, column), ())]
+        else:
+            positions = range(len(self.users))
+
+        users = []
+        for position in sorted(positions):
+            user = self.users[position]
+            if bbox is not None:
+                if not south <= user.latitude <= north:
+                    continue
+                if not (west <= user.longitude <= east if west <= east else
+                        user.longitude >= west or user.longitude <= east):
+                    continue
+            users.append(user)
+            if limit is not None and len(users) >= limit:
+                break
+
+        return users
+
+
+class RenderCache:
+    """A thread-safe cache that keeps the outputs that were used most recently, up to a total size.
+
+    Args:
+        max_size (int): The most characters (or bytes) of outputs to keep, other outputs count as 1
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self._outputs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the output saved for ``key``, or None if there isn't one."""
+        with self._lock:
+            output = self._outputs.get(key)
+            if output is not None:
+                self._outputs.move_to_end(key)
+            return output
+
+    def put(self, key, output):
+        """Save the ``output`` for ``key``, removing the outputs that were used least recently to make room."""
+        size = self._size(output)
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._outputs:
+                self.size -= self._size(self._outputs.pop(key))
+            self._outputs[key] = output
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._outputs.popitem(last=False)
+                self.size -= self._size(evicted)
+
+    @staticmethod
+    def _size(output):
+        return len(output) if isinstance(output, (str, bytes)) else 1
+
+
+class PublishGuard:
+    """Stops the outputs from being replaced when most of the users have suddenly gone,
+    e.g. when the wiki page has been broken or the wrong list was picked up from it.
+
+    The number of users and a hash of them are saved to ``state_file`` each time the outputs are written,
+    and the next set of users is compared to them before anything is written.
+
+    Args:
+        state_file (str): Location of the file to save the state of the last outputs to
+        max_shrink (float): The largest fraction of the users that can disappear at once
+    """
+
+    def __init__(self, state_file, max_shrink=0.5):
+        self.state_file = state_file
+        self.max_shrink = max_shrink
+
+    @staticmethod
+    def content_hash(parsed_users):
+        """Make a hash of the users, it changes if anything about any of them changes."""
+        from hashlib import sha256
+
+        users_hash = sha256()
+        for latitude, longitude, name, comment in parsed_users:
+            # JSON keeps the fields apart, whatever quote marks or '#' are in the names and comments
+            users_hash.update(json.dumps([str(latitude), str(longitude), name, comment]).encode('utf-8') + b'\n')
+        return users_hash.hexdigest()
+
+    def read_state(self):
+        """Read the number of users and their hash from the state file, returns None if there isn't one."""
+        try:
+            with open(self.state_file, 'r') as state:
+                return json.load(state)
+        except (OSError, ValueError):
+            return None
+
+    def check(self, parsed_users):
+        """Check if the outputs should be replaced with ``parsed_users``.
+
+        Args:
+            parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+            (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+            : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+
+        Returns:
+            bool: False if more than ``max_shrink`` of the users have gone since the last outputs, otherwise True
+        """
+        state = self.read_state()
+        if state is None:
+            return True
+
+        if state.get('hash') == self.content_hash(parsed_users):
+            log.debug('The users are the same as the last outputs')
+            return True
+
+        last_count = state.get('count', 0)
+        if len(parsed_users) < last_count * (1 - self.max_shrink):
+            log.critical('There are only {} users, down from {} in the last outputs. The list is probably broken '
+                         'so the outputs were left as they are'.format(len(parsed_users), last_count))
+            return False
+        return True
+
+    def commit(self, parsed_users):
+        """Save the number of users and their hash as the state of the last outputs."""
+        log.debug('Writing the state of the outputs to ' + self.state_file)
+        with open(self.state_file, 'w') as state:
+            json.dump({'count': len(parsed_users), 'hash': self.content_hash(parsed_users)}, state)
+            state.write('\n')
+
+
+class Generations:
+    """Publishes the outputs into a new directory each run and then points a ``current`` symlink at it,
+    so anyone reading the outputs through ``current`` never sees a mix of two runs.
+
+    Files that are the same as in the last generation are hardlinked to it instead of being kept twice,
+    and old generations are removed by :meth:`publish`.
+
+    Args:
+        directory (str): Location of the directory to keep the generations in
+        keep (int): The number of generations to keep, including the current one
+        max_age (float): Generations older than this many seconds are removed even if there are fewer than ``keep``
+            of them, the current generation is always kept. None turns this off
+    """
+
+    # The names are in UTC, so they sort in the order the generations were made even across DST changes
+    name_format = '%Y%m%dT%H%M%S.%fZ'
+
+    def __init__(self, directory, keep=3, max_age=None):
+        self.directory = directory
+        self.keep = keep
+        self.max_age = max_age
+        self.path = None
+        self._names = {}
+
+    def current(self):
+        """Get the location of the current generation, returns None if nothing has been published yet."""
+        link = os.path.join(self.directory, 'current')
+        if not os.path.islink(link):
+            return None
+        return os.path.join(self.directory, os.readlink(link))
+
+    def generations(self):
+        """Get the names of all of the generations, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if name != 'current' and not name.startswith('.') and
+                      os.path.isdir(os.path.join(self.directory, name)) and
+                      not os.path.islink(os.path.join(self.directory, name)))
+
+    def new(self, seed=()):
+        """Make the directory for a new generation.
+
+        Args:
+            seed (:obj:`list` of :obj:`str`): Names of files to copy from the current generation,
+                for outputs that are updated in place rather than written from scratch (e.g. SQLite)
+
+        Returns:
+            str: The location of the new generation
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            path = os.path.join(self.directory, datetime.now(timezone.utc).strftime(self.name_format))
+            try:
+                os.mkdir(path)
+                break
+            except FileExistsError:
+                pass
+
+        current = self.current()
+        if current is not None:
+            for name in seed:
+                try:
+                    shutil.copy2(os.path.join(current, name), os.path.join(path, name))
+                except FileNotFoundError:
+                    pass
+
+        log.debug('Writing the outputs to ' + path)
+        self.path = path
+        self._names = {}
+        return path
+
+    def path_for(self, output_file):
+        """Get the location in the new generation to write ``output_file`` to.
+
+        The outputs are all kept in the top of the generation under their file names, so two outputs
+        can't have the same file name even if they are in different directories.
+
+        Raises:
+            ValueError: If another output with the same file name is already in the new generation
+        """
+        name = os.path.basename(output_file)
+        other_file = self._names.setdefault(name, os.path.abspath(output_file))
+        if other_file != os.path.abspath(output_file):
+            raise ValueError("The outputs {} and {} can't both be in a generation, they have the same file name"
+                             .format(other_file, output_file))
+        return os.path.join(self.path, name)
+
+    def discard(self):
+        """Remove the new generation without publishing it."""
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def publish(self):
+        """Hardlink the unchanged files to the current generation, make the new generation current
+        and remove the old generations."""
+        current = self.current()
+        if current is not None:
+            for name in os.listdir(self.path):
+                new_file = os.path.join(self.path, name)
+                old_file = os.path.join(current, name)
+                if os.path.isfile(old_file) and filecmp.cmp(old_file, new_file, shallow=False):
+                    temp_file = os.path.join(self.path, '.' + name + '.link')
+                    os.link(old_file, temp_file)
+                    os.replace(temp_file, new_file)
+
+        # Replacing the symlink is atomic, unlike removing it and making a new one.
+        temp_link = os.path.join(self.directory, '.current.link')
+        try:
+            os.remove(temp_link)
+        except FileNotFoundError:
+            pass
+        os.symlink(os.path.basename(self.path), temp_link)
+        os.replace(temp_link, os.path.join(self.directory, 'current'))
+        log.info('Published the outputs to ' + self.path)
+
+        self.path = None
+        self.prune()
+
+    def prune(self):
+        """Remove the generations that are older than ``max_age`` or aren't one of the newest ``keep``."""
+        current = self.current()
+        current = os.path.basename(current) if current is not None else None
+        names = self.generations()
+        now = time.time()
+        for number, name in enumerate(reversed(names)):
+            if name == current:
+                continue
+            path = os.path.join(self.directory, name)
+            if number >= self.keep or (self.max_age is not None and now - os.path.getmtime(path) > self.max_age):
+                log.debug('Removing the old generation ' + path)
+                shutil.rmtree(path, ignore_errors=True)
+
+
+class SnapshotArchive:
+    """A history of the users, with a snapshot of them added on each run, kept in an SQLite database.
+
+    Most snapshots are stored as a compressed delta against the one before (the users that were removed
+    and the users that were added, with their positions), and every ``keyframe_interval`` snapshots
+    there is a complete compressed copy, so getting the users back never needs more than that many deltas.
+    The number of users in each snapshot is stored in its own column, so :meth:`counts` doesn't need to
+    decompress anything.
+
+    Args:
+        archive_file (str): Location of the SQLite database
+        keyframe_interval (int): The number of snapshots from one keyframe to the next
+    """
+
+    def __init__(self, archive_file, keyframe_interval=28):
+        self.archive_file = archive_file
+        self.keyframe_interval = keyframe_interval
+        self._last = None
+
+    def add(self, parsed_users, when=None):
+        """Add a snapshot of ``parsed_users`` to the archive.
+
+        Args:
+            parsed_users (:obj:`list` of :obj:`collections.namedtuple` \
+            (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`))\
+            : A list of namedtuples, each namedtuple should have 4 elements: ``(latitude, longitude, name, comment)``
+            when (:obj:`datetime.datetime`): The time of the snapshot, defaults to now.
+                It can't be before the last snapshot in the archive
+
+        Returns:
+            int: The ID of the new snapshot
+        """
+        rows = [(str(user.latitude), str(user.longitude), user.name, user.comment) for user in parsed_users]
+        timestamp = when.timestamp() if when is not None else time.time()
+
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN')
+            last = connection.execute('SELECT id, time FROM snapshots ORDER BY id DESC LIMIT 1').fetchone()
+            if last is not None and timestamp < last[1]:
+                raise ValueError('Snapshots have to be added in order')
+
+            data = None
+            if last is not None:
+                since_keyframe = connection.execute('SELECT count(*) FROM snapshots WHERE id > '
+                                                    '(SELECT max(id) FROM snapshots WHERE keyframe)').fetchone()[0]
+                if since_keyframe + 1 < self.keyframe_interval:
+                    last_rows = self._last[1] if self._last and self._last[0] == last[0] else \
+                        self._rows(connection, last[0])
+                    data = self._delta(last_rows, rows)
+
+            keyframe = data is None
+            if keyframe:
+                data = self._pack(rows)
+
+            cursor = connection.execute('INSERT INTO snapshots (time, count, keyframe, data) VALUES (?, ?, ?, ?)',
+                                        (timestamp, len(rows), keyframe, data))
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+        log.info('Added {} snapshot {} of {} users to {} ({} bytes)'.format(
+            'keyframe' if keyframe else 'delta', cursor.lastrowid, len(rows), self.archive_file, len(data)))
+        self._last = (cursor.lastrowid, rows)
+        return cursor.lastrowid
+
+    def snapshot(self, when=None):
+        """Get the users as they were at ``when``, from the last snapshot that was added at or before then.
+
+        Args:
+            when (:obj:`datetime.datetime`): The time to get the users at, defaults to the last snapshot
+
+        Returns:
+            :obj:`list` of :obj:`collections.namedtuple` \
+            (:obj:`decimal.Decimal`, :obj:`decimal.Decimal`, :obj:`str`, :obj:`str`) or None\
+            : The users, or None if there isn't a snapshot that old
+        """
+        connection = self._connect()
+        try:
+            if when is None:
+                row = connection.execute('SELECT max(id) FROM snapshots').fetchone()
+            else:
+                row = connection.execute('SELECT max(id) FROM snapshots WHERE time <= ?', (when.timestamp(),)).fetchone()
+            if row[0] is None:
+                return None
+            rows = self._rows(connection, row[0])
+        finally:
+            connection.close()
+
+        return [Entry(Decimal(latitude), Decimal(longitude), name, comment)
+                for latitude, longitude, name, comment in rows]
+
+    def counts(self, start=None, end=None):
+        """Get the number of users in each snapshot, e.g. to see how the number of users has grown.
+
+        Args:
+            start (:obj:`datetime.datetime`): Leave out the snapshots before this time
+            end (:obj:`datetime.datetime`): Leave out the snapshots after this time
+
+        Returns:
+            :obj:`list` of :obj:`tuple` (:obj:`datetime.datetime`, int): The time (in UTC) of each snapshot
+            and the number of users in it, oldest first
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute('SELECT time, count FROM snapshots WHERE time >= ? AND time <= ? ORDER BY id',
+                                      (start.timestamp() if start is not None else float('-inf'),
+                                       end.timestamp() if end is not None else float('inf'))).fetchall()
+        finally:
+            connection.close()
+
+        return [(datetime.fromtimestamp(timestamp, timezone.utc), count) for timestamp, count in rows]
+
+    def _connect(self):
+        """Open the database, making the table if it's new."""
+        import sqlite3
+
+        connection = sqlite3.connect(self.archive_file, isolation_level=None)
+        connection.execute('CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, time REAL NOT NULL, '
+                           'count INTEGER NOT NULL, keyframe INTEGER NOT NULL, data BLOB NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (time)')
+        return connection
+
+    def _rows(self, connection, snapshot_id):
+        """Rebuild the users in a snapshot from the keyframe before it and the deltas after that keyframe."""
+        keyframe_id = connection.execute('SELECT max(id) FROM snapshots WHERE keyframe AND id <= ?',
+                                         (snapshot_id,)).fetchone()[0]
+        rows = None
+        for keyframe, data in connection.execute('SELECT keyframe, data FROM snapshots WHERE id >= ? AND id <= ? '
+                                                 'ORDER BY id', (keyframe_id, snapshot_id)):
+            rows = self._unpack(data) if keyframe else self._apply(rows, self._unpack(data))
+        return rows
+
+    @staticmethod
+    def _pack(data):
+        """Compress a keyframe or delta."""
+        return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 9)
+
+    @staticmethod
+    def _unpack(data):
+        """Decompress a keyframe or delta, the users in it are turned back into tuples."""
+        data = json.loads(zlib.decompress(data).decode('utf-8'))
+        if isinstance(data, list):
+            return [tuple(row) for row in data]
+        return {'removed': [tuple(row) for row in data['removed']],
+                'added': [(index, tuple(row)) for index, row in data['added']]}
+
+    def _delta(self, old_rows, new_rows):
+        """Make a compressed delta from ``old_rows`` to ``new_rows``, or return None if a keyframe would be better
+        (the order of the users has changed or most of them are different)."""
+        removed = Counter(old_rows) - Counter(new_rows)
+        delta = {'removed': list(removed.elements()), 'added': []}
+        kept = self._apply(old_rows, delta)
+
+        # Every user that is left should be in the same order in 'new_rows', anything between them has been added.
+        position = 0
+        for index, row in enumerate(new_rows):
+            if position < len(kept) and kept[position] == row:
+                position += 1
+            else:
+                delta['added'].append((index, row))
+
+        if position < len(kept) or len(delta['added']) + len(delta['removed']) > len(new_rows) // 2:
+            return None
+        return self._pack(delta)
+
+    @staticmethod
+    def _apply(rows, delta):
+        """Apply a delta from :meth:`_delta` to ``rows``."""
+        kept = rows
+        if delta['removed']:
+            removed = Counter(delta['removed'])
+            kept = []
+            for row in rows:
+                if removed.get(row):
+                    removed[row] -= 1
+                else:
+                    kept.append(row)
+
+        new_rows = []
+        kept = iter(kept)
+        for index, row in delta['added']:
+            new_rows.extend(islice(kept, index - len(new_rows)))
+            new_rows.append(row)
+        new_rows.extend(kept)
+        return new_rows
+
+
+def _is_parsed(users):
+    """Check if ``users`` is a list of users that has already been parsed (e.g. by :func:`read_output`)."""
+    return isinstance(users, list) and bool(users) and isinstance(users[0], Entry)
+
+
+def _files_missing(options):
+    """Check if any of the files in the ``*_file`` ``options`` of a sink have gone, e.g. been deleted by hand."""
+    return any(option.endswith('_file') and isinstance(value, str) and value not in ('', '-', 'no') and
+               not os.path.exists(value) for option, value in options.items())
+
+
+class Pipeline:
+    """Gets users from a source, runs them through a list of stages and then outputs them to each of the sinks.
+
+    A pipeline can be run any number of times, e.g. by a service that keeps it around. The users from the
+    last run are cached, if the source gives the same text again they aren't parsed or put through the
+    stages again, and a sink is only run again when the users that it would be given have changed
+    (or the file in one of its ``*_file`` options has gone).
+
+    The source is a function that takes no arguments and returns a list of user lists (each one is the
+    text of a list, an iterable of its lines, a list of users that have already been parsed (e.g. from
+    :func:`read_output`) or None if it couldn't be got), for example ``lambda: [get_users()]``,
+    ``lambda: get_users_multi(sources)`` or ``lambda: [read_output('/tmp/archmap.csv')]``. If there is more than one list,
+    the users are merged with :func:`merge_users`. Each stage is a function that takes the users and
+    returns the changed users, for example ``partial(round_users, precision=4)``.
+
+    Example:
+        .. code-block:: python
+
+            pipeline = archmap.Pipeline(lambda: [archmap.get_users()],
+                                        stages=[lambda users: archmap.validate_users(users)[0]])
+            pipeline.register_sink('ids', archmap.make_ids, id_file='/tmp/archmap-ids.json')
+            pipeline.register_sink('geojson', archmap.make_geojson, output_file='/tmp/archmap.geojson',
+                                   inputs={'ids': 'ids'})
+            outputs = pipeline.run()
+
+    Subsets of the users can be output with :meth:`render`, it's meant to be called over and over
+    (e.g. by a web service) so the outputs are kept in a :class:`RenderCache` of ``cache_size`` characters.
+
+    Args:
+        source (function): Gets the lists of users
+        stages (:obj:`list` of :obj:`function`): The functions to run the parsed users through, in order
+        cache_size (int): The most characters of outputs from :meth:`render` to keep
+        max_bad_lines (float): If more than this fraction of the lines can't be parsed, the list is probably
+            broken so :meth:`run` stops before any of the sinks are run. None turns this check off
+        guard (:obj:`PublishGuard`): Checks the users before the sinks are run, so that they aren't run
+            when most of the users have suddenly gone. The users from the last good run are kept in :attr:`users`
+        parse_options (dict): Keyword arguments for :func:`parse_users`, e.g. the limits on each list
+    """
+
+    def __init__(self, source, stages=(), cache_size=16 * 1024 * 1024, max_bad_lines=None, guard=None,
+                 parse_options=None):
+        self.source = source
+        self.stages = list(stages)
+        self.max_bad_lines = max_bad_lines
+        self.guard = guard
+        self.parse_options = parse_options or {}
+        # The users from the last run and their generation are only ever replaced together, in one assignment,
+        # so that render() can't see the new users with the old generation (or the other way round).
+        self._snapshot = (None, None)
+        self.parse_report = None
+        self.outputs = {}
+        self.render_cache = RenderCache(cache_size)
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._sinks = {}
+        self._source_key = None
+        self._sink_cache = {}
+
+    @property
+    def users(self):
+        """The users from the last good run, None if the pipeline hasn't been run yet."""
+        return self._snapshot[1]
+
+    @property
+    def generation(self):
+        """A digest of :attr:`users`, the outputs of the sinks and :meth:`render` are cached on it."""
+        return self._snapshot[0]
+
+    def register_sink(self, name, function, uses=None, inputs=None, **options):
+        """Add a sink called ``name`` to the pipeline (or replace the sink that already has that name).
+
+        The sinks are run in the order they were added. Each one is called with the users and ``options``,
+        e.g. ``make_geojson(users, output_file='/tmp/archmap.geojson', compact=True)``, and what it returns
+        is saved as its output.
+
+        Args:
+            name (str): The name of the sink, it's used as the key of its output
+            function (function): The function to call, e.g. one of the ``make_*`` functions
+            uses (str): The name of a sink to give the output of to ``function`` instead of the users,
+                e.g. :func:`make_density` uses the cells from :func:`count_cells`
+            inputs (dict): Extra arguments for ``function`` that come from the outputs of other sinks,
+                the keys are the argument names and the values are the sink names, e.g. ``{'ids': 'ids'}``
+            **options: The other arguments for ``function``
+        """
+        self._sinks[name] = (function, uses, inputs or {}, options)
+        self._sink_cache.pop(name, None)
+
+    def run(self, force=False):
+        """Get the users from the source, process them and run each of the sinks.
+
+        The lines that couldn't be parsed are in :attr:`parse_report` afterwards.
+
+        Args:
+            force (bool): If set to True, everything is done again even if the users haven't changed
+                and the guard isn't checked
+
+        Returns:
+            dict: The output of each sink, keyed on their names. None if none of the users could be got,
+            too many of the lines couldn't be parsed or the guard stopped the sinks from being run
+        """
+        user_lists = self.source()
+        if not user_lists or all(users is None for users in user_lists):
+            return None
+
+        # Only text can be compared to the last run, an iterable of lines can't be read twice.
+        source_key = None
+        if all(isinstance(users, str) or users is None for users in user_lists):
+            source_key = tuple(user_lists)
+
+        if force or source_key is None or source_key != self._source_key:
+            # The bad lines of every list are put in one report, so they are only logged once.
+            report = self.parse_report = ParseReport()
+            parsed_lists = [users if _is_parsed(users) else parse_users(users, report, **self.parse_options)
+                            for users in user_lists if users is not None]
+            if report.reasons:
+                log.error(report.summary())
+            if self.max_bad_lines is not None and report.ratio > self.max_bad_lines:
+                log.critical("{:.0%} of the lines couldn't be parsed, the list is probably broken so nothing was output"
+                             .format(report.ratio))
+                return None
+
+            users = parsed_lists[0] if len(user_lists) == 1 else merge_users(*parsed_lists)
+            for stage in self.stages:
+                users = stage(users)
+
+            users = list(users)
+            if self.guard is not None and not force and not self.guard.check(users):
+                return None
+
+            self._snapshot = (PublishGuard.content_hash(users), users)
+            self._source_key = source_key
+        else:
+            log.info('The users have not changed since the last run')
+
+        generation, users = self._snapshot
+        outputs = {}
+        for name, (function, uses, inputs, options) in self._sinks.items():
+            cached = self._sink_cache.get(name)
+            if not force and cached is not None and cached[0] == generation and not _files_missing(options):
+                log.debug('Using the cached output of the {} sink'.format(name))
+                outputs[name] = cached[1]
+                continue
+
+            arguments = dict(options)
+            arguments.update((argument, outputs[sink]) for argument, sink in inputs.items())
+            outputs[name] = function(users if uses is None else outputs[uses], **arguments)
+            self._sink_cache[name] = (generation, outputs[name])
+
+        if self.guard is not None:
+            self.guard.commit(users)
+
+        self.outputs = outputs
+        return outputs
+
+    def render(self, function, bbox=None, prefix=None, limit=None, **options):
+        """Output the users from the last run that are in ``bbox`` and whose names start with ``prefix``.
+
+        The users are found with a :class:`UserIndex` that is made once for each set of users, and
+        the output is cached until the users change, e.g. ``render(make_geojson, bbox=(-10, 35, 30, 60))``
+        only runs :func:`make_geojson` the first time it's called for those users.
+
+        Args:
+            function (function): The function to output the users with, e.g. one of the ``make_*`` functions
+            bbox (tuple): The area to find the users in, see :meth:`UserIndex.select`
+            prefix (str): The start of the names to find, it isn't case-sensitive
+            limit (int): The most users to output
+            **options: The other arguments for ``function``
+
+        Returns:
+            The output of ``function``
+
+        Raises:
+            ValueError: If the pipeline hasn't been run yet
+        """
+        generation, users = self._snapshot
+        if users is None:
+            raise ValueError("The pipeline hasn't been run yet")
+
+        key = (function, generation, tuple(bbox) if bbox is not None else None, prefix, limit,
+               repr(sorted(options.items())))
+        output = self.render_cache.get(key)
+        if output is not None:
+            log.debug('Using a cached output')
+            return output
+
+        with self._index_lock:
+            if self._index is None or self._index[0] != generation:
+                log.debug('Indexing {} users'.format(len(users)))
+                self._index = (generation, UserIndex(users))
+            index = self._index[1]
+
+        output = function(index.select(bbox=bbox, prefix=prefix, limit=limit), **options)
+        self.render_cache.put(key, output)
+        return output
+
+
+def _parse_positive(text):
+    """Parse ``text`` as a :obj:`decimal.Decimal` that is more than 0, returns None if it isn't one."""
+    try:
+        number = Decimal(text)
+    except InvalidOperation:
+        return None
+    return number if number.is_finite() and number > 0 else None
+
+
 def main():
     from argparse import ArgumentParser
     from configparser import ConfigParser
@@ -340,8 +3009,22 @@ def main():
                         help='Use an alternative URL to parse the wiki list from')
     parser.add_argument('--file', metavar='FILE',
                         help='Use a file to parse the wiki list from')
+    parser.add_argument('--raw', metavar='FILE',
+                        help='Use a raw-text list file instead of the wiki list')
+    parser.add_argument('--load', metavar='FILE',
+                        help='Use the users from a CSV, GeoJSON or KML output instead of the wiki list')
+    parser.add_argument('--api', metavar='URL',
+                        help='Use the wikitext from a MediaWiki API instead of the rendered wiki list')
+    parser.add_argument('--source', metavar='SOURCE', action='append',
+                        help='Also get users from SOURCE (a URL or a file), can be used more than once')
     parser.add_argument('--pretty', action='store_true',
                         help='Prettify the raw-text. Only works if user output is enabled')
+    parser.add_argument('--precision', metavar='PLACES', type=int,
+                        help='Round the coordinates in every output to PLACES decimal places')
+    parser.add_argument('--compact', action='store_true',
+                        help='Make the GeoJSON and KML as small as possible')
+    parser.add_argument('--sort', metavar='KEY', choices=['geohash', 'name'],
+                        help="Sort the users by KEY ('geohash' or 'name') instead of keeping the order of the list")
     parser.add_argument('--text', metavar='FILE',
                         help="Output the raw-text to FILE, use 'no' to disable output or '-' to print to stdout")
     parser.add_argument('--geojson', metavar='FILE',
@@ -350,8 +3033,45 @@ def main():
                         help="Output the KML to FILE, use 'no' to disable output or '-' to print to stdout")
     parser.add_argument('--csv', metavar='FILE',
                         help="Output the CSV to FILE, use 'no' to disable output or '-' to print to stdout")
+    parser.add_argument('--points', metavar='FILE',
+                        help="Output the binary points to FILE, use 'no' to disable output or '-' to print to stdout")
+    parser.add_argument('--msgpack', metavar='FILE',
+                        help="Output the MessagePack to FILE, use 'no' to disable output or '-' to print to stdout")
+    parser.add_argument('--sqlite', metavar='FILE',
+                        help="Export the users to the SQLite database FILE, use 'no' to disable it")
+    parser.add_argument('--boundaries', metavar='FILE',
+                        help='Look up the country of each user in the GeoJSON country boundaries in FILE')
+    parser.add_argument('--countries', metavar='FILE',
+                        help="Output the number of users in each country to FILE, use 'no' to disable output "
+                             "or '-' to print to stdout")
+    parser.add_argument('--density', metavar='FILE',
+                        help="Output the number of users in each cell of a grid as GeoJSON to FILE, "
+                             "use 'no' to disable output or '-' to print to stdout")
+    parser.add_argument('--density-grid', metavar='FILE',
+                        help="Output the number of users in each cell of a grid as an ESRI ASCII grid to FILE, "
+                             "use 'no' to disable output or '-' to print to stdout")
+    parser.add_argument('--cell-size', metavar='DEGREES',
+                        help='Use DEGREES sized cells for the density outputs')
+    parser.add_argument('--parse-report', metavar='FILE',
+                        help="Save the lines that couldn't be parsed to FILE as JSON")
+    parser.add_argument('--max-bad-lines', metavar='RATIO', type=float,
+                        help="Don't output anything if more than RATIO (between 0 and 1) of the lines can't be parsed")
+    parser.add_argument('--generations', metavar='DIR',
+                        help="Write the output files to a new directory in DIR each run and link DIR/current to it")
+    parser.add_argument('--archive', metavar='FILE',
+                        help='Add a snapshot of the users to the archive in FILE')
+    parser.add_argument('--state', metavar='FILE',
+                        help="Save the number of users to FILE and don't replace the outputs if most of them go")
+    parser.add_argument('--force', action='store_true',
+                        help="Write the outputs even if the list hasn't changed or most of the users have gone "
+                             "since the last run")
+    parser.add_argument('--ids', metavar='FILE',
+                        help="Give the users IDs that stay the same between runs and save them to FILE, "
+                             "use 'no' to number them instead")
     args = parser.parse_args()
 
+    log_to_journal()
+
     config_location = Path(args.config)
     config = ConfigParser()
 
@@ -363,12 +3083,52 @@ def main():
 
     verbosity = config.getint('extras', 'verbosity', fallback=default_verbosity)
     pretty = config.getboolean('extras', 'pretty', fallback=default_pretty)
+    precision = config.get('extras', 'precision', fallback=default_precision)
+    compact = config.getboolean('extras', 'compact', fallback=default_compact)
+    sort = config.get('extras', 'sort', fallback=default_sort)
+    csv_columns = config.get('csv', 'columns', fallback=default_csv_columns).replace(',', ' ').split()
+    csv_precision = config.get('csv', 'precision', fallback=default_csv_precision)
+    csv_encoding = config.get('csv', 'encoding', fallback=default_csv_encoding)
+    csv_buffering = config.getint('csv', 'buffering', fallback=default_csv_buffering)
+    validate = config.get('extras', 'validate', fallback=default_validate)
+    nearby = config.get('extras', 'nearby', fallback=default_nearby)
+    timeout = config.getfloat('extras', 'timeout', fallback=default_timeout)
+    retries = config.getint('extras', 'retries', fallback=default_retries)
+    limit_download = config.get('limits', 'download', fallback=default_limit_download)
+    limit_line_length = config.get('limits', 'line_length', fallback=default_limit_line_length)
+    limit_users = config.get('limits', 'users', fallback=default_limit_users)
+    limit_parse_time = config.get('limits', 'parse_time', fallback=default_limit_parse_time)
+    max_bad_lines = config.get('extras', 'max_bad_lines', fallback=default_max_bad_lines)
+    max_shrink = config.getfloat('extras', 'max_shrink', fallback=float(default_max_shrink))
+    keep_generations = config.getint('extras', 'keep_generations', fallback=int(default_keep_generations))
+    generation_max_age = config.get('extras', 'generation_max_age', fallback=default_generation_max_age)
+    keyframe_interval = config.getint('extras', 'keyframe_interval', fallback=int(default_keyframe_interval))
     input_url = config.get('files', 'url', fallback=default_url)
     input_file = config.get('files', 'file', fallback=default_file)
+    input_api = config.get('files', 'api', fallback=default_api)
+    input_title = config.get('files', 'title', fallback=default_title)
+    revision_file = config.get('files', 'revision', fallback=default_revision)
+    input_raw = config.get('files', 'raw', fallback=default_raw)
+    input_load = config.get('files', 'load', fallback=default_load)
+    input_sources = config.get('files', 'sources', fallback=default_sources).split()
     output_file_text = config.get('files', 'text', fallback=default_text)
     output_file_geojson = config.get('files', 'geojson', fallback=default_geojson)
     output_file_kml = config.get('files', 'kml', fallback=default_kml)
     output_file_csv = config.get('files', 'csv', fallback=default_csv)
+    output_file_points = config.get('files', 'points', fallback=default_points)
+    output_file_msgpack = config.get('files', 'msgpack', fallback=default_msgpack)
+    output_file_sqlite = config.get('files', 'sqlite', fallback=default_sqlite)
+    id_file = config.get('files', 'ids', fallback=default_ids)
+    boundary_file = config.get('files', 'boundaries', fallback=default_boundaries)
+    country_code = config.get('files', 'country_code', fallback=default_country_code)
+    output_file_countries = config.get('files', 'countries', fallback=default_countries)
+    output_file_density = config.get('files', 'density', fallback=default_density)
+    parse_report_file = config.get('files', 'parse_report', fallback=default_parse_report)
+    state_file = config.get('files', 'state', fallback=default_state)
+    generations_directory = config.get('files', 'generations', fallback=default_generations)
+    archive_file = config.get('files', 'archive', fallback=default_archive)
+    output_file_density_grid = config.get('files', 'density_grid', fallback=default_density_grid)
+    cell_size = config.get('extras', 'cell_size', fallback=default_cell_size)
 
     # Finally, parse the command line arguments, anything passed to them will
     # override both the defaults in this script and anything in the config file.
@@ -387,12 +3147,33 @@ def main():
     if args.pretty is not False:
         pretty = True
 
+    if args.precision is not None:
+        precision = args.precision
+
+    if args.compact is not False:
+        compact = True
+
+    if args.sort is not None:
+        sort = args.sort
+
     if args.url is not None:
         input_url = args.url
 
     if args.file is not None:
         input_file = args.file
 
+    if args.raw is not None:
+        input_raw = args.raw
+
+    if args.load is not None:
+        input_load = args.load
+
+    if args.api is not None:
+        input_api = args.api
+
+    if args.source is not None:
+        input_sources = args.source
+
     if args.text is not None:
         output_file_text = args.text
 
@@ -405,12 +3186,83 @@ def main():
     if args.csv is not None:
         output_file_csv = args.csv
 
+    if args.points is not None:
+        output_file_points = args.points
+
+    if args.msgpack is not None:
+        output_file_msgpack = args.msgpack
+
+    if args.sqlite is not None:
+        output_file_sqlite = args.sqlite
+
+    if args.ids is not None:
+        id_file = args.ids
+
+    if args.boundaries is not None:
+        boundary_file = args.boundaries
+
+    if args.countries is not None:
+        output_file_countries = args.countries
+
+    if args.density is not None:
+        output_file_density = args.density
+
+    if args.density_grid is not None:
+        output_file_density_grid = args.density_grid
+
+    if args.cell_size is not None:
+        cell_size = args.cell_size
+
+    if args.parse_report is not None:
+        parse_report_file = args.parse_report
+
+    if args.max_bad_lines is not None:
+        max_bad_lines = args.max_bad_lines
+
+    if args.state is not None:
+        state_file = args.state
+
+    if args.generations is not None:
+        generations_directory = args.generations
+
+    if args.archive is not None:
+        archive_file = args.archive
+
+    # Check the settings that the config file or the arguments could have got wrong before anything is done.
+    if validate not in ('drop', 'flag', 'no'):
+        parser.error("validate has to be 'drop', 'flag' or 'no', not '{}'".format(validate))
+
+    nearby_degrees = _parse_positive(nearby)
+    if nearby_degrees is None:
+        parser.error("nearby has to be a number of degrees more than 0, not '{}'".format(nearby))
+    nearby = nearby_degrees
+
+    for option, places in (('precision', precision), ('csv precision', csv_precision)):
+        if places != '' and not str(places).isdigit():
+            parser.error("{} has to be a number of decimal places (0 or more), not '{}'".format(option, places))
+
+    if output_file_density not in ('', 'no') or output_file_density_grid not in ('', 'no'):
+        cell_degrees = _parse_positive(cell_size)
+        if cell_degrees is None:
+            parser.error("cell_size has to be a number of degrees more than 0, not '{}'".format(cell_size))
+        grid_cells = math.ceil(90 / cell_degrees) * math.ceil(180 / cell_degrees) * 4
+        if output_file_density_grid not in ('', 'no') and grid_cells > density_grid_max_cells:
+            parser.error('cell_size {} makes a density grid of {} cells, use larger cells to keep it under {}'
+                         .format(cell_size, grid_cells, density_grid_max_cells))
+
     # Do what's needed.
     dont_run = ['', 'no']
     if output_file_text in dont_run and \
        output_file_geojson in dont_run and \
        output_file_kml in dont_run and \
-       output_file_csv in dont_run:
+       output_file_csv in dont_run and \
+       output_file_points in dont_run and \
+       output_file_msgpack in dont_run and \
+       output_file_sqlite in dont_run and \
+       output_file_countries in dont_run and \
+       output_file_density in dont_run and \
+       output_file_density_grid in dont_run and \
+       archive_file in dont_run:
         log.warning('There is nothing to do')
     else:
         pipe_claims = []
@@ -422,23 +3274,169 @@ def main():
             pipe_claims.append('KML')
         if output_file_csv == '-':
             pipe_claims.append('CSV')
+        if output_file_points == '-':
+            pipe_claims.append('Points')
+        if output_file_msgpack == '-':
+            pipe_claims.append('MessagePack')
+        if output_file_countries == '-':
+            pipe_claims.append('Countries')
+        if output_file_density == '-':
+            pipe_claims.append('Density')
+        if output_file_density_grid == '-':
+            pipe_claims.append('Density grid')
         if len(pipe_claims) > 1:
             log.warning('More than one format specified for printing. You probably want to disable one of the following: {}'
                         .format(', '.join(pipe_claims)))
 
-        users = get_users(url=input_url, local=input_file)
-        if users is None:
-            return None
-        parsed_users = parse_users(users)
-
+        max_bytes = int(limit_download) if limit_download else None
+        parse_options = {'max_line': int(limit_line_length) if limit_line_length else None,
+                         'max_users': int(limit_users) if limit_users else None,
+                         'time_limit': float(limit_parse_time) if limit_parse_time else None}
+
+        # An unchanged revision is only skipped if the outputs were made the same way last time,
+        # so adding or changing an output makes it on the next run instead of waiting for the next edit.
+        output_settings = json.dumps({
+            'text': output_file_text, 'geojson': output_file_geojson, 'kml': output_file_kml, 'csv': output_file_csv,
+            'points': output_file_points, 'msgpack': output_file_msgpack, 'sqlite': output_file_sqlite,
+            'ids': id_file, 'boundaries': boundary_file, 'country_code': country_code,
+            'countries': output_file_countries, 'density': output_file_density,
+            'density_grid': output_file_density_grid, 'cell_size': cell_size, 'archive': archive_file,
+            'generations': generations_directory, 'pretty': pretty, 'compact': compact, 'precision': precision,
+            'sort': sort, 'validate': validate, 'nearby': str(nearby), 'csv_columns': csv_columns,
+            'csv_precision': csv_precision, 'csv_encoding': csv_encoding}, sort_keys=True)
+        revision = None
+
+        def source():
+            nonlocal revision
+            if input_api:
+                # Skipping an unchanged revision only works if there aren't any other sources to check.
+                last_revision = None
+                if revision_file and not input_sources and not args.force:
+                    last_revision = read_revision(revision_file, output_settings)
+
+                revision, users = get_users_api(api=input_api, title=input_title, revision=last_revision,
+                                                timeout=timeout, max_bytes=max_bytes)
+                if revision is not None and users is None:
+                    log.info('The list has not changed since the last run')
+                    return None
+                user_lists = [users]
+            elif input_raw:
+                user_lists = [read_users(input_raw, max_line=parse_options['max_line'])]
+            elif input_load:
+                try:
+                    user_lists = [read_output(input_load)]
+                except (OSError, ValueError) as error:
+                    log.critical("Can't load the users from {}: {}".format(input_load, error))
+                    return None
+            elif input_sources:
+                return get_users_multi([input_file or input_url] + input_sources, timeout=timeout, retries=retries,
+                                       max_bytes=max_bytes)
+            else:
+                user_lists = [get_users(url=input_url, local=input_file, max_bytes=max_bytes)]
+
+            if input_sources:
+                user_lists += get_users_multi(input_sources, timeout=timeout, retries=retries, max_bytes=max_bytes)
+            return user_lists
+
+        stages = []
+        if validate != 'no':
+            stages.append(lambda users: validate_users(users, drop=(validate == 'drop'), nearby=nearby)[0])
+        if precision != '':
+            stages.append(partial(round_users, precision=int(precision)))
+        if sort:
+            stages.append(partial(sort_users, key=sort))
+
+        generations = None
+        if generations_directory:
+            generations = Generations(generations_directory, keep=keep_generations,
+                                      max_age=float(generation_max_age) * 3600 if generation_max_age else None)
+            generations.new(seed=[Path(output_file_sqlite).name] if output_file_sqlite not in dont_run else [])
+
+            def in_generation(output_file):
+                if output_file in dont_run or output_file == '-':
+                    return output_file
+                return generations.path_for(output_file)
+
+            try:
+                output_file_text = in_generation(output_file_text)
+                output_file_geojson = in_generation(output_file_geojson)
+                output_file_kml = in_generation(output_file_kml)
+                output_file_csv = in_generation(output_file_csv)
+                output_file_points = in_generation(output_file_points)
+                output_file_msgpack = in_generation(output_file_msgpack)
+                output_file_sqlite = in_generation(output_file_sqlite)
+                output_file_countries = in_generation(output_file_countries)
+                output_file_density = in_generation(output_file_density)
+                output_file_density_grid = in_generation(output_file_density_grid)
+            except ValueError as error:
+                generations.discard()
+                parser.error(str(error))
+
+        guard = PublishGuard(state_file, max_shrink) if state_file else None
+        pipeline = Pipeline(source, stages, max_bad_lines=float(max_bad_lines) if max_bad_lines != '' else None,
+                            guard=guard, parse_options=parse_options)
+        id_inputs = {}
+        if id_file not in dont_run:
+            pipeline.register_sink('ids', make_ids, id_file=id_file)
+            id_inputs = {'ids': 'ids'}
         if output_file_text not in dont_run:
-            make_text(parsed_users, output_file_text, pretty=pretty)
+            pipeline.register_sink('text', make_text, output_file=output_file_text, pretty=pretty)
         if output_file_geojson not in dont_run:
-            make_geojson(parsed_users, output_file_geojson)
+            pipeline.register_sink('geojson', make_geojson, inputs=id_inputs, output_file=output_file_geojson,
+                                   compact=compact)
         if output_file_kml not in dont_run:
-            make_kml(parsed_users, output_file_kml)
+            pipeline.register_sink('kml', make_kml, inputs=id_inputs, output_file=output_file_kml, compact=compact)
         if output_file_csv not in dont_run:
-            make_csv(parsed_users, output_file_csv)
+            pipeline.register_sink('csv', make_csv, output_file=output_file_csv, columns=csv_columns,
+                                   precision=int(csv_precision) if csv_precision else None,
+                                   encoding=csv_encoding, buffering=csv_buffering, stream=True)
+        if output_file_points not in dont_run:
+            pipeline.register_sink('points', make_points, output_file=output_file_points)
+        if output_file_msgpack not in dont_run:
+            pipeline.register_sink('msgpack', make_msgpack, output_file=output_file_msgpack)
+        if output_file_sqlite not in dont_run:
+            pipeline.register_sink('sqlite', make_sqlite, output_file=output_file_sqlite)
+        if output_file_countries not in dont_run:
+            if boundary_file:
+                try:
+                    lookup = CountryLookup(boundary_file, code_property=country_code)
+                except (OSError, ValueError, KeyError, TypeError) as error:
+                    log.error("Can't load the country boundaries from {}: {}".format(boundary_file, error))
+                else:
+                    pipeline.register_sink('locations', locate_users, lookup=lookup)
+                    pipeline.register_sink('countries', make_country_counts, uses='locations',
+                                           output_file=output_file_countries)
+            else:
+                log.error('The country counts need a country boundaries file')
+        if output_file_density not in dont_run or output_file_density_grid not in dont_run:
+            pipeline.register_sink('cells', count_cells, cell_size=Decimal(cell_size))
+            if output_file_density not in dont_run:
+                pipeline.register_sink('density', make_density, uses='cells', output_file=output_file_density,
+                                       cell_size=Decimal(cell_size))
+            if output_file_density_grid not in dont_run:
+                pipeline.register_sink('density_grid', make_density_grid, uses='cells',
+                                       output_file=output_file_density_grid, cell_size=Decimal(cell_size))
+        if archive_file not in dont_run:
+            pipeline.register_sink('archive', SnapshotArchive(archive_file, keyframe_interval).add)
+
+        try:
+            outputs = pipeline.run(force=args.force)
+        except BaseException:
+            if generations is not None:
+                generations.discard()
+            raise
+        if parse_report_file and pipeline.parse_report is not None:
+            pipeline.parse_report.write(parse_report_file)
+        if outputs is None:
+            if generations is not None:
+                generations.discard()
+            return None
+
+        if generations is not None:
+            generations.publish()
+
+        if revision is not None and revision_file:
+            write_revision(revision_file, revision, output_settings)
 
 
 # If the script is being run and not imported...
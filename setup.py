@@ -17,7 +17,7 @@ setup(
     license='Unlicense',
     py_modules=['archmap'],
     entry_points={'console_scripts': ['archmap=archmap:main']},
-    install_requires=['bs4', 'geojson', 'simplekml'],
+    install_requires=['geojson>=2.5'],
     test_suite='setup.test_suite',
     python_requires='>=3',
     include_package_data=True
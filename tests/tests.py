@@ -1,13 +1,33 @@
 #!/usr/bin/env python3
 import configparser
 import contextlib
+import datetime
+import gzip
 import io
+import json
 import logging
 import os
 import pickle
+import random
+import re
+import shutil
+import sqlite3
+import struct
+import subprocess
 import sys
+import threading
+import time
+import tracemalloc
 import unittest
-import urllib
+import unittest.mock
+import zlib
+from decimal import Decimal
+from functools import partial
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
 
 import archmap
 
@@ -15,6 +35,97 @@ import archmap
 logging.disable(60)
 
 
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """A local HTTP server that stands in for the ArchWiki and its mirrors.
+
+    ``pages`` maps request paths to the bytes that are served for them, paths starting
+    with ``/slow`` are delayed for ``delay`` seconds and paths starting with ``/flaky``
+    fail with a 503 error until they have been requested ``failures`` times.
+    Paths starting with ``/gzip`` or ``/deflate`` are compressed and ``/redirect`` is moved to ``/wiki``.
+    ``/api.php`` acts like the MediaWiki API, serving the ``(revision ID, wikitext)`` pair in ``revision``.
+    As a proxy it serves requests for whole URLs by their path and refuses to open any ``CONNECT`` tunnels.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, pages, delay=2, failures=1, revision=None):
+        self.pages = pages
+        self.revision = revision
+        self.delay = delay
+        self.failures = failures
+        self.requests = []
+        self.headers = []
+        self.connections = 0
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.headers.append(self.headers)
+
+        if self.path.startswith('/slow'):
+            time.sleep(self.server.delay)
+        if self.path.startswith('/flaky') and self.server.requests.count(self.path) <= self.server.failures:
+            self.send_error(503)
+            return
+        if self.path.startswith('/redirect'):
+            self.send_response(301)
+            self.send_header('Location', '/wiki')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        path = self.path if self.path in self.server.pages else urlsplit(self.path).path
+        if path == '/api.php':
+            self.server.pages[path] = self.api_response()
+        if path not in self.server.pages:
+            self.send_error(404)
+            return
+
+        body = self.server.pages[path]
+        self.send_response(200)
+        if self.path.startswith('/gzip'):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        if self.path.startswith('/deflate'):
+            body = zlib.compress(body)
+            self.send_header('Content-Encoding', 'deflate')
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_CONNECT(self):
+        self.server.requests.append('CONNECT ' + self.path)
+        self.server.headers.append(self.headers)
+        self.send_error(403)
+
+    def api_response(self):
+        query = parse_qs(urlsplit(self.path).query)
+        revision = {'revid': self.server.revision[0]}
+        if 'content' in query['rvprop'][0].split('|'):
+            revision['slots'] = {'main': {'contentmodel': 'wikitext', 'content': self.server.revision[1]}}
+        page = {'title': query['titles'][0], 'revisions': [revision]}
+        return json.dumps({'batchcomplete': True, 'query': {'pages': [page]}}).encode()
+
+    def log_message(self, format, *args):
+        pass
+
+
 class WikiParserTestCase(unittest.TestCase):
     """These tests test the wiki parser in the get_users() function
     """
@@ -37,34 +148,354 @@ class WikiParserTestCase(unittest.TestCase):
         self.assertEqual(self.raw_users, output_get_users)
 
     def test_internet(self):
-        # Mock out the internet connection using an offline copy
-        def mock_urlopen(url):
-            with open('tests/ArchMap_List-stripped.html', 'rb') as test_page:
-                test_string = io.BytesIO(test_page.read())
-            return test_string
-
-        # Reassign the 'urlopen' function to use the mock one
-        archmap.urlopen = mock_urlopen
+        # Stand in for the ArchWiki using an offline copy
+        server = StandInServer({'/wiki': open(self.wiki_html, 'rb').read()})
+        self.addCleanup(server.stop)
 
         # Check that the returned string equals the raw text
-        self.assertEqual(self.raw_users, archmap.get_users())
-
-        # Restore the original call
-        archmap.urlopen = urllib.request.urlopen
+        self.assertEqual(self.raw_users, archmap.get_users(url=server.url('/wiki')))
 
     def test_error(self):
-        # Fake an error when the function is called
-        def mock_error(url):
-            raise urllib.error.URLError('Simulated test error')
+        # Check that the function returns 'None' when there is a connection error
+        server = StandInServer({})
+        self.addCleanup(server.stop)
+        self.assertIsNone(archmap.get_users(url=server.url('/wiki')))
 
-        # Reassign the 'urlopen' function to use the mock one
-        archmap.urlopen = mock_error
+    def test_no_list(self):
+        with open('tests/sample-raw.txt', 'r') as raw_users:
+            self.assertIsNone(archmap.get_users(local=raw_users.name))
+
+    def test_extractor_pieces(self):
+        # Feeding the page one character at a time should give the same result as feeding it all at once
+        with open(self.wiki_html, 'r') as wiki:
+            wiki_source = wiki.read()
+
+        extractor = archmap.PreExtractor()
+        for character in wiki_source:
+            extractor.feed(character)
+        extractor.close()
+        self.assertEqual(self.raw_users, extractor.text.strip())
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    """These tests test the connection reuse and decompression in ``ConnectionPool``
+    """
+
+    with open('tests/ArchMap_List-stripped.html', 'rb') as wiki_html:
+        wiki_html = wiki_html.read()
+
+    with open('tests/sample-raw.txt', 'r') as raw_users:
+        raw_users = raw_users.read().rstrip('\n')
+
+    def setUp(self):
+        self.server = StandInServer({'/wiki': self.wiki_html, '/gzip': self.wiki_html, '/deflate': self.wiki_html})
+        self.pool = archmap.ConnectionPool(chunk_size=64)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_keep_alive(self):
+        for _ in range(3):
+            self.assertEqual(self.raw_users, archmap.get_users(url=self.server.url('/wiki'), pool=self.pool))
+        self.assertEqual(1, self.server.connections)
+
+    def test_stale_connection(self):
+        archmap.get_users(url=self.server.url('/wiki'), pool=self.pool)
+        for connections in self.pool._idle.values():
+            for connection in connections:
+                connection.sock.close()
+        self.assertEqual(self.raw_users, archmap.get_users(url=self.server.url('/wiki'), pool=self.pool))
+
+    def proxy_environ(self, **proxies):
+        environ = {name: value for name, value in os.environ.items() if not name.lower().endswith('_proxy')}
+        environ.update(proxies)
+        return unittest.mock.patch.dict(os.environ, environ, clear=True)
+
+    def test_http_proxy(self):
+        proxy = StandInServer({'/wiki': self.wiki_html})
+        self.addCleanup(proxy.stop)
+        with self.proxy_environ(http_proxy=proxy.url('').replace('http://', 'http://user:p%40ss@')):
+            for _ in range(2):
+                self.assertEqual(self.raw_users, archmap.get_users(url='http://wiki.invalid/wiki', pool=self.pool))
+
+        self.assertEqual(['http://wiki.invalid/wiki'] * 2, proxy.requests)
+        self.assertEqual('wiki.invalid', proxy.headers[0]['Host'])
+        self.assertEqual('Basic dXNlcjpwQHNz', proxy.headers[0]['Proxy-Authorization'])
+        self.assertEqual(1, proxy.connections)
+        self.assertEqual([], self.server.requests)
+
+    def test_https_proxy(self):
+        proxy = StandInServer({})
+        self.addCleanup(proxy.stop)
+        with self.proxy_environ(https_proxy='127.0.0.1:{}'.format(proxy.server_address[1])):
+            with self.assertRaises(OSError):
+                list(self.pool.stream('https://wiki.invalid/wiki'))
+        self.assertEqual(['CONNECT wiki.invalid:443'], proxy.requests)
+
+    def test_no_proxy(self):
+        proxy = StandInServer({})
+        self.addCleanup(proxy.stop)
+        with self.proxy_environ(http_proxy=proxy.url(''), no_proxy='127.0.0.1'):
+            self.assertEqual(self.raw_users, archmap.get_users(url=self.server.url('/wiki'), pool=self.pool))
+        self.assertEqual([], proxy.requests)
+        self.assertEqual(['/wiki'], self.server.requests)
+
+    def test_compression(self):
+        self.assertEqual(self.raw_users, archmap.get_users(url=self.server.url('/gzip'), pool=self.pool))
+        self.assertEqual(self.raw_users, archmap.get_users(url=self.server.url('/deflate'), pool=self.pool))
+
+    def test_redirect(self):
+        self.assertEqual(self.raw_users, archmap.get_users(url=self.server.url('/redirect'), pool=self.pool))
+        self.assertEqual(['/redirect', '/wiki'], self.server.requests)
+
+    def test_partial_read(self):
+        # A response that isn't read to the end can't be reused
+        stream = self.pool.stream(self.server.url('/wiki'))
+        next(stream)
+        stream.close()
+        self.assertEqual({}, {key: value for key, value in self.pool._idle.items() if value})
+
+
+class LimitsTestCase(unittest.TestCase):
+    """These tests test the limits on the size of the lists and how long they take to parse, using oversized lists
+    """
+
+    line = '51.5,-0.12 "User" # London, UK'
+
+    def setUp(self):
+        self.page = ('<html><body><pre>\n' + '\n'.join([self.line] * 100000) + '\n</pre></body></html>').encode()
+        self.server = StandInServer({'/wiki': self.page, '/gzip': b'<pre>' + b'1' * 30000000})
+        self.pool = archmap.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_download(self):
+        users = archmap.get_users(url=self.server.url('/wiki'), pool=self.pool, max_bytes=100000)
+        lines = users.splitlines()
+        self.assertLess(len(lines), 100000 // len(self.line))
+        self.assertEqual({self.line}, set(lines))
+
+        # A page that isn't over the limit is read to the end
+        users = archmap.get_users(url=self.server.url('/wiki'), pool=self.pool, max_bytes=len(self.page))
+        self.assertEqual(100000, len(users.splitlines()))
+
+    def test_compressed(self):
+        # Only the limit is decompressed, however large the response would be
+        pieces = []
+        with self.assertRaises(archmap.DownloadLimitError):
+            for piece in self.pool.stream(self.server.url('/gzip'), max_bytes=1000000):
+                pieces.append(piece)
+        self.assertEqual(1000000, sum(len(piece) for piece in pieces))
+
+        # The page is cut off in the middle of a line, so that line is left out
+        self.assertEqual('', archmap.get_users(url=self.server.url('/gzip'), pool=self.pool, max_bytes=1000))
+
+    def test_local(self):
+        with open('tests/sample-raw.txt', 'r') as raw_users:
+            raw_lines = raw_users.read().splitlines()
+
+        users = archmap.get_users(local='tests/ArchMap_List-stripped.html', max_bytes=750)
+        self.assertEqual(raw_lines[:len(users.splitlines())], users.splitlines())
+        self.assertLess(len(users.splitlines()), len(raw_lines))
+
+    def test_multi(self):
+        lists = archmap.get_users_multi([self.server.url('/wiki')], max_bytes=1000)
+        self.assertEqual({self.line}, set(lists[0].splitlines()))
+
+    def test_api(self):
+        self.server.revision = (1234, '<pre>\n' + '\n'.join([self.line] * 1000) + '\n</pre>')
+        self.assertEqual((None, None), archmap.get_users_api(api=self.server.url('/api.php'), pool=self.pool,
+                                                             max_bytes=1000))
+        self.assertEqual(1234, archmap.get_users_api(api=self.server.url('/api.php'), pool=self.pool)[0])
+
+    def test_line_length(self):
+        report = archmap.ParseReport()
+        users = archmap.parse_users([self.line, '1,2 "' + 'x' * 1000000 + '"', self.line], report, max_line=100)
+        self.assertEqual(2, len(users))
+        self.assertEqual({'too long': 1}, report.reasons)
+        self.assertEqual([(2, '1,2 "' + 'x' * 95 + '...')], report.samples['too long'])
+
+    def test_users(self):
+        report = archmap.ParseReport()
+        self.assertEqual(3, len(archmap.parse_users('\n'.join([self.line] * 10), report, max_users=3)))
+        self.assertEqual(['stopped at line 4 after 3 users'], report.truncated)
+        self.assertIn('The list was cut off: stopped at line 4 after 3 users', report.summary())
+
+    def test_time_limit(self):
+        report = archmap.ParseReport()
+        self.assertEqual(999, len(archmap.parse_users([self.line] * 5000, report, time_limit=0)))
+        self.assertEqual(['stopped at line 1000 after 0 seconds'], report.truncated)
+
+    def test_pipeline(self):
+        pipeline = archmap.Pipeline(lambda: ['\n'.join([self.line] * 10)] * 2, parse_options={'max_users': 4})
+        pipeline.register_sink('counter', len)
+        # Each list is limited on its own and the same users are merged together
+        self.assertEqual({'counter': 1}, pipeline.run())
+        self.assertEqual(2, len(pipeline.parse_report.truncated))
+
+
+class MultiSourceTestCase(unittest.TestCase):
+    """These tests test fetching and merging several lists with ``get_users_multi()`` and ``merge_users()``
+    """
+
+    with open('tests/ArchMap_List-stripped.html', 'rb') as wiki_html:
+        wiki_html = wiki_html.read()
+
+    with open('tests/sample-raw.txt', 'r') as raw_users:
+        raw_users = raw_users.read().rstrip('\n')
+
+    mirror_html = b'<html><pre>1,2 "Mirror user" # Somewhere else</pre></html>'
+
+    def setUp(self):
+        self.server = StandInServer({'/wiki': self.wiki_html,
+                                     '/mirror': self.mirror_html,
+                                     '/slow': self.wiki_html,
+                                     '/flaky': self.mirror_html}, delay=2, failures=1)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_concurrent_sources(self):
+        sources = [self.server.url('/wiki'), 'tests/ArchMap_List-stripped.html', self.server.url('/mirror')]
+        results = archmap.get_users_multi(sources, timeout=5, retries=0)
+        self.assertEqual([self.raw_users, self.raw_users, '1,2 "Mirror user" # Somewhere else'], results)
+
+    def test_timeout(self):
+        start = time.monotonic()
+        results = archmap.get_users_multi([self.server.url('/slow'), self.server.url('/wiki')], timeout=0.5, retries=0)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual([None, self.raw_users], results)
+
+    def test_retries_one_at_a_time(self):
+        running = []
+        most_running = []
+
+        def slow_failure(**options):
+            running.append(options)
+            most_running.append(len(running))
+            time.sleep(0.3)
+            running.remove(options)
+            return None
+
+        with unittest.mock.patch('archmap.get_users', side_effect=slow_failure) as get_users:
+            self.assertEqual([None], archmap.get_users_multi([self.server.url('/wiki')], timeout=0.1, retries=2))
+        self.assertEqual(3, get_users.call_count)
+        self.assertEqual([1, 1, 1], most_running)
+
+    def test_retries(self):
+        self.assertEqual([None], archmap.get_users_multi([self.server.url('/flaky')], timeout=5, retries=0))
+        self.server.requests.clear()
+        results = archmap.get_users_multi([self.server.url('/flaky')], timeout=5, retries=1)
+        self.assertEqual(['1,2 "Mirror user" # Somewhere else'], results)
+        self.assertEqual(['/flaky', '/flaky'], self.server.requests)
+
+    def test_missing_sources(self):
+        sources = [self.server.url('/missing'), 'tests/missing.html']
+        self.assertEqual([None, None], archmap.get_users_multi(sources, timeout=5, retries=1))
+
+    def test_merge(self):
+        wiki_users = archmap.parse_users(self.raw_users)
+        mirror_users = archmap.parse_users('1,2 "Mirror user" # Somewhere else\n' + self.raw_users)
+        merged = archmap.merge_users(wiki_users, mirror_users)
+        self.assertEqual(wiki_users + [mirror_users[0]], merged)
+
+    def test_interactive(self):
+        output = io.StringIO()
+        sys.argv = ['test',
+                    '--file', 'tests/ArchMap_List-stripped.html',
+                    '--source', self.server.url('/mirror'),
+                    '--source', self.server.url('/wiki'),
+                    '--text', '-',
+                    '--geojson', 'no',
+                    '--kml', 'no',
+                    '--csv', 'no']
+        with contextlib.redirect_stdout(output):
+            archmap.main()
+
+        merged_users = archmap.parse_users(self.raw_users) + archmap.parse_users('1,2 "Mirror user" # Somewhere else')
+        self.assertEqual(archmap.make_text(merged_users) + '\n', output.getvalue())
 
-        # Check that the function returns 'None' when there is a connection error
-        self.assertIsNone(archmap.get_users())
 
-        # Restore the original call
-        archmap.urlopen = urllib.request.urlopen
+class WikiApiTestCase(unittest.TestCase):
+    """These tests test getting the wikitext from the MediaWiki API with ``get_users_api()``
+    """
+
+    with open('tests/sample-raw.txt', 'r') as raw_users:
+        raw_users = raw_users.read().rstrip('\n')
+
+    wikitext = ('== Adding yourself to the list ==\n'
+                '<pre>&lt;latitude&gt;,&lt;longitude&gt; "&lt;name&gt;" # &lt;comment&gt;</pre>\n'
+                '== List ==\n'
+                '<pre>\n' + raw_users + '\n</pre>\n')
+
+    def setUp(self):
+        self.server = StandInServer({}, revision=(1234, self.wikitext))
+        self.revision_file = 'tests/output-revision.txt'
+        self.output_csv = 'tests/output-api.csv'
+
+    def tearDown(self):
+        self.server.stop()
+        for output_file in (self.revision_file, self.output_csv):
+            try:
+                os.remove(output_file)
+            except FileNotFoundError:
+                pass
+
+    def test_wikitext(self):
+        self.assertEqual((1234, self.raw_users), archmap.get_users_api(api=self.server.url('/api.php')))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_unchanged_revision(self):
+        self.assertEqual((1234, None), archmap.get_users_api(api=self.server.url('/api.php'), revision=1234))
+        self.assertEqual(1, len(self.server.requests))
+        self.assertNotIn('content', self.server.requests[0])
+
+    def test_bad_response(self):
+        self.server.pages['/wiki'] = b'<html><pre>Not JSON</pre></html>'
+        self.assertEqual((None, None), archmap.get_users_api(api=self.server.url('/wiki')))
+
+        self.server.revision = (1235, 'The list has been removed')
+        self.assertEqual((None, None), archmap.get_users_api(api=self.server.url('/api.php')))
+
+    def test_interactive(self):
+        sys.argv = ['test',
+                    '--config', '/dev/null',
+                    '--api', self.server.url('/api.php'),
+                    '--text', '-',
+                    '--geojson', 'no',
+                    '--kml', 'no',
+                    '--csv', 'no']
+
+        with open('tests/sample-archmap.txt', 'r') as file:
+            sample_text = file.read() + '\n'
+
+        archmap.write_revision(self.revision_file, 1000)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), unittest.mock.patch('archmap.default_revision', self.revision_file):
+            archmap.main()
+            self.assertEqual(sample_text, output.getvalue())
+            self.assertEqual(1234, archmap.read_revision(self.revision_file))
+
+            # The second run should stop after checking the revision
+            archmap.main()
+            self.assertEqual(sample_text, output.getvalue())
+
+            # Unless it is forced, or the outputs have changed since the last run
+            sys.argv.append('--force')
+            archmap.main()
+            self.assertEqual(sample_text * 2, output.getvalue())
+
+            sys.argv[sys.argv.index('--csv') + 1] = self.output_csv
+            sys.argv.remove('--force')
+            archmap.main()
+            self.assertEqual(sample_text * 3, output.getvalue())
+            self.assertTrue(os.path.isfile(self.output_csv))
+
+            archmap.main()
+            self.assertEqual(sample_text * 3, output.getvalue())
 
 
 class ListParserTestCase(unittest.TestCase):
@@ -97,6 +528,322 @@ class ListParserTestCase(unittest.TestCase):
         self.assertEqual(self.sample_parsed_users, parsed_cleaned_users)
 
 
+class ParseReportTestCase(unittest.TestCase):
+    """These tests test the ``ParseReport`` of the lines that couldn't be parsed
+    """
+
+    with open('tests/sample-raw.txt', 'r') as raw_users_file:
+        raw_users = raw_users_file.read()
+
+    def setUp(self):
+        self.output_report = 'tests/output-parse_report.json'
+
+    def tearDown(self):
+        logging.disable(60)
+        try:
+            os.remove(self.output_report)
+        except FileNotFoundError:
+            pass
+
+    def test_reasons(self):
+        report = archmap.ParseReport()
+        users = archmap.parse_users(self.raw_users + '\n\n1..5,2 "User 11" #\n1,2 User 12 #\n1,2 "User 13 #', report)
+        self.assertEqual(8, len(users))
+        self.assertEqual(14, report.lines)
+        self.assertEqual(6, report.bad_lines)
+        self.assertEqual({'bad coordinates': 3, 'missing coordinates': 1, 'missing quotes': 2}, report.reasons)
+        self.assertEqual([(9, '10.5,  "User 8" # Unknown'), (10, ',20.5 "User 9" # Unknown'), (14, '1..5,2 "User 11" #')],
+                         report.samples['bad coordinates'])
+        self.assertEqual([(15, '1,2 User 12 #'), (16, '1,2 "User 13 #')], report.samples['missing quotes'])
+        self.assertEqual([(11, '"User 10" # Unknown')], report.samples['missing coordinates'])
+
+    def test_samples(self):
+        report = archmap.ParseReport(max_samples=2)
+        archmap.parse_users('bad\n' * 10 + '1,2 "User" #', report)
+        self.assertEqual({'missing quotes': 10}, report.reasons)
+        self.assertEqual([(1, 'bad'), (2, 'bad')], report.samples['missing quotes'])
+        self.assertAlmostEqual(10 / 11, report.ratio)
+
+    def test_logged_once(self):
+        logging.disable(logging.NOTSET)
+        with self.assertLogs(logger=archmap.log, level='ERROR') as logcatcher:
+            archmap.parse_users(self.raw_users + '\nbad\n' * 1000)
+        self.assertEqual(1, len(logcatcher.output))
+        self.assertTrue(logcatcher.output[0].startswith(
+            'ERROR:archmap:Skipped 1003 bad lines of 1011 (1000 missing quotes, 2 bad coordinates, 1 missing coordinates)'))
+
+    def test_file(self):
+        report = archmap.ParseReport()
+        archmap.parse_users(self.raw_users, report)
+        report.write(self.output_report)
+        with open(self.output_report, 'r') as file:
+            self.assertEqual({'lines': 11,
+                              'bad_lines': 3,
+                              'reasons': {'bad coordinates': 2, 'missing coordinates': 1},
+                              'samples': {'bad coordinates': [{'line': 9, 'text': '10.5,  "User 8" # Unknown'},
+                                                              {'line': 10, 'text': ',20.5 "User 9" # Unknown'}],
+                                          'missing coordinates': [{'line': 11, 'text': '"User 10" # Unknown'}]},
+                              'truncated': []},
+                             json.load(file))
+
+    def test_threshold(self):
+        sources = [self.raw_users]
+        pipeline = archmap.Pipeline(lambda: list(sources), max_bad_lines=0.3)
+        pipeline.register_sink('count', len)
+        self.assertEqual({'count': 8}, pipeline.run())
+
+        sources.append('bad\n' * 5)
+        self.assertIsNone(pipeline.run())
+        self.assertEqual(8, pipeline.parse_report.bad_lines)
+        self.assertEqual(8, len(pipeline.users))
+
+
+class RawFileTestCase(unittest.TestCase):
+    """These tests test reading raw-text lists with ``read_users()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        sample_parsed_users = pickle.load(pickled_input)
+
+    def setUp(self):
+        self.output_raw = 'tests/output-raw.txt'
+
+    def tearDown(self):
+        try:
+            os.remove(self.output_raw)
+        except FileNotFoundError:
+            pass
+
+    def write_raw(self, raw_bytes):
+        with open(self.output_raw, 'wb') as file:
+            file.write(raw_bytes)
+
+    def test_raw_file(self):
+        with open('tests/sample-raw.txt', 'r') as raw_users:
+            self.assertEqual(raw_users.read().splitlines(), list(archmap.read_users('tests/sample-raw.txt')))
+        self.assertEqual(self.sample_parsed_users, archmap.parse_users(archmap.read_users('tests/sample-raw.txt')))
+
+    def test_line_endings(self):
+        self.write_raw('1,2 "User 0" # Ünïcödé\r\n3,4 "User 1" #\n\n5,6 "User 2" # No newline'.encode())
+        self.assertEqual(['1,2 "User 0" # Ünïcödé', '3,4 "User 1" #', '', '5,6 "User 2" # No newline'],
+                         list(archmap.read_users(self.output_raw)))
+
+    def test_empty_file(self):
+        self.write_raw(b'')
+        self.assertEqual([], list(archmap.read_users(self.output_raw)))
+
+    def test_max_line(self):
+        self.write_raw('1,2 "User 0"\n3,4 "{}"\r\n5,6 "User 2"'.format('\u00dc' * 100).encode())
+        lines = list(archmap.read_users(self.output_raw, max_line=20))
+        self.assertEqual(['1,2 "User 0"', '5,6 "User 2"'], [lines[0], lines[2]])
+        self.assertGreater(len(lines[1]), 20)
+        self.assertLessEqual(len(lines[1]), 90)
+        self.assertTrue(lines[1].startswith('3,4 "\u00dc\u00dc'))
+
+        # Lines that might fit in the limit are read whole, for 'parse_users()' to check
+        self.assertEqual(['1,2 "User 0"', '3,4 "{}"'.format('\u00dc' * 100), '5,6 "User 2"'],
+                         list(archmap.read_users(self.output_raw, max_line=100)))
+
+    def test_max_line_memory(self):
+        with open(self.output_raw, 'wb') as file:
+            file.write(b'1,2 "User 0"\n3,4 "')
+            for _ in range(50):
+                file.write(b'x' * 1000000)
+            file.write(b'"\n5,6 "User 2"\n')
+
+        report = archmap.ParseReport()
+        tracemalloc.start()
+        try:
+            users = archmap.parse_users(archmap.read_users(self.output_raw, max_line=1000), report, max_line=1000)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(['User 0', 'User 2'], [user.name for user in users])
+        self.assertEqual({'too long': 1}, report.reasons)
+        # The 50 MB line is never copied into memory
+        self.assertLess(peak, 1000000)
+
+    def test_interactive(self):
+        output = io.StringIO()
+        sys.argv = ['test',
+                    '--raw', 'tests/sample-raw.txt',
+                    '--text', '-',
+                    '--geojson', 'no',
+                    '--kml', 'no',
+                    '--csv', 'no']
+        with contextlib.redirect_stdout(output):
+            archmap.main()
+
+        with open('tests/sample-archmap.txt', 'r') as file:
+            self.assertEqual(file.read() + '\n', output.getvalue())
+
+
+class LineParserTestCase(unittest.TestCase):
+    """These tests check that ``parse_line()`` splits lines exactly the same way as the original 8-group expression
+    """
+
+    re_coord = r'((\-?\d+)\.*(\d+)?)'
+    re_whole = re.compile(str(re_coord + r'\s*,\s*' + re_coord + r'[^a-zA-Z]*' + r'"(.*)"' + r'\s*#*\s*' + r'(.*)'))
+
+    # Pieces that the fuzzed lines are built from, weighted towards the characters that matter to the parser
+    pieces = ['1', '23', '4.5', '-', '.', '..', ',', ' ', '\t', '\u00a0', '"', '#', '##', 'a', 'Z', 'é', '٣', ';', '(', '']
+
+    def original_parse_line(self, line):
+        match = self.re_whole.fullmatch(line)
+        if match is None:
+            return None
+        return match.group(1), match.group(4), match.group(7).strip(), match.group(8).strip()
+
+    def assertSameAsOriginal(self, lines):
+        for line in lines:
+            self.assertEqual(self.original_parse_line(line), archmap.parse_line(line), msg=repr(line))
+
+    def test_fixtures(self):
+        for fixture in ('tests/sample-raw.txt', 'tests/sample-archmap.txt', 'tests/sample-archmap_pretty.txt'):
+            with open(fixture, 'r') as file:
+                self.assertSameAsOriginal(file.read().splitlines())
+
+    def test_fuzzed_lines(self):
+        fuzz = random.Random(29)
+        lines = []
+
+        for _ in range(20000):
+            # Start from something close to a valid line and mangle a few parts of it
+            parts = [fuzz.choice(['1', '-12.5', '3..', '']), fuzz.choice([',', ' , ', '']),
+                     fuzz.choice(['4', '-0.5', '7.', '']), fuzz.choice([' ', '  "', '1 ', '']),
+                     '"', fuzz.choice(['User', ' A "B" ', '']), '"',
+                     fuzz.choice([' # ', '#', ' ', '']), fuzz.choice(['London, UK', '', '"', ' ##x '])]
+            for _ in range(fuzz.randrange(3)):
+                parts.insert(fuzz.randrange(len(parts) + 1), fuzz.choice(self.pieces))
+            lines.append(''.join(parts))
+
+            # And some lines that are completely random
+            lines.append(''.join(fuzz.choice(self.pieces) for _ in range(fuzz.randrange(12))))
+
+        self.assertSameAsOriginal(lines)
+        self.assertGreater(sum(archmap.parse_line(line) is not None for line in lines), 5000)
+
+    def test_long_lines(self):
+        # These used to backtrack for minutes, they should be split as quickly as any other line
+        self.assertIsNone(archmap.parse_line('1,' + '1' * 50000 + ' x'))
+        self.assertIsNone(archmap.parse_line('1,1' + '.' * 50000 + 'x"a"b"'))
+        self.assertEqual(('1', '1' * 50000, 'a"b', ''), archmap.parse_line('1,' + '1' * 50000 + ' "a"b"'))
+        self.assertEqual(('1', '1', 'a" # ' + '"' * 49999, ''), archmap.parse_line('1,1 "a" # ' + '"' * 50000))
+
+
+class CleanTextTestCase(unittest.TestCase):
+    """These tests test the normalizing and escaping of names and comments
+    """
+
+    def test_normalize(self):
+        self.assertEqual('Caf\u00e9', archmap.clean_text('Cafe\u0301'))
+        self.assertEqual('\u00c5ngstr\u00f6m', archmap.clean_text('\u212bngstro\u0308m'))
+
+    def test_control_characters(self):
+        self.assertEqual('ab', archmap.clean_text('a\x00b\x7f\x85'))
+        self.assertEqual('Name', archmap.clean_text('Name \x07'))
+        self.assertEqual('tab', archmap.clean_text('t\tab'))
+
+    def test_unchanged(self):
+        text = 'Plain ASCII'
+        self.assertIs(text, archmap.clean_text(text))
+        self.assertIs(text, archmap.escape_xml(text))
+        self.assertEqual('A &amp; &lt;B&gt; "C"', archmap.escape_xml('A & <B> "C"'))
+
+    def test_parse_users(self):
+        users = archmap.parse_users('1,2 "Jose\u0301\x1b[31m" # Hi\x00 there\n3,4 "Plain" # Text')
+        self.assertEqual(['Jos\u00e9[31m', 'Plain'], [user.name for user in users])
+        self.assertEqual(['Hi there', 'Text'], [user.comment for user in users])
+        self.assertIn('<name>Jos\u00e9[31m</name>', archmap.make_kml(users))
+
+
+class ValidationTestCase(unittest.TestCase):
+    """These tests test the invalid and duplicate user checks in ``validate_users()``
+    """
+
+    users = archmap.parse_users('10,10 "User 0" # First\n'
+                                '91,10 "User 1" # Too far north\n'
+                                '10,-180.5 "User 2" # Too far west\n'
+                                '10,10 "User 0" # Same place again\n'
+                                '10.005,9.995 "User 0" # Nearby\n'
+                                '10.005,9.995 "User 3" # Nearby, different name\n'
+                                '10.02,10 "User 0" # Further away\n'
+                                '-90,180 "User 4" # On the edge\n')
+
+    def test_drop(self):
+        users, report = archmap.validate_users(self.users)
+        self.assertEqual([self.users[0], self.users[5], self.users[6], self.users[7]], users)
+        self.assertEqual([self.users[1], self.users[2]], report.invalid)
+        self.assertEqual([self.users[3]], report.duplicates)
+        self.assertEqual([self.users[4]], report.nearby)
+
+    def test_flag(self):
+        users, report = archmap.validate_users(self.users, drop=False)
+        self.assertEqual(self.users, users)
+        self.assertEqual(2, len(report.invalid))
+        self.assertEqual(1, len(report.duplicates))
+        self.assertEqual(1, len(report.nearby))
+
+    def test_exact_only(self):
+        users, report = archmap.validate_users(self.users, nearby=0)
+        self.assertEqual([], report.nearby)
+        self.assertIn(self.users[4], users)
+
+    def test_cell_boundaries(self):
+        # Users either side of a grid line should still be found
+        users = archmap.parse_users('-0.001,0.009 "User" #\n0.005,0.011 "User" #')
+        self.assertEqual(users[:1], archmap.validate_users(users)[0])
+
+    def test_sample_unchanged(self):
+        with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+            parsed_users = pickle.load(pickled_input)
+        self.assertEqual((parsed_users, ([], [], [])), archmap.validate_users(parsed_users))
+
+    @staticmethod
+    def remove(output_file):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(output_file)
+
+    def run_main(self, **extras):
+        config_file = 'tests/output-validate.conf'
+        raw_file = 'tests/output-validate.txt'
+        output_csv = 'tests/output-validate.csv'
+        for output_file in (config_file, raw_file, output_csv):
+            self.addCleanup(self.remove, output_file)
+
+        with open(config_file, 'w') as file:
+            file.write('[extras]\n' + ''.join('{} = {}\n'.format(*option) for option in extras.items()))
+        with open(raw_file, 'w') as file:
+            file.write(archmap.make_text(self.users))
+        sys.argv = ['test',
+                    '--config', config_file,
+                    '--raw', raw_file,
+                    '--csv', output_csv,
+                    '--text', 'no',
+                    '--geojson', 'no',
+                    '--kml', 'no']
+
+        with contextlib.redirect_stderr(io.StringIO()) as error:
+            try:
+                archmap.main()
+            except SystemExit:
+                return None, error.getvalue()
+        with open(output_csv, 'r') as file:
+            return len(file.read().splitlines()) - 1, error.getvalue()
+
+    def test_main_default(self):
+        # The users are only flagged unless dropping them is asked for
+        self.assertEqual(8, self.run_main()[0])
+        self.assertEqual(4, self.run_main(validate='drop')[0])
+
+    def test_main_bad_settings(self):
+        self.assertIn("validate has to be 'drop', 'flag' or 'no'", self.run_main(validate='remove')[1])
+        for nearby in ('0', '-0.01', 'NaN', 'near'):
+            with self.subTest(nearby=nearby):
+                self.assertIn('nearby has to be a number of degrees more than 0', self.run_main(nearby=nearby)[1])
+
+
 class OutputTestCase(unittest.TestCase):
     """These tests compare the output of ``make_text()``, ``make_geojson()``, ``make_kml()``  and ``make csv()``
     with pre-generated versions that have been checked manually, these *sample* files were
@@ -241,6 +988,1118 @@ class ReturnedTestCase(unittest.TestCase):
         self.assertEqual(sample_csv, returned_csv)
 
 
+class OutputReaderTestCase(unittest.TestCase):
+    """These tests test reading the users back from the CSV, GeoJSON and KML outputs
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    users = [archmap.Entry(Decimal('1.50'), Decimal('-2'), 'A & <B> "C"', ''),
+             archmap.Entry(Decimal('-45.125'), Decimal('179.9999999'), 'Jos\u00e9, "Pepe"', 'Line one\nLine two')]
+
+    def setUp(self):
+        self.output_file = 'tests/output-reader'
+
+    def tearDown(self):
+        for extension in ('.csv', '.geojson', '.kml', '.txt'):
+            try:
+                os.remove(self.output_file + extension)
+            except FileNotFoundError:
+                pass
+
+    def test_samples(self):
+        self.assertEqual(self.parsed_users, archmap.read_csv('tests/sample-archmap.csv'))
+        self.assertEqual(self.parsed_users, archmap.read_geojson('tests/sample-archmap.geojson'))
+        self.assertEqual(self.parsed_users, archmap.read_kml('tests/sample-archmap.kml'))
+        self.assertEqual(self.parsed_users, archmap.read_output('tests/sample-archmap.geojson'))
+
+    def test_round_trip(self):
+        writers = {'.csv': archmap.make_csv, '.geojson': archmap.make_geojson, '.kml': archmap.make_kml}
+        for extension, writer in writers.items():
+            for options in ({}, {'compact': True}):
+                if extension == '.csv' and options:
+                    continue
+                with self.subTest(extension=extension, **options):
+                    writer(self.users, output_file=self.output_file + extension, **options)
+                    self.assertEqual(self.users, archmap.read_output(self.output_file + extension))
+
+    def test_other_kml(self):
+        # A placemark that isn't laid out like the ones from make_kml() is read with an XML parser
+        with open(self.output_file + '.kml', 'w') as kml:
+            kml.write('<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                      '<Placemark><Point><coordinates> 2.5,1 </coordinates></Point><name><![CDATA[A & B]]></name>'
+                      '</Placemark></Document></kml>')
+        self.assertEqual([archmap.Entry(Decimal('1'), Decimal('2.5'), 'A & B', '')],
+                         archmap.read_kml(self.output_file + '.kml'))
+
+    def test_csv_columns(self):
+        archmap.make_csv(self.users, output_file=self.output_file + '.csv', columns=('name', 'longitude', 'latitude'),
+                         precision=2)
+        self.assertEqual([archmap.Entry(Decimal('1.50'), Decimal('-2.00'), 'A & <B> "C"', ''),
+                          archmap.Entry(Decimal('-45.12'), Decimal('180.00'), 'Jos\u00e9, "Pepe"', '')],
+                         archmap.read_csv(self.output_file + '.csv'))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            archmap.read_output(self.output_file + '.txt')
+
+        archmap.make_csv(self.users, output_file=self.output_file + '.csv', columns=('name', 'comment'))
+        with self.assertRaises(ValueError):
+            archmap.read_csv(self.output_file + '.csv')
+
+        with open(self.output_file + '.kml', 'w') as kml:
+            kml.write('<kml><Document>')
+        with self.assertRaises(ValueError):
+            archmap.read_kml(self.output_file + '.kml')
+
+        with open(self.output_file + '.geojson', 'w') as geojson:
+            geojson.write('{"features": [{"geometry": null}]}')
+        with self.assertRaises(ValueError):
+            archmap.read_geojson(self.output_file + '.geojson')
+
+    def test_pipeline(self):
+        pipeline = archmap.Pipeline(lambda: [archmap.read_output('tests/sample-archmap.kml')])
+        pipeline.register_sink('text', archmap.make_text)
+        self.assertEqual(archmap.make_text(self.parsed_users), pipeline.run()['text'])
+
+    def test_main(self):
+        sys.argv = ['test',
+                    '--config', '/dev/null',
+                    '--load', 'tests/sample-archmap.geojson',
+                    '--text', self.output_file + '.txt',
+                    '--geojson', 'no',
+                    '--kml', 'no',
+                    '--csv', 'no']
+
+        archmap.main()
+        with open(self.output_file + '.txt', 'r') as text, open('tests/sample-archmap.txt', 'r') as sample:
+            self.assertEqual(sample.read().rstrip('\n'), text.read().rstrip('\n'))
+
+
+class KMLTestCase(unittest.TestCase):
+    """These tests test the escaping and thread-safety of ``make_kml()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    with open('tests/sample-archmap.kml', 'r') as file:
+        sample_kml = file.read()
+
+    def test_escaping(self):
+        users = [archmap.Entry(Decimal('1'), Decimal('2'), 'A & <B>', '"Quoted" </description>')]
+        kml = archmap.make_kml(users)
+        self.assertIn('<name>A &amp; &lt;B&gt;</name>', kml)
+        self.assertIn('<description>"Quoted" &lt;/description&gt;</description>', kml)
+
+    def test_compact(self):
+        kml = archmap.make_kml(self.parsed_users, compact=True)
+        self.assertEqual(re.sub(r'\n *|<description/>', '', self.sample_kml) + '\n', kml)
+
+    def test_threads(self):
+        # Each call numbers its own elements, so calls from different threads can't change each other's output.
+        outputs = []
+        lengths = [1, 3, 8]
+
+        def make_kmls(length):
+            for _ in range(50):
+                outputs.append((length, archmap.make_kml(self.parsed_users[:length])))
+
+        threads = [threading.Thread(target=make_kmls, args=(length,)) for length in lengths * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expected = {length: archmap.make_kml(self.parsed_users[:length]) for length in lengths}
+        self.assertEqual(len(threads) * 50, len(outputs))
+        for length, output in outputs:
+            self.assertEqual(expected[length], output)
+        self.assertEqual(self.sample_kml, archmap.make_kml(self.parsed_users))
+
+
+class CSVOptionsTestCase(unittest.TestCase):
+    """These tests test the column, precision, encoding and batching options of ``make_csv()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def setUp(self):
+        self.output_csv = 'tests/output-archmap.csv'
+
+    def tearDown(self):
+        try:
+            os.remove(self.output_csv)
+        except FileNotFoundError:
+            pass
+
+    def test_streamed_batches(self):
+        with open('tests/sample-archmap.csv', 'r') as file:
+            sample_csv = file.read()
+
+        for batch_size in (1, 3, 1000):
+            self.assertIsNone(archmap.make_csv(iter(self.parsed_users), self.output_csv, batch_size=batch_size,
+                                               stream=True))
+            with open(self.output_csv, 'r') as file:
+                self.assertEqual(sample_csv, file.read())
+
+    def test_returned_text(self):
+        # Without 'stream' the text is still returned when it is written to a file
+        returned_csv = archmap.make_csv(self.parsed_users, self.output_csv)
+        with open(self.output_csv, 'r') as file:
+            self.assertEqual(file.read(), returned_csv)
+
+    def test_columns(self):
+        output = archmap.make_csv(self.parsed_users[:2], columns=('longitude', 'latitude'))
+        self.assertEqual('Longitude,Latitude\n-0.1276474,51.5073219\n18.4172485,-33.9289049\n', output)
+
+    def test_precision(self):
+        output = archmap.make_csv(self.parsed_users[:2] + self.parsed_users[-1:], precision=3)
+        self.assertEqual('Latitude,Longitude,Name,Comment\n'
+                         '51.507,-0.128,User 0,"London, UK"\n'
+                         '-33.929,18.417,User 1,"Cape Town, South Africa"\n'
+                         '20.000,20.000,User 7,\n', output)
+
+    def test_encoding(self):
+        archmap.make_csv(self.parsed_users[5:6], self.output_csv, columns=('comment',), encoding='latin-1', buffering=1)
+        with open(self.output_csv, 'rb') as file:
+            self.assertEqual('Comment\n"Brasília, Brazil"\n'.encode('latin-1'), file.read())
+
+
+class PrecisionTestCase(unittest.TestCase):
+    """These tests test ``round_users()`` and the compact GeoJSON and KML output
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def test_round_users(self):
+        rounded_users = archmap.round_users(self.parsed_users, 4)
+        self.assertEqual(Decimal('51.5073'), rounded_users[0].latitude)
+        self.assertEqual(Decimal('-0.1276'), rounded_users[0].longitude)
+        self.assertEqual(Decimal('10'), rounded_users[6].latitude)
+        self.assertEqual(self.parsed_users[0].name, rounded_users[0].name)
+
+    def test_trailing_zeros(self):
+        users = [archmap.Entry(Decimal('51.50001'), Decimal('-0.99999'), 'User', '')]
+        rounded_users = archmap.round_users(users, 4)
+        self.assertEqual('51.5', str(rounded_users[0].latitude))
+        self.assertEqual('-1', str(rounded_users[0].longitude))
+
+    def test_negative_precision(self):
+        with self.assertRaises(ValueError):
+            archmap.round_users(self.parsed_users, -1)
+
+        config_file = 'tests/output-precision.conf'
+        with open(config_file, 'w') as file:
+            file.write('[csv]\nprecision = -2\n')
+        self.addCleanup(os.remove, config_file)
+
+        for option in (['--precision', '-1'], ['--config', config_file]):
+            with self.subTest(option=option):
+                sys.argv = ['test', '--config', '/dev/null', '--raw', 'tests/sample-raw.txt', '--text', '-',
+                            '--geojson', 'no', '--kml', 'no', '--csv', 'no'] + option
+                with contextlib.redirect_stderr(io.StringIO()) as error, self.assertRaises(SystemExit):
+                    archmap.main()
+                self.assertIn('number of decimal places (0 or more)', error.getvalue())
+
+    def test_rounded_geojson(self):
+        geojson = json.loads(archmap.make_geojson(archmap.round_users(self.parsed_users, 2)))
+        self.assertEqual([-0.13, 51.51], geojson['features'][0]['geometry']['coordinates'])
+
+    def test_compact_geojson(self):
+        output = archmap.make_geojson(self.parsed_users, compact=True)
+        self.assertNotIn('\n', output.rstrip('\n'))
+        self.assertNotIn(': ', output)
+        geojson = json.loads(output)
+        self.assertEqual({'Name': 'User 7'}, geojson['features'][7]['properties'])
+        self.assertEqual(json.loads(archmap.make_geojson(self.parsed_users))['features'][:7], geojson['features'][:7])
+        self.assertLess(len(output), len(archmap.make_geojson(self.parsed_users)))
+
+    def test_compact_kml(self):
+        output = archmap.make_kml(self.parsed_users, compact=True)
+        self.assertNotIn('\n    ', output)
+        self.assertEqual(7, output.count('<description>'))
+        self.assertLess(len(output), len(archmap.make_kml(self.parsed_users)))
+
+
+class SortTestCase(unittest.TestCase):
+    """These tests test ``geohash()`` and ``sort_users()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def test_geohash(self):
+        self.assertEqual('u4pruydqqvj', archmap.geohash(Decimal('57.64911'), Decimal('10.40744'), length=11))
+        self.assertEqual('gcpvj0e5csep', archmap.geohash(Decimal('51.5073219'), Decimal('-0.1276474')))
+        self.assertEqual('7zzzzzzzzzzz', archmap.geohash(Decimal('-0.0000001'), Decimal('-0.0000001')))
+
+    def test_sort_by_geohash(self):
+        sorted_users = list(archmap.sort_users(self.parsed_users))
+        hashes = [archmap.geohash(user.latitude, user.longitude) for user in sorted_users]
+        self.assertEqual(sorted(hashes), hashes)
+        self.assertCountEqual(self.parsed_users, sorted_users)
+
+    def test_sort_by_name(self):
+        users = [archmap.Entry(Decimal('1'), Decimal('1'), name, '') for name in ('b', 'A', 'a', 'C')]
+        self.assertEqual(['A', 'a', 'b', 'C'], [user.name for user in archmap.sort_users(users, key='name')])
+
+    def test_stable_order(self):
+        users = self.parsed_users * 3 + [user._replace(comment='Moved') for user in self.parsed_users]
+        expected = list(archmap.sort_users(users))
+
+        shuffled_users = list(users)
+        random.Random(0).shuffle(shuffled_users)
+        self.assertEqual(expected, list(archmap.sort_users(shuffled_users)))
+
+    def test_external_sort(self):
+        users = [archmap.Entry(Decimal(random.randint(-90000, 90000)) / 1000,
+                               Decimal(random.randint(-180000, 180000)) / 1000,
+                               'User {}'.format(number), '') for number in range(1000)]
+        expected = list(archmap.sort_users(users))
+
+        for run_size in (1, 7, 999, 1000):
+            with self.subTest(run_size=run_size):
+                self.assertEqual(expected, list(archmap.sort_users(iter(users), run_size=run_size)))
+
+    def test_bad_key(self):
+        with self.assertRaises(ValueError):
+            archmap.sort_users(self.parsed_users, key='comment')
+
+
+class FilterTestCase(unittest.TestCase):
+    """These tests test ``UserIndex``, ``RenderCache`` and ``Pipeline.render()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def test_bbox(self):
+        index = archmap.UserIndex(self.parsed_users)
+        self.assertEqual(self.parsed_users[:1], index.select(bbox=(-10, 35, 30, 60)))
+        self.assertEqual([self.parsed_users[3], self.parsed_users[4]], index.select(bbox=(130, 30, -60, 50)))
+        self.assertEqual(self.parsed_users[6:], index.select(bbox=(10, 10, 20, 20)))
+        self.assertEqual(self.parsed_users, index.select())
+
+    def test_prefix_and_limit(self):
+        names = ['Anna', 'bob', 'ann', 'Bo', 'an', 'Á', 'x', 'a']
+        users = [user._replace(name=name) for user, name in zip(self.parsed_users, names)]
+        index = archmap.UserIndex(users)
+        self.assertEqual(['Anna', 'ann'], [user.name for user in index.select(prefix='ANN')])
+        self.assertEqual(['Anna', 'ann', 'an', 'a'], [user.name for user in index.select(prefix='a')])
+        self.assertEqual(['Anna', 'ann'], [user.name for user in index.select(prefix='a', limit=2)])
+        self.assertEqual(['Anna'], [user.name for user in index.select(bbox=(-10, 35, 30, 60), prefix='a')])
+        self.assertEqual([], index.select(prefix='z'))
+
+    def test_random_areas(self):
+        # The index should find the same users as checking every one of them.
+        rand = random.Random(0)
+        users = [archmap.Entry(Decimal(rand.randint(-9000, 9000)) / 100, Decimal(rand.randint(-18000, 18000)) / 100,
+                               'User {}'.format(number), '') for number in range(1000)]
+        index = archmap.UserIndex(users, cell_size=7)
+        for _ in range(100):
+            west, east = rand.uniform(-180, 180), rand.uniform(-180, 180)
+            south, north = sorted((rand.uniform(-90, 90), rand.uniform(-90, 90)))
+            bbox = (Decimal(str(west)), Decimal(str(south)), Decimal(str(east)), Decimal(str(north)))
+            expected = [user for user in users if south <= user.latitude <= north and
+                        (west <= user.longitude <= east if west <= east else not east < user.longitude < west)]
+            self.assertEqual(expected, index.select(bbox=bbox))
+
+    def test_render_cache(self):
+        cache = archmap.RenderCache(max_size=10)
+        cache.put('a', '1234')
+        cache.put('b', '1234')
+        self.assertEqual('1234', cache.get('a'))
+        cache.put('c', '1234')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('1234', cache.get('a'))
+        self.assertEqual(8, cache.size)
+
+        cache.put('d', '12345678901')
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual('1234', cache.get('c'))
+
+    def test_render(self):
+        with open('tests/sample-raw.txt', 'r') as raw_users:
+            sources = [raw_users.read()]
+        pipeline = archmap.Pipeline(lambda: list(sources))
+        with self.assertRaises(ValueError):
+            pipeline.render(archmap.make_geojson)
+        pipeline.run()
+
+        expected = archmap.make_geojson(self.parsed_users[:1], compact=True)
+        with unittest.mock.patch('archmap.make_geojson', wraps=archmap.make_geojson) as make_geojson:
+            output = pipeline.render(make_geojson, bbox=(-10, 35, 30, 60), compact=True)
+            self.assertEqual(expected, output)
+            self.assertEqual(output, pipeline.render(make_geojson, bbox=(-10, 35, 30, 60), compact=True))
+            self.assertEqual(1, make_geojson.call_count)
+
+            pipeline.render(make_geojson, bbox=(-10, 35, 30, 60))
+            pipeline.render(make_geojson, prefix='user 1')
+            self.assertEqual(3, make_geojson.call_count)
+
+            # New users make a new generation, so the cached outputs aren't used.
+            sources.append('52,0 "User 8" #')
+            pipeline.run()
+            self.assertEqual(2, len(json.loads(pipeline.render(make_geojson, bbox=(-10, 35, 30, 60)))['features']))
+            self.assertEqual(4, make_geojson.call_count)
+
+    def test_render_snapshot(self):
+        with open('tests/sample-raw.txt', 'r') as raw_users:
+            sources = [raw_users.read()]
+        pipeline = archmap.Pipeline(lambda: list(sources))
+        pipeline.run()
+        expected = archmap.make_geojson(self.parsed_users[:1], compact=True)
+
+        # A run in the middle of a render doesn't mix the new users into the output cached for the old ones.
+        def run(key):
+            sources.append('52,0 "User 8" #')
+            pipeline.run()
+            return None
+
+        with unittest.mock.patch.object(pipeline.render_cache, 'get', side_effect=run):
+            self.assertEqual(expected, pipeline.render(archmap.make_geojson, bbox=(-10, 35, 30, 60), compact=True))
+        self.assertEqual(2, len(json.loads(pipeline.render(archmap.make_geojson, bbox=(-10, 35, 30, 60)))['features']))
+
+        with self.assertRaises(AttributeError):
+            pipeline.users = []
+
+
+class PipelineTestCase(unittest.TestCase):
+    """These tests test the ``Pipeline`` class
+    """
+
+    with open('tests/sample-raw.txt', 'r') as raw_users:
+        raw_users = raw_users.read()
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def setUp(self):
+        self.sources = [self.raw_users]
+        self.sink_calls = []
+        self.pipeline = archmap.Pipeline(lambda: list(self.sources))
+        self.pipeline.register_sink('counter', self.counting_sink)
+
+    def counting_sink(self, users):
+        self.sink_calls.append(users)
+        return len(users)
+
+    def test_outputs(self):
+        self.pipeline.register_sink('text', archmap.make_text, pretty=True)
+        outputs = self.pipeline.run()
+        self.assertEqual({'counter': 8, 'text': archmap.make_text(self.parsed_users, pretty=True)}, outputs)
+        self.assertEqual(self.parsed_users, self.pipeline.users)
+        self.assertEqual(outputs, self.pipeline.outputs)
+
+    def test_stages(self):
+        self.pipeline.stages = [partial(archmap.round_users, precision=1), lambda users: users[:2]]
+        self.assertEqual(2, self.pipeline.run()['counter'])
+        self.assertEqual(Decimal('51.5'), self.pipeline.users[0].latitude)
+
+    def test_sink_inputs(self):
+        self.pipeline.register_sink('ids', archmap.make_ids)
+        self.pipeline.register_sink('geojson', archmap.make_geojson, inputs={'ids': 'ids'}, compact=True)
+        self.pipeline.register_sink('cells', archmap.count_cells, cell_size=Decimal('30'))
+        self.pipeline.register_sink('grid', archmap.make_density_grid, uses='cells', cell_size=Decimal('30'))
+        outputs = self.pipeline.run()
+
+        self.assertEqual(archmap.make_geojson(self.parsed_users, compact=True, ids=outputs['ids']), outputs['geojson'])
+        self.assertEqual(archmap.make_density_grid(archmap.count_cells(self.parsed_users, Decimal('30')),
+                                                   cell_size=Decimal('30')), outputs['grid'])
+
+    def test_cache(self):
+        with unittest.mock.patch('archmap.parse_users', wraps=archmap.parse_users) as parse_users:
+            first_outputs = self.pipeline.run()
+            self.assertEqual(first_outputs, self.pipeline.run())
+            self.assertEqual(1, parse_users.call_count)
+            self.assertEqual(1, len(self.sink_calls))
+
+            # The same users from a differently formatted list are parsed again, but the sinks aren't run.
+            self.sources = [self.raw_users.replace(' # ', '   #   ')]
+            self.pipeline.run()
+            self.assertEqual(2, parse_users.call_count)
+            self.assertEqual(1, len(self.sink_calls))
+
+            self.sources = [self.raw_users, '1,1 "New user" #']
+            self.assertEqual(9, self.pipeline.run()['counter'])
+            self.assertEqual(2, len(self.sink_calls))
+
+            self.pipeline.run(force=True)
+            self.assertEqual(3, len(self.sink_calls))
+
+    def test_generation(self):
+        self.pipeline.run()
+        self.assertEqual(archmap.PublishGuard.content_hash(self.parsed_users), self.pipeline.generation)
+
+        # Different users always make a different generation, however the quote marks fall
+        self.sources = [[archmap.Entry(Decimal('1'), Decimal('1'), 'a', 'b" # c')]]
+        self.pipeline.run()
+        self.sources = [[archmap.Entry(Decimal('1'), Decimal('1'), 'a" # b', 'c')]]
+        self.pipeline.run()
+        self.assertEqual(3, len(self.sink_calls))
+
+    def test_missing_output(self):
+        output_text = 'tests/output-pipeline.txt'
+        self.addCleanup(os.remove, output_text)
+        self.pipeline.register_sink('text', archmap.make_text, output_file=output_text)
+        self.pipeline.run()
+        self.pipeline.run()
+        self.assertEqual(1, len(self.sink_calls))
+
+        # A file that was deleted since the last run is written again, the other sinks still use their cache
+        os.remove(output_text)
+        self.pipeline.run()
+        self.assertTrue(os.path.isfile(output_text))
+        self.assertEqual(1, len(self.sink_calls))
+
+    def test_replaced_sink(self):
+        self.pipeline.run()
+        self.pipeline.register_sink('counter', lambda users: 'replaced')
+        self.assertEqual({'counter': 'replaced'}, self.pipeline.run())
+
+    def test_no_users(self):
+        self.sources = [None, None]
+        self.assertIsNone(self.pipeline.run())
+        self.sources = []
+        self.assertIsNone(self.pipeline.run())
+        self.assertEqual([], self.sink_calls)
+
+
+class PublishGuardTestCase(unittest.TestCase):
+    """These tests test that the ``PublishGuard`` stops the outputs from being replaced when most of the users go
+    """
+
+    with open('tests/sample-raw.txt', 'r') as raw_users:
+        raw_users = raw_users.read()
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def setUp(self):
+        self.state_file = 'tests/output-state.json'
+        self.sources = [self.raw_users]
+        self.pipeline = archmap.Pipeline(lambda: list(self.sources), guard=archmap.PublishGuard(self.state_file))
+        self.pipeline.register_sink('counter', len)
+
+    def tearDown(self):
+        try:
+            os.remove(self.state_file)
+        except FileNotFoundError:
+            pass
+
+    def test_first_run(self):
+        self.assertEqual({'counter': 8}, self.pipeline.run())
+        with open(self.state_file, 'r') as state:
+            state = json.load(state)
+        self.assertEqual({'count': 8, 'hash': archmap.PublishGuard.content_hash(self.parsed_users)}, state)
+
+    def test_shrink(self):
+        self.pipeline.run()
+        self.sources = ['\n'.join(self.raw_users.splitlines()[:3])]
+        self.assertIsNone(self.pipeline.run())
+
+        # The last good users and outputs are kept, and so is the state
+        self.assertEqual(self.parsed_users, self.pipeline.users)
+        self.assertEqual({'counter': 8}, self.pipeline.outputs)
+        self.assertEqual(8, self.pipeline.guard.read_state()['count'])
+
+    def test_small_shrink(self):
+        self.pipeline.run()
+        self.sources = ['\n'.join(self.raw_users.splitlines()[:5])]
+        self.assertEqual({'counter': 5}, self.pipeline.run())
+        self.assertEqual(5, self.pipeline.guard.read_state()['count'])
+
+    def test_force(self):
+        self.pipeline.run()
+        self.sources = ['\n'.join(self.raw_users.splitlines()[:1])]
+        self.assertEqual({'counter': 1}, self.pipeline.run(force=True))
+        self.assertEqual(1, self.pipeline.guard.read_state()['count'])
+
+    def test_max_shrink(self):
+        guard = archmap.PublishGuard(self.state_file, max_shrink=0.9)
+        guard.commit(self.parsed_users)
+        self.assertTrue(guard.check(self.parsed_users[:1]))
+        self.assertFalse(guard.check([]))
+
+    def test_broken_state(self):
+        with open(self.state_file, 'w') as state:
+            state.write('{')
+        self.assertTrue(archmap.PublishGuard(self.state_file).check([]))
+
+
+class GenerationsTestCase(unittest.TestCase):
+    """These tests test publishing the outputs with ``Generations``
+    """
+
+    def setUp(self):
+        self.directory = 'tests/output-generations'
+        self.generations = archmap.Generations(self.directory, keep=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def publish(self, files):
+        self.generations.new(seed=['seeded'])
+        for name, contents in files.items():
+            with open(self.generations.path_for('/tmp/' + name), 'w') as output:
+                output.write(contents)
+        path = self.generations.path
+        self.generations.publish()
+        return path
+
+    def test_publish(self):
+        path = self.publish({'a.txt': 'a', 'b.txt': 'b'})
+        self.assertEqual(os.path.abspath(path), os.path.abspath(self.generations.current()))
+        with open(os.path.join(self.directory, 'current', 'a.txt'), 'r') as output:
+            self.assertEqual('a', output.read())
+        self.assertEqual([os.path.basename(path)], self.generations.generations())
+
+    def test_utc_names(self):
+        path = self.publish({'a.txt': 'a'})
+        made = datetime.datetime.strptime(os.path.basename(path), archmap.Generations.name_format)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        self.assertLess(abs((now - made).total_seconds()), 60)
+
+    def test_hardlinks(self):
+        first = self.publish({'a.txt': 'a', 'b.txt': 'b'})
+        second = self.publish({'a.txt': 'a', 'b.txt': 'c'})
+        self.assertTrue(os.path.samefile(os.path.join(first, 'a.txt'), os.path.join(second, 'a.txt')))
+        self.assertFalse(os.path.samefile(os.path.join(first, 'b.txt'), os.path.join(second, 'b.txt')))
+        self.assertEqual(['a.txt', 'b.txt'], sorted(os.listdir(second)))
+
+    def test_seed(self):
+        first = self.publish({'seeded': 'data'})
+        self.generations.new(seed=['seeded'])
+        with open(self.generations.path_for('seeded'), 'r') as output:
+            self.assertEqual('data', output.read())
+        # The copy can be changed without changing the published file
+        self.assertFalse(os.path.samefile(os.path.join(first, 'seeded'), self.generations.path_for('seeded')))
+        self.generations.discard()
+
+    def test_name_clash(self):
+        self.generations.new()
+        self.addCleanup(self.generations.discard)
+        self.assertEqual(self.generations.path_for('a/users.csv'), self.generations.path_for('a/users.csv'))
+        with self.assertRaises(ValueError):
+            self.generations.path_for('b/users.csv')
+
+    def test_main_name_clash(self):
+        sys.argv = ['test',
+                    '--config', '/dev/null',
+                    '--raw', 'tests/sample-raw.txt',
+                    '--generations', self.directory,
+                    '--text', 'a/users.txt',
+                    '--csv', 'b/users.txt',
+                    '--geojson', 'no',
+                    '--kml', 'no']
+
+        with contextlib.redirect_stderr(io.StringIO()) as error, self.assertRaises(SystemExit):
+            archmap.main()
+        self.assertIn('same file name', error.getvalue())
+        self.assertEqual([], self.generations.generations())
+
+    def test_prune(self):
+        paths = [self.publish({'a.txt': str(number)}) for number in range(4)]
+        self.assertEqual([os.path.basename(path) for path in paths[2:]], self.generations.generations())
+
+    def test_max_age(self):
+        first = self.publish({'a.txt': 'a'})
+        os.utime(first, (0, 0))
+        self.generations.max_age = 3600
+        second = self.publish({'a.txt': 'b'})
+        self.assertEqual([os.path.basename(second)], self.generations.generations())
+
+        # The current generation is kept however old it is
+        os.utime(second, (0, 0))
+        self.generations.prune()
+        self.assertEqual([os.path.basename(second)], self.generations.generations())
+
+    def test_discard(self):
+        self.publish({'a.txt': 'a'})
+        self.generations.new()
+        self.generations.discard()
+        self.assertEqual(1, len(self.generations.generations()))
+
+    def test_main(self):
+        sys.argv = ['test',
+                    '--config', '/dev/null',
+                    '--raw', 'tests/sample-raw.txt',
+                    '--generations', self.directory,
+                    '--text', 'archmap.txt',
+                    '--geojson', 'no',
+                    '--kml', 'no',
+                    '--csv', 'no']
+
+        archmap.main()
+        archmap.main()
+        first, second = (os.path.join(self.directory, name) for name in self.generations.generations())
+        self.assertTrue(os.path.samefile(os.path.join(first, 'archmap.txt'), os.path.join(second, 'archmap.txt')))
+        self.assertEqual(second, self.generations.current())
+
+
+class SnapshotArchiveTestCase(unittest.TestCase):
+    """These tests test adding snapshots of the users to a ``SnapshotArchive`` and getting them back
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    start = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def setUp(self):
+        self.archive_file = 'tests/output-archive.sqlite'
+        self.archive = archmap.SnapshotArchive(self.archive_file, keyframe_interval=3)
+
+        # Each snapshot adds, removes, changes or moves some of the users
+        fuzz = random.Random(50)
+        users = list(self.parsed_users)
+        self.history = []
+        for number in range(10):
+            if number % 2:
+                users.insert(fuzz.randrange(len(users) + 1),
+                             archmap.Entry(Decimal('1.50'), Decimal(number), 'New {}'.format(number), ''))
+            if number % 3 == 2:
+                users.pop(fuzz.randrange(len(users)))
+            if number == 5:
+                users[0] = users[0]._replace(comment='Moved')
+            if number == 7:
+                users.reverse()
+            if number == 8:
+                users.append(users[1])
+            self.history.append(list(users))
+
+    def tearDown(self):
+        try:
+            os.remove(self.archive_file)
+        except FileNotFoundError:
+            pass
+
+    def add_history(self):
+        for number, users in enumerate(self.history):
+            self.archive.add(users, self.start + datetime.timedelta(hours=6 * number))
+
+    def keyframes(self):
+        with contextlib.closing(sqlite3.connect(self.archive_file)) as connection:
+            return [row[0] for row in connection.execute('SELECT keyframe FROM snapshots ORDER BY id')]
+
+    def test_snapshots(self):
+        self.add_history()
+        for number, users in enumerate(self.history):
+            when = self.start + datetime.timedelta(hours=6 * number, minutes=30)
+            self.assertEqual(users, self.archive.snapshot(when))
+        self.assertEqual(self.history[-1], self.archive.snapshot())
+        self.assertIsNone(self.archive.snapshot(self.start - datetime.timedelta(days=1)))
+
+        # The coordinates come back exactly as they were
+        self.assertIn('1.50', [str(user.latitude) for user in self.archive.snapshot()])
+
+    def test_keyframes(self):
+        self.add_history()
+        # Reversing the users after the 8th snapshot can't be stored as a delta
+        self.assertEqual([1, 0, 0, 1, 0, 0, 1, 1, 0, 0], self.keyframes())
+
+    def test_reopen(self):
+        for number, users in enumerate(self.history):
+            archive = archmap.SnapshotArchive(self.archive_file, keyframe_interval=3)
+            archive.add(users, self.start + datetime.timedelta(hours=6 * number))
+        self.assertEqual(self.history[4], archmap.SnapshotArchive(self.archive_file).snapshot(
+            self.start + datetime.timedelta(days=1)))
+
+    def test_counts(self):
+        self.add_history()
+        counts = self.archive.counts()
+        self.assertEqual([len(users) for users in self.history], [count for _, count in counts])
+        self.assertEqual(self.start, counts[0][0])
+        self.assertEqual(counts[2:4], self.archive.counts(self.start + datetime.timedelta(hours=12),
+                                                          self.start + datetime.timedelta(hours=18)))
+
+    def test_order(self):
+        self.archive.add(self.parsed_users, self.start)
+        with self.assertRaises(ValueError):
+            self.archive.add(self.parsed_users, self.start - datetime.timedelta(hours=1))
+
+    def test_empty(self):
+        self.archive.add([], self.start)
+        self.archive.add(self.parsed_users, self.start)
+        self.archive.add([], self.start)
+        self.assertEqual([], self.archive.snapshot())
+        self.assertEqual([0, 8, 0], [count for _, count in self.archive.counts()])
+
+    def test_main(self):
+        sys.argv = ['test',
+                    '--config', '/dev/null',
+                    '--raw', 'tests/sample-raw.txt',
+                    '--archive', self.archive_file,
+                    '--text', 'no',
+                    '--geojson', 'no',
+                    '--kml', 'no',
+                    '--csv', 'no']
+
+        archmap.main()
+        archmap.main()
+        self.assertEqual([8, 8], [count for _, count in self.archive.counts()])
+        self.assertEqual([1, 0], self.keyframes())
+        self.assertEqual(self.parsed_users, self.archive.snapshot())
+
+
+class BinaryOutputTestCase(unittest.TestCase):
+    """These tests read back the binary formats made by ``make_points()`` and ``make_msgpack()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def setUp(self):
+        self.output_points = 'tests/output-archmap.points'
+
+    def tearDown(self):
+        try:
+            os.remove(self.output_points)
+        except FileNotFoundError:
+            pass
+
+    def read_points(self, points):
+        magic, version, flags, count, rows, columns, strings_offset, strings_size = struct.unpack_from('<4sHHIHHII', points)
+        self.assertEqual((b'AMPF', 1), (magic, version))
+        self.assertEqual(len(points), strings_offset + strings_size)
+
+        index = list(struct.unpack_from('<{}I'.format(rows * columns + 1), points, 24)) if flags & 1 else []
+        records_offset = strings_offset - count * 16
+        self.assertEqual(24 + len(index) * 4, records_offset)
+
+        def string(offset):
+            length, = struct.unpack_from('<I', points, strings_offset + offset)
+            return points[strings_offset + offset + 4:strings_offset + offset + 4 + length].decode()
+
+        users = []
+        for latitude, longitude, name, comment in struct.iter_unpack('<iiII', points[records_offset:strings_offset]):
+            users.append((latitude / 10 ** 7, longitude / 10 ** 7, string(name), string(comment)))
+        return users, index, columns
+
+    def sample_users(self):
+        return [(float(user.latitude), float(user.longitude), user.name, user.comment) for user in self.parsed_users]
+
+    def test_points(self):
+        archmap.make_points(self.parsed_users, self.output_points, index=False)
+        with open(self.output_points, 'rb') as file:
+            users, index, _ = self.read_points(file.read())
+
+        self.assertEqual(self.sample_users(), users)
+        self.assertEqual([], index)
+
+    def test_points_index(self):
+        users, index, columns = self.read_points(archmap.make_points(self.parsed_users))
+        self.assertEqual(sorted(self.sample_users()), sorted(users))
+        self.assertEqual(len(users), index[-1])
+
+        # Every user should be in the cell that the index says it is in
+        for cell in range(len(index) - 1):
+            for latitude, longitude, _, _ in users[index[cell]:index[cell + 1]]:
+                self.assertEqual(cell, int((latitude + 90) // 10) * columns + int((longitude + 180) // 10))
+
+        # London and Ottawa are in the same row, so London comes first
+        self.assertLess(users.index(self.sample_users()[4]), users.index(self.sample_users()[0]))
+
+    def test_points_strings(self):
+        users = archmap.parse_users('1,2 "Same" # Same\n3,4 "Same" # Same\n5,6 "Ünïcödé" #')
+        points = archmap.make_points(users)
+        self.assertEqual(24 + (18 * 36 + 1) * 4 + 3 * 16 + (4 + 4) + (4 + 11) + 4, len(points))
+        self.assertEqual([(1, 2, 'Same', 'Same'), (3, 4, 'Same', 'Same'), (5, 6, 'Ünïcödé', '')],
+                         self.read_points(points)[0])
+
+    def test_msgpack(self):
+        users = archmap.parse_users('51.5,-0.125 "User 0" # London\n1,2 "{}" #'.format('x' * 40))
+        self.assertEqual(b'\x92'
+                         b'\x94\xcb' + struct.pack('>d', 51.5) + b'\xcb' + struct.pack('>d', -0.125) +
+                         b'\xa6User 0\xa6London'
+                         b'\x94\xcb' + struct.pack('>d', 1) + b'\xcb' + struct.pack('>d', 2) +
+                         b'\xd9\x28' + b'x' * 40 + b'\xa0',
+                         archmap.make_msgpack(users))
+
+    def test_msgpack_long_list(self):
+        users = archmap.parse_users('1,2 "User" #\n' * 20)
+        self.assertEqual(b'\xdc\x00\x14\x94', archmap.make_msgpack(users)[:4])
+
+
+class IdTestCase(unittest.TestCase):
+    """These tests test ``make_ids()`` and the IDs in the GeoJSON and KML outputs
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def setUp(self):
+        self.id_file = 'tests/output-ids.json'
+
+    def tearDown(self):
+        try:
+            os.remove(self.id_file)
+        except FileNotFoundError:
+            pass
+
+    def test_stable_ids(self):
+        ids = archmap.make_ids(self.parsed_users)
+        self.assertEqual(len(self.parsed_users), len(set(ids)))
+        self.assertRegex(ids[0], '^[0-9a-f]{12}$')
+
+        # Adding a user to the start of the list doesn't change the IDs of the others.
+        new_user = archmap.Entry(Decimal('1'), Decimal('2'), 'New user', '')
+        self.assertEqual(ids, archmap.make_ids([new_user] + self.parsed_users)[1:])
+
+    def test_collisions(self):
+        users = self.parsed_users[:1] * 3
+        ids = archmap.make_ids(users)
+        self.assertEqual([ids[0], ids[0] + '-1', ids[0] + '-2'], ids)
+
+    def test_id_file(self):
+        ids = archmap.make_ids(self.parsed_users[:1] * 2 + self.parsed_users[1:], self.id_file)
+        with open(self.id_file, 'r') as index_file:
+            index = json.load(index_file)
+        self.assertEqual(sorted(ids), sorted(index))
+        self.assertEqual('51.5073219,-0.1276474 "User 0" # London, UK', index[ids[0]])
+
+        # The IDs are read back from the file, so the copy that is left and the other users keep theirs.
+        new_user = archmap.Entry(Decimal('1'), Decimal('2'), 'New user', '')
+        new_ids = archmap.make_ids(self.parsed_users[:1] + self.parsed_users[1:] + [new_user], self.id_file)
+        self.assertEqual(ids[:1] + ids[2:], new_ids[:-1])
+        self.assertNotIn(new_ids[-1], ids)
+
+    def test_outputs(self):
+        ids = archmap.make_ids(self.parsed_users)
+        geojson = json.loads(archmap.make_geojson(self.parsed_users, ids=ids))
+        self.assertEqual(ids, [feature['id'] for feature in geojson['features']])
+
+        kml = archmap.make_kml(self.parsed_users, ids=ids)
+        self.assertEqual(ids, re.findall('<Placemark id="feat_([^"]*)">', kml))
+
+
+class CountryTestCase(unittest.TestCase):
+    """These tests test ``CountryLookup``, ``locate_users()`` and ``make_country_counts()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def setUp(self):
+        self.boundaries = 'tests/sample-boundaries.geojson'
+        self.output_countries = 'tests/output-countries.json'
+
+    def tearDown(self):
+        try:
+            os.remove(self.output_countries)
+        except FileNotFoundError:
+            pass
+
+    def test_lookup(self):
+        lookup = archmap.CountryLookup(self.boundaries)
+        self.assertEqual('GB', lookup.country(Decimal('51.5073219'), Decimal('-0.1276474')))
+        self.assertEqual('ZA', lookup.country(Decimal('-33.9289049'), Decimal('18.4172485')))
+        self.assertIsNone(lookup.country(Decimal('55.7516335'), Decimal('37.6187042')))
+
+    def test_holes_and_multipolygons(self):
+        lookup = archmap.CountryLookup(self.boundaries)
+        self.assertEqual('LS', lookup.country(Decimal('-29.5'), Decimal('28.2')))
+        self.assertEqual('JP', lookup.country(Decimal('35.6823815'), Decimal('139.7530053')))
+        self.assertEqual('JP', lookup.country(Decimal('31.5'), Decimal('129.5')))
+        self.assertIsNone(lookup.country(Decimal('33.5'), Decimal('131.5')))
+
+    def test_grid_sizes(self):
+        countries = archmap.locate_users(self.parsed_users, archmap.CountryLookup(self.boundaries))
+        for cell_size in (0.1, 5, 360):
+            with self.subTest(cell_size=cell_size):
+                lookup = archmap.CountryLookup(self.boundaries, cell_size=cell_size)
+                self.assertEqual(countries, archmap.locate_users(self.parsed_users, lookup))
+
+    def test_cache(self):
+        lookup = archmap.CountryLookup(self.boundaries)
+        lookup.country(Decimal('51.5073219'), Decimal('-0.1276474'))
+        lookup.country(Decimal('51.5095'), Decimal('-0.1289'))
+        self.assertEqual({(51.51, -0.13): 'GB'}, lookup.cache)
+
+    def test_code_property(self):
+        lookup = archmap.CountryLookup(self.boundaries, code_property='NAME')
+        self.assertEqual('United Kingdom', lookup.country(Decimal('51.5073219'), Decimal('-0.1276474')))
+
+    def test_counts(self):
+        countries = archmap.locate_users(self.parsed_users, archmap.CountryLookup(self.boundaries))
+        self.assertEqual(['GB', 'ZA', None, 'JP', None, None, None, None], countries)
+
+        archmap.make_country_counts(countries, self.output_countries)
+        with open(self.output_countries, 'r') as file:
+            self.assertEqual({'': 5, 'GB': 1, 'JP': 1, 'ZA': 1}, json.load(file))
+
+    def test_interactive(self):
+        sys.argv = ['test',
+                    '--file', 'tests/ArchMap_List-stripped.html',
+                    '--boundaries', self.boundaries,
+                    '--countries', self.output_countries,
+                    '--text', 'no',
+                    '--geojson', 'no',
+                    '--kml', 'no',
+                    '--csv', 'no']
+        archmap.main()
+
+        with open(self.output_countries, 'r') as file:
+            self.assertEqual({'': 5, 'GB': 1, 'JP': 1, 'ZA': 1}, json.load(file))
+
+
+class DensityTestCase(unittest.TestCase):
+    """These tests test ``count_cells()``, ``make_density()`` and ``make_density_grid()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def test_count_cells(self):
+        cells = archmap.count_cells(self.parsed_users, Decimal('10'))
+        self.assertEqual(len(self.parsed_users), sum(cells.values()))
+        self.assertEqual(1, cells[5, -1])
+        self.assertEqual(1, cells[-4, 1])
+        self.assertEqual(1, cells[1, 1])
+
+        users = [archmap.Entry(Decimal('20'), Decimal('20'), 'User', '')] * 3
+        self.assertEqual({(40, 40): 3}, archmap.count_cells(users, Decimal('0.5')))
+
+    def test_edges(self):
+        users = [archmap.Entry(Decimal('90'), Decimal('180'), 'North pole', ''),
+                 archmap.Entry(Decimal('-90'), Decimal('-180'), 'South pole', '')]
+        self.assertEqual({(8, 17): 1, (-9, -18): 1}, archmap.count_cells(users, Decimal('10')))
+        self.assertEqual({(1, 2): 1, (-2, -3): 1}, archmap.count_cells(users, Decimal('70')))
+
+    def test_bad_cells(self):
+        users = [archmap.Entry(Decimal('91'), Decimal('10'), 'Too far north', ''),
+                 archmap.Entry(Decimal('10'), Decimal('-180.5'), 'Too far west', ''),
+                 archmap.Entry(Decimal('10'), Decimal('10'), 'User', '')]
+        self.assertEqual({(1, 1): 1}, archmap.count_cells(users, Decimal('10')))
+
+        for cell_size in (Decimal('0'), Decimal('-1')):
+            with self.subTest(cell_size=cell_size):
+                with self.assertRaises(ValueError):
+                    archmap.count_cells(users, cell_size)
+                with self.assertRaises(ValueError):
+                    archmap.make_density_grid({}, cell_size=cell_size)
+
+        with self.assertRaises(ValueError):
+            archmap.make_density_grid({}, cell_size=Decimal('0.01'))
+        # A 9 degree grid has 20 rows of 40 cells, so it's just within the limit
+        self.assertEqual(6 + 20, len(archmap.make_density_grid({}, cell_size=Decimal('9'), max_cells=800).splitlines()))
+        with self.assertRaises(ValueError):
+            archmap.make_density_grid({}, cell_size=Decimal('9'), max_cells=799)
+
+    def test_main_cell_size(self):
+        for cell_size, message in (('0', 'more than 0'), ('-2', 'more than 0'), ('0.01', 'use larger cells')):
+            with self.subTest(cell_size=cell_size):
+                sys.argv = ['test',
+                            '--config', '/dev/null',
+                            '--raw', 'tests/sample-raw.txt',
+                            '--density-grid', '-',
+                            '--cell-size', cell_size,
+                            '--text', 'no',
+                            '--geojson', 'no',
+                            '--kml', 'no',
+                            '--csv', 'no']
+                with contextlib.redirect_stderr(io.StringIO()) as error, self.assertRaises(SystemExit):
+                    archmap.main()
+                self.assertIn(message, error.getvalue())
+
+    def test_density(self):
+        cells = archmap.count_cells(self.parsed_users, Decimal('0.5'))
+        geojson = json.loads(archmap.make_density(cells, cell_size=Decimal('0.5')))
+        self.assertEqual(len(cells), len(geojson['features']))
+        self.assertIn({'type': 'Feature',
+                       'geometry': {'type': 'Polygon',
+                                    'coordinates': [[[-0.5, 51.5], [0, 51.5], [0, 52], [-0.5, 52], [-0.5, 51.5]]]},
+                       'properties': {'Users': 1}}, geojson['features'])
+
+    def test_density_grid(self):
+        cells = archmap.count_cells(self.parsed_users, Decimal('30'))
+        grid = archmap.make_density_grid(cells, cell_size=Decimal('30')).splitlines()
+        self.assertEqual(['ncols 12', 'nrows 6', 'xllcorner -180', 'yllcorner -90', 'cellsize 30', 'NODATA_value -1'],
+                         grid[:6])
+        self.assertEqual(['0 0 0 0 0 0 0 0 0 0 0 0',
+                          '0 0 0 1 0 1 0 1 0 0 1 0',
+                          '0 0 0 0 0 0 2 0 0 0 0 0',
+                          '0 0 0 0 1 0 0 0 0 0 0 0',
+                          '0 0 0 0 0 0 1 0 0 0 0 0',
+                          '0 0 0 0 0 0 0 0 0 0 0 0'], grid[6:])
+
+
+class SQLiteOutputTestCase(unittest.TestCase):
+    """These tests test exporting and updating the users in an SQLite database with ``make_sqlite()``
+    """
+
+    with open('tests/sample-parsed_users.pickle', 'rb') as pickled_input:
+        parsed_users = pickle.load(pickled_input)
+
+    def setUp(self):
+        self.output_sqlite = 'tests/output-archmap.sqlite'
+
+    def tearDown(self):
+        try:
+            os.remove(self.output_sqlite)
+        except FileNotFoundError:
+            pass
+
+    def query(self, sql):
+        connection = sqlite3.connect(self.output_sqlite)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_export(self):
+        self.assertEqual((8, 0), archmap.make_sqlite(self.parsed_users, self.output_sqlite))
+
+        rows = self.query('SELECT latitude, longitude, name, comment FROM users ORDER BY id')
+        self.assertEqual([(float(user.latitude), float(user.longitude), user.name, user.comment)
+                          for user in self.parsed_users], rows)
+
+        indexes = self.query("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'users'")
+        self.assertEqual({('users_latitude',), ('users_longitude',)}, set(indexes))
+
+    def test_rtree(self):
+        archmap.make_sqlite(self.parsed_users, self.output_sqlite)
+        if not self.query("SELECT name FROM sqlite_master WHERE name = 'users_rtree'"):
+            self.skipTest('SQLite does not have the R*Tree module')
+
+        rows = self.query('SELECT name FROM users JOIN users_rtree USING (id) WHERE min_latitude >= 50 AND '
+                          'max_latitude <= 52 AND min_longitude >= -1 AND max_longitude <= 1')
+        self.assertEqual([('User 0',)], rows)
+
+    def test_incremental_update(self):
+        archmap.make_sqlite(self.parsed_users, self.output_sqlite)
+        first_ids = dict(self.query('SELECT name, id FROM users'))
+
+        changed_users = self.parsed_users[1:] + archmap.parse_users('1,2 "User 8" # New')
+        changed_users[2] = changed_users[2]._replace(comment='Moved')
+        self.assertEqual((2, 2), archmap.make_sqlite(changed_users, self.output_sqlite))
+
+        # Users that haven't changed should keep their rows
+        second_ids = dict(self.query('SELECT name, id FROM users'))
+        self.assertNotIn('User 0', second_ids)
+        self.assertEqual(first_ids['User 1'], second_ids['User 1'])
+        self.assertNotEqual(first_ids['User 3'], second_ids['User 3'])
+        self.assertEqual([('Moved',)], self.query("SELECT comment FROM users WHERE name = 'User 3'"))
+        self.assertEqual([(8,)], self.query('SELECT count(*) FROM users'))
+
+        self.assertEqual((0, 0), archmap.make_sqlite(changed_users, self.output_sqlite))
+
+    def test_duplicates(self):
+        users = self.parsed_users[:1] * 3
+        self.assertEqual((3, 0), archmap.make_sqlite(users, self.output_sqlite))
+        self.assertEqual((0, 1), archmap.make_sqlite(users[:2], self.output_sqlite))
+
+    def test_rollback(self):
+        archmap.make_sqlite(self.parsed_users, self.output_sqlite)
+        with self.assertRaises(AttributeError):
+            archmap.make_sqlite(self.parsed_users[:2] + [None], self.output_sqlite)
+        self.assertEqual([(8,)], self.query('SELECT count(*) FROM users'))
+
+
 class InteractiveTestCase(unittest.TestCase):
     """These tests test the interactive part of the script - the "main()" function
     """
@@ -470,6 +2329,34 @@ class LogLevelTestCase(unittest.TestCase):
         self.assertEqual(archmap.log.level, 50)
 
 
+class ImportTestCase(unittest.TestCase):
+    """These tests check that the heavier modules are only imported when they are needed
+    """
+
+    heavy_modules = ['asyncio', 'geojson', 'http.client', 'sqlite3', 'xml.etree.ElementTree']
+
+    def imported_modules(self, code):
+        code = 'import sys\n' + code + '\nprint(" ".join(m for m in {} if m in sys.modules))'.format(self.heavy_modules)
+        output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True)
+        return output.stdout.decode().split()
+
+    def test_import(self):
+        self.assertEqual([], self.imported_modules('import archmap'))
+
+    def test_text_and_csv(self):
+        code = ('import sys, archmap\n'
+                'sys.argv = ["archmap", "--quiet", "--file", "tests/ArchMap_List-stripped.html",\n'
+                '            "--text", "/dev/null", "--csv", "/dev/null", "--geojson", "no", "--kml", "no"]\n'
+                'archmap.main()')
+        self.assertEqual([], self.imported_modules(code))
+
+    def test_all_outputs(self):
+        code = ('import archmap\n'
+                'archmap.make_geojson([])\n'
+                'archmap.make_kml([])')
+        self.assertEqual(['geojson'], self.imported_modules(code))
+
+
 class ConfigFileTestCase(unittest.TestCase):
     """These tests check that the config file is correct
     """
@@ -481,12 +2368,52 @@ class ConfigFileTestCase(unittest.TestCase):
         test_config = configparser.ConfigParser()
         test_config['files'] = {'url': 'https://wiki.archlinux.org/index.php/ArchMap/List',
                                 'file': '',
+                                'api': '',
+                                'title': 'ArchMap/List',
+                                'revision': '',
+                                'raw': '',
+                                'load': '',
+                                'sources': '',
                                 'text': '/tmp/archmap.txt',
                                 'geojson': '/tmp/archmap.geojson',
                                 'kml': '/tmp/archmap.kml',
-                                'csv': '/tmp/archmap.csv'}
+                                'csv': '/tmp/archmap.csv',
+                                'points': '',
+                                'msgpack': '',
+                                'sqlite': '',
+                                'ids': '',
+                                'boundaries': '',
+                                'countries': '',
+                                'country_code': 'ISO_A2',
+                                'density': '',
+                                'density_grid': '',
+                                'parse_report': '',
+                                'state': '',
+                                'generations': '',
+                                'archive': ''}
+        test_config['csv'] = {'columns': 'latitude, longitude, name, comment',
+                              'precision': '',
+                              'encoding': 'utf-8',
+                              'buffering': '-1'}
+        test_config['limits'] = {'download': '67108864',
+                                 'line_length': '4096',
+                                 'users': '1000000',
+                                 'parse_time': '60'}
         test_config['extras'] = {'verbosity': '1',
-                                 'pretty': 'False'}
+                                 'pretty': 'False',
+                                 'precision': '',
+                                 'compact': 'False',
+                                 'sort': '',
+                                 'cell_size': '1',
+                                 'validate': 'flag',
+                                 'nearby': '0.01',
+                                 'max_bad_lines': '',
+                                 'max_shrink': '0.5',
+                                 'keep_generations': '3',
+                                 'generation_max_age': '',
+                                 'keyframe_interval': '28',
+                                 'timeout': '30',
+                                 'retries': '2'}
 
         self.assertEqual(default_config, test_config)
 